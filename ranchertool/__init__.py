@@ -1,2 +1,10 @@
 import sys
 sys.path.append('.')
+
+from .api import apply_compose, connect, deploy, pre_pull, rollback, DeployOutcome, DeployResult
+from .fleet import deploy_fleet, load_fleet, FleetOrdering, FleetReport, FleetTarget
+from .history import DeployHistory
+from .reconcile import reconcile_services, run_reconcile, DefinitionDirectory, ReconcileReport, ReconcileState
+from .release import load_plan, run_release, ReleaseReport, ReleaseStep
+from .helpers import RancherToolError, ConfigurationError, RancherApiError, NotFoundError, DeadlineExceeded, \
+    UpgradeFailed, RollbackStrategy, ServiceSnapshot, LaunchConfig, Service, Stack, Clock, VirtualClock
@@ -0,0 +1,566 @@
+"""
+The library interface of ranchertool.
+
+deploy() runs the same create/upgrade/wait/finish flow as the command line, but reports failures as RancherToolError
+subclasses instead of exiting and returns a DeployResult with the outcome and per-phase timings. Pass the same
+connection to many deploy() calls (from as many threads as you like) to reuse its connection pool and id caches:
+
+    connection = connect('https://rancher.example.com', access_key, secret_key)
+    result = deploy(connection, 'web', 'api', image='registry.example.com/web/api:42')
+
+Every upgrade snapshots the service's launch configs first (result.snapshot, or a file with snapshot_file). rollback()
+brings the service back to a snapshot, also long after the upgrade was finished.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from typing import Dict, NamedTuple, Optional
+
+from .helpers import ConfigurationError, Deadline, DeployHandle, LogLevel, Logger, NotFoundError, RancherApiError, \
+    Http2Transport, RancherConnection, RecordingTransport, ReplayTransport, RollbackStrategy, ServiceSnapshot, \
+    ServiceState, ServiceTarget, UpgradeFailed, get_codec
+
+
+class DeployOutcome(Enum):
+    CREATED = 'created'
+    TRIGGERED = 'triggered'
+    UPGRADED = 'upgraded'
+    FINISHED = 'finished'
+
+
+class DeployResult(NamedTuple):
+    """
+    What a deploy did, how long each of its phases took and how many requests each phase sent. Upgrades carry the
+    snapshot of the service's launch configs from before the upgrade.
+    """
+    stack_name: str
+    service_name: str
+    service_id: Optional[str]
+    outcome: Optional[DeployOutcome]
+    timings: Dict[str, float]
+    handle: Optional[DeployHandle] = None
+    requests: Dict[str, int] = {}
+    snapshot: Optional[ServiceSnapshot] = None
+
+    @property
+    def duration(self):
+        return sum(self.timings.values())
+
+    @property
+    def request_count(self):
+        return sum(self.requests.values())
+
+
+def connect(rancher_url, access_key, secret_key, project_name=None, api_version='v2-beta', ssl_verify=True,
+            timeout=300, connect_timeout=10, request_timeout=30, deadline=None, log_level=LogLevel.INFO,
+            project_id=None, pool_size=10, record=None, replay=None, replay_speed=None, codec=None, http2=False,
+            inventory=False, clock=None):
+    """
+    Opens a RancherConnection that deploy() calls can share.
+
+    :param record: A file to record all requests and responses to (see Cassette).
+    :param replay: A cassette file to answer all requests from instead of the Rancher server.
+    :param replay_speed: How fast to replay: None answers immediately, 1 at the recorded speed, 10 ten times faster.
+    :param codec: The JSON library to use ('orjson', 'ujson' or 'json'). Defaults to the fastest one installed.
+    :param http2: Speaks HTTP/2 with servers that support it, multiplexing all requests over one connection (needs
+                  httpx, see Http2Transport).
+    :param inventory: Looks stacks and services up in an index of the whole project (see Inventory), for runs that
+                      touch services in many stacks.
+    :param clock: The Clock to wait and measure time with (see VirtualClock). Defaults to the system's.
+
+    :raises ConfigurationError: if the URL is not a valid URL
+    :raises NotFoundError: if the environment (project) can't be found
+    """
+    if "://" not in rancher_url:
+        raise ConfigurationError("The Rancher URL doesn't look right. Please verify that it's a valid URL (i.e. "
+                                 "https://my.rancher.com).")
+    if record and replay:
+        raise ConfigurationError("A run can either be recorded or replayed, not both.")
+    transport = Http2Transport(ssl_verify, pool_size) if http2 and not replay else None
+    try:
+        if record:
+            transport = RecordingTransport(record, pool_size, transport)
+        elif replay:
+            transport = ReplayTransport(replay, replay_speed)
+    except (OSError, ValueError) as e:
+        raise ConfigurationError("Unable to open the cassette: %s" % format(e))
+    try:
+        codec = get_codec(codec)
+    except ValueError as e:
+        raise ConfigurationError(format(e))
+    return RancherConnection(rancher_url, access_key, secret_key, project_name, None, None, ssl_verify, api_version,
+                             log_level, timeout, pool_size=pool_size, connect_timeout=connect_timeout,
+                             read_timeout=request_timeout, deadline=deadline, project_id=project_id,
+                             transport=transport, codec=codec, inventory=inventory, clock=clock)
+
+
+def deploy(connection, stack_name, service_name, image=None, batch_size=1, batch_interval=2,
+           start_before_stopping=False, wait=True, finish=True, rollback=False, sidekicks=False,
+           new_sidekick_images=None, create_stack=False, create_service=False, labels=None, variables=None,
+           service_links=None, pre_pull=False, deadline=None, log_level=LogLevel.INFO, snapshot_file=None,
+           rollback_strategy=RollbackStrategy.AUTO, rollback_batch_size=None, service_id=None):
+    """
+    Creates or upgrades a service.
+
+    :param connection: The RancherConnection to deploy through (see connect()).
+    :param image: The new image (and :tag) of the service. Required to create a service.
+    :param new_sidekick_images: A {sidekick name: image} dict (or list of pairs) of sidekick images to replace.
+    :param labels: Labels to add, as a dict or in any format RancherConnection.parse_labels accepts.
+    :param variables: Environment variables to add, as a dict or in any format RancherConnection.parse_variables
+                      accepts.
+    :param service_links: Service links to set, in any format RancherConnection.resolve_service_links accepts.
+    :param pre_pull: Whether to pull the new images on the hosts before the upgrade is started (see pre_pull()).
+    :param deadline: Seconds the whole deploy may take, or a Deadline. Defaults to the connection's deadline.
+    :param snapshot_file: A file to save the service's snapshot to before the upgrade starts (see rollback()).
+    :param rollback_strategy: How a failed upgrade is rolled back when rollback is set (see RollbackStrategy).
+    :param rollback_batch_size: Containers to replace at once when the snapshot is re-applied. Defaults to all.
+    :param service_id: The id of the service, if it was just looked up (e.g. with find_services()). Upgrades the
+                       service with that id instead of looking the name up again.
+    :return: A DeployResult. With wait=False, its handle can be used to resume the upgrade later.
+    :raises RancherToolError: (or one of its subclasses) if the deploy fails
+    """
+    if deadline is not None and not isinstance(deadline, Deadline):
+        deadline = Deadline(deadline, connection.get_clock())
+    with connection.deadline_scope(deadline or connection.get_deadline()):
+        return _Deploy(connection, stack_name, service_name, log_level, service_id).run(
+            image, batch_size, batch_interval, start_before_stopping, wait, finish, rollback, sidekicks,
+            dict(new_sidekick_images or {}), create_stack, create_service, labels, variables, service_links, pre_pull,
+            snapshot_file, RollbackStrategy(rollback_strategy), rollback_batch_size)
+
+
+def rollback(connection, snapshot, strategy=RollbackStrategy.AUTO, batch_size=None, batch_interval=0,
+             start_before_stopping=False, deadline=None, log_level=LogLevel.INFO):
+    """
+    Brings a service back to the launch configs of a snapshot taken before an upgrade.
+
+    While the upgrade is still in progress (upgrading or upgraded), Rancher's rollback action is the fastest way back:
+    it restarts the containers it kept. Once the upgrade was finished (or when the action fails), the snapshot is
+    re-applied as a new upgrade that replaces all containers at once.
+
+    :param snapshot: A ServiceSnapshot (e.g. DeployResult.snapshot), or the file it was saved to.
+    :param strategy: A RollbackStrategy (or its value): AUTO, only the rollback ACTION, or always REAPPLY.
+    :param batch_size: Containers to replace at once when re-applying. Defaults to the service's scale.
+    :return: A DeployResult with the 'rollback' and/or 'reapply' phases
+    :raises ConfigurationError: if the snapshot file can't be read
+    :raises UpgradeFailed: if the service could not be brought back
+    """
+    if not isinstance(snapshot, ServiceSnapshot):
+        try:
+            snapshot = ServiceSnapshot.load(snapshot)
+        except (OSError, ValueError) as e:
+            raise ConfigurationError("Unable to read the snapshot: %s" % format(e))
+    if deadline is not None and not isinstance(deadline, Deadline):
+        deadline = Deadline(deadline, connection.get_clock())
+    with connection.deadline_scope(deadline or connection.get_deadline()):
+        return _Deploy(connection, snapshot.stack_name, snapshot.service_name, log_level).restore(
+            snapshot, RollbackStrategy(strategy), batch_size, batch_interval, start_before_stopping)
+
+
+def apply_compose(connection, stack_name, docker_compose, rancher_compose=None, environment=None, create_stack=True,
+                  wait=True, finish=True, rollback=False, deadline=None, log_level=LogLevel.INFO):
+    """
+    Creates or upgrades a whole stack from a docker-compose/rancher-compose pair. Rancher applies every service of the
+    stack from a single create or upgrade request, so this takes one request plus one wait however many services the
+    stack has.
+
+    :param docker_compose: The contents of the docker-compose.yml.
+    :param rancher_compose: The contents of the rancher-compose.yml, if any.
+    :param environment: A {name: value} dict of variables to interpolate into the compose files.
+    :param create_stack: Whether to create the stack if it doesn't exist.
+    :return: A DeployResult (without a service). Its outcome is CREATED when the stack was created.
+    :raises RancherToolError: (or one of its subclasses) if the apply fails
+    """
+    if deadline is not None and not isinstance(deadline, Deadline):
+        deadline = Deadline(deadline, connection.get_clock())
+    with connection.deadline_scope(deadline or connection.get_deadline()):
+        return _Deploy(connection, stack_name, None, log_level).compose(
+            docker_compose, rancher_compose, environment, create_stack, wait, finish, rollback)
+
+
+def pre_pull(connection, images, timeout=None, deadline=None, log_level=LogLevel.INFO):
+    """
+    Pulls images on all hosts of the environment ahead of an upgrade, so that the upgrade's batches only pay for
+    starting containers. One Rancher pull task is started per image and all of them are waited for concurrently.
+
+    :raises RancherApiError: if an image could not be pulled in time
+    """
+    if deadline is not None and not isinstance(deadline, Deadline):
+        deadline = Deadline(deadline, connection.get_clock())
+    with connection.deadline_scope(deadline or connection.get_deadline()):
+        _pre_pull(connection, images, Logger(log_level, 'PrePull'), timeout)
+
+
+def _pre_pull(connection, images, log, timeout=None):
+    """:return: The number of requests sent by the threads waiting for the pulls"""
+    images = list(dict.fromkeys(images))
+    pull_tasks = [connection.create_pull_task(image) for image in images]
+    failed = [image for image, pull_task in zip(images, pull_tasks) if pull_task is None]
+    deadline = connection.get_deadline()
+
+    def wait(pull_task):
+        # deadline scopes are per thread, so carry the caller's deadline over to the pool's threads
+        with connection.deadline_scope(deadline):
+            sent = connection.requests_sent()
+            return connection.wait_for_pull_task(pull_task['id'], timeout), connection.requests_sent() - sent
+
+    started = [(image, pull_task) for image, pull_task in zip(images, pull_tasks) if pull_task is not None]
+    requests = 0
+    if started:
+        with ThreadPoolExecutor(max_workers=len(started)) as pool:
+            done = list(pool.map(wait, [pull_task for image, pull_task in started]))
+        failed += [image for (image, pull_task), (pulled, sent) in zip(started, done) if not pulled]
+        requests = sum(sent for pulled, sent in done)
+    if failed:
+        raise RancherApiError("Pre-pulling %s failed." % ', '.join(failed))
+    log.info("Pre-pulled %s." % ', '.join(images))
+    return requests
+
+
+class _Deploy:
+    """The steps of a single deploy, with the bookkeeping for its DeployResult."""
+
+    def __init__(self, connection, stack_name, service_name, log_level, service_id=None):
+        self.__connection = connection
+        self.__log = Logger(log_level, 'Deploy').bind(service='%s/%s' % (stack_name, service_name) if service_name
+                                                      else stack_name)
+        self.__stack_name = stack_name
+        self.__service_name = service_name
+        self.__service_id = service_id
+        self.__timings = {}
+        self.__requests = {}
+        self.__phase = None
+        self.__phase_started = None
+        self.__phase_requests = 0
+        self.__snapshot = None
+
+    def run(self, image, batch_size, batch_interval, start_before_stopping, wait, finish, rollback, sidekicks,
+            new_sidekick_images, create_stack, create_service, labels, variables, service_links, pre_pull,
+            snapshot_file, rollback_strategy, rollback_batch_size):
+        rancher = self.__connection
+        try:
+            # 1 -> Build the target: labels and variables
+            self.__start_phase('discovery')
+            target = rancher.target(self.__stack_name, self.__service_name)._replace(service_id=self.__service_id)
+            if labels:
+                target = target.with_labels(labels if isinstance(labels, dict) else rancher.parse_labels(labels))
+            if variables:
+                target = target.with_variables(variables if isinstance(variables, dict)
+                                               else rancher.parse_variables(variables))
+
+            # 2 -> Look everything up at once and validate it before anything is changed
+            target, stack_found, lifecycle = self.__preflight(target, image, service_links, new_sidekick_images,
+                                                              create_stack, create_service)
+
+            # 3 -> Create the stack (aka "environment") and the service, if needed
+            if not stack_found:
+                if not rancher.create_stack(target=target):
+                    raise RancherApiError("Creating stack failed.")
+                self.__log.info('Successfully created stack')
+            if lifecycle is None:
+                self.__start_phase('create')
+                if not rancher.create_service(image, target=target):
+                    raise RancherApiError("Failed to create a service called '%s'." % self.__service_name)
+                self.__service_id = rancher.resolve(target).service_id
+                self.__log.info("Service was successfully created. Thank you and have a nice day!")
+                return self.__result(DeployOutcome.CREATED)
+
+            # 4 -> Is the service eligible for upgrade?
+            self.__service_id = lifecycle.target.service_id
+            if lifecycle.state == ServiceState.UPGRADED:
+                self.__log.warn("The current service state is 'upgraded'. Finishing the previous upgrade before "
+                                "starting a new one...")
+                if not lifecycle.finish():
+                    raise UpgradeFailed("Failed to finish the previous upgrade.", self.__result(None))
+
+            self.__log.info("Upgrading %s/%s in environment %s..." %
+                            (self.__stack_name, self.__service_name, rancher.get_project_name()))
+            self.__snapshot = ServiceSnapshot.take(rancher.get_project_id(), lifecycle)
+            if snapshot_file:
+                try:
+                    self.__snapshot.save(snapshot_file)
+                except OSError as e:
+                    raise ConfigurationError("Unable to save the snapshot of %s/%s: %s" %
+                                             (self.__stack_name, self.__service_name, format(e)))
+            upgrade = build_upgrade(lifecycle, target, image, batch_size, batch_interval, start_before_stopping,
+                                    sidekicks, new_sidekick_images)
+
+            if pre_pull:
+                images = [image] if image else []
+                images += [new_sidekick_images[name] for name in sorted(new_sidekick_images)]
+                if images:
+                    self.__start_phase('pull')
+                    # the waits for the pulls run on other threads, which the phase's request count doesn't see
+                    self.__phase_requests -= _pre_pull(rancher, images, self.__log)
+
+            # 5 -> Start the upgrade
+            self.__start_phase('upgrade')
+            if not lifecycle.upgrade(upgrade):
+                raise UpgradeFailed("The upgrade could not be started.", self.__result(None))
+
+            # 6 -> Wait for the upgrade to finish
+            if not wait:
+                self.__log.info("Upgrade triggered. Not waiting for finish.")
+                handle = DeployHandle.start(rancher.get_project_id(), lifecycle.target)
+                return self.__result(DeployOutcome.TRIGGERED, handle)
+
+            self.__start_phase('wait')
+            self.__log.info("Upgrade started, waiting for upgrade to complete...")
+            if not lifecycle.wait_until(ServiceState.UPGRADED):
+                if not rollback:
+                    raise UpgradeFailed("The upgrade failed. Please investigate the cause and resolve any issues "
+                                        "before trying again.", self.__result(None))
+                self.__roll_back(lifecycle, self.__snapshot, rollback_strategy, rollback_batch_size)
+                raise UpgradeFailed("Service successfully rolled back. Please investigate why the upgrade failed and "
+                                    "resolve any issued before trying again.", self.__result(None), rolled_back=True)
+
+            if not finish:
+                self.__log.info("Service upgraded. Upgrade still needs to be manually finished.")
+                return self.__result(DeployOutcome.UPGRADED)
+
+            self.__start_phase('finish')
+            self.__log.info("Finishing upgrade...")
+            if not lifecycle.finish():
+                raise UpgradeFailed("Something happened while waiting for the upgraded to be finished. Please "
+                                    "investigate the cause and resolve any issues before trying again.",
+                                    self.__result(None))
+            self.__log.info("Upgrade finished.")
+            return self.__result(DeployOutcome.FINISHED)
+        finally:
+            self.__start_phase(None)
+
+    def __preflight(self, target, image, service_links, new_sidekick_images, create_stack, create_service):
+        """
+        Resolves the service links while the stack, the service and its state are looked up, each on a thread of its
+        own, so that the discovery takes as long as the slowest of those lookups, then validates all of it. Nothing is
+        created or changed before this passes.
+
+        :return: The target with its service links, whether the stack exists and the service's ServiceLifecycle (None
+                 if the service doesn't exist)
+        """
+        rancher = self.__connection
+        links = rancher.parse_service_links(service_links, strict=True) if service_links else []
+        deadline = rancher.get_deadline()
+
+        def counted(call, *args):
+            # deadline scopes are per thread, so carry the caller's deadline over to the pool's threads
+            with rancher.deadline_scope(deadline):
+                sent = rancher.requests_sent()
+                return call(*args), rancher.requests_sent() - sent
+
+        def look_up():
+            # each lookup needs the one before it: the service is looked up in the stack, its state by its id
+            stack_exists = rancher.stack_exists(target=target)
+            service_exists = stack_exists and rancher.service_exists(target=target)
+            service = rancher.get_service(target=rancher.resolve(target)) if service_exists else None
+            return stack_exists, service_exists, service
+
+        with ThreadPoolExecutor(max_workers=len(links) + 1) as pool:
+            looking_up = pool.submit(counted, look_up)
+            resolving = [pool.submit(counted, rancher.resolve_service_link, reference) for name, reference in links]
+            (stack_found, service_found, service), looked_up = looking_up.result()
+            resolved = [future.result() for future in resolving]
+        # the lookups on other threads aren't counted by the phase's request count
+        self.__phase_requests -= looked_up + sum(sent for service_id, sent in resolved)
+
+        missing = [reference for (name, reference), (service_id, sent) in zip(links, resolved) if service_id is None]
+        if missing:
+            raise NotFoundError("Unable to find the services to link to: %s." % ', '.join(missing))
+        if links:
+            target = target.with_service_links([(name, service_id)
+                                                for (name, reference), (service_id, sent) in zip(links, resolved)])
+        if service_found and service is None:
+            raise RancherApiError("Unable to fetch service %s/%s." % (self.__stack_name, self.__service_name))
+        # the lifecycle's target carries the links, which are set along with the upgrade
+        lifecycle = rancher.lifecycle(target, service) if service_found else None
+        if not stack_found and not create_stack:
+            raise NotFoundError("Unable to find a stack called '%s'. Does it exist in the '%s' environment?" %
+                                (self.__stack_name, rancher.get_project_name()))
+        if lifecycle is None:
+            # We didn't find the specified service, so if the 'create' flag is set, let's try to create a new one
+            if not create_service:
+                raise NotFoundError("Unable to find a service called '%s', does it exist in Rancher?" %
+                                    self.__service_name)
+            if image is None:
+                raise ConfigurationError("In order to create service %s, an image must be specified." %
+                                         self.__service_name)
+        elif image is None and not new_sidekick_images and not (target.labels or target.variables or links):
+            raise ConfigurationError("Nothing to upgrade %s/%s to: specify an image, sidekick images, labels, "
+                                     "variables or service links." % (self.__stack_name, self.__service_name))
+        elif new_sidekick_images:
+            sidekicks = {config.get('name') for config in lifecycle.launch_config(True) or []}
+            unknown = sorted(set(new_sidekick_images) - sidekicks)
+            if unknown:
+                raise ConfigurationError("%s/%s has no sidekick called %s." %
+                                         (self.__stack_name, self.__service_name, ', '.join(unknown)))
+        return target, stack_found, lifecycle
+
+    def restore(self, snapshot, strategy, batch_size, batch_interval, start_before_stopping):
+        try:
+            self.__start_phase('discovery')
+            self.__service_id = snapshot.service_id
+            self.__snapshot = snapshot
+            lifecycle = self.__connection.lifecycle(ServiceTarget(snapshot.stack_name, snapshot.service_name,
+                                                                  snapshot.stack_id, snapshot.service_id))
+            lifecycle.observe()
+            if lifecycle.launch_config() is None:
+                raise NotFoundError("Unable to find service %s in Rancher." % snapshot.reference())
+            self.__roll_back(lifecycle, snapshot, strategy, batch_size, batch_interval, start_before_stopping)
+            self.__log.info("%s is back on its snapshot." % snapshot.reference())
+            return self.__result(DeployOutcome.FINISHED)
+        finally:
+            self.__start_phase(None)
+
+    def __roll_back(self, lifecycle, snapshot, strategy, batch_size=None, batch_interval=0,
+                    start_before_stopping=False):
+        """Brings the service back to the snapshot, see rollback(). Raises UpgradeFailed if that didn't work."""
+        in_progress = lifecycle.state in (ServiceState.UPGRADING, ServiceState.UPGRADED) or \
+            lifecycle.pending is ServiceState.UPGRADED
+        if strategy is not RollbackStrategy.REAPPLY:
+            if not in_progress:
+                if strategy is RollbackStrategy.ACTION:
+                    raise UpgradeFailed("Rancher can only roll back an upgrade that is in progress, and %s is %s." %
+                                        (lifecycle.target.reference(), lifecycle.state.value if lifecycle.state
+                                         else 'in an unknown state'), self.__result(None))
+            else:
+                self.__start_phase('rollback')
+                self.__log.info("Processing image rollback...")
+                if lifecycle.rollback():
+                    self.__log.info("Rollback request submitted. Waiting for container to come back online.")
+                    if lifecycle.wait_until(ServiceState.ACTIVE):
+                        return
+                if strategy is RollbackStrategy.ACTION:
+                    raise UpgradeFailed("A timeout occurred while waiting for Rancher to rollback the upgrade to its "
+                                        "latest running state. Please check Rancher and resolve the problem.",
+                                        self.__result(None))
+                self.__log.warn("Rancher's rollback did not complete. Re-applying the snapshot instead...")
+
+        self.__start_phase('reapply')
+        if snapshot is None:
+            raise UpgradeFailed("There is no snapshot to re-apply.", self.__result(None))
+        if lifecycle.state is ServiceState.UPGRADED and not lifecycle.finish():
+            raise UpgradeFailed("Finishing the upgrade before re-applying the snapshot failed.", self.__result(None))
+        self.__log.info("Re-applying the snapshot of %s..." % snapshot.reference())
+        if not lifecycle.upgrade(snapshot.upgrade_payload(batch_size, batch_interval, start_before_stopping)) or \
+                not lifecycle.finish():
+            raise UpgradeFailed("Re-applying the snapshot of %s failed. Please check Rancher and resolve the problem."
+                                % snapshot.reference(), self.__result(None))
+
+    def compose(self, docker_compose, rancher_compose, environment, create_stack, wait, finish, rollback):
+        rancher = self.__connection
+        try:
+            self.__start_phase('discovery')
+            target = rancher.target(self.__stack_name)
+            if not rancher.stack_exists(target=target):
+                if not create_stack:
+                    raise NotFoundError("Unable to find a stack called '%s'. Does it exist in the '%s' environment?" %
+                                        (self.__stack_name, rancher.get_project_name()))
+                self.__start_phase('create')
+                if not rancher.create_stack(target=target, docker_compose=docker_compose,
+                                            rancher_compose=rancher_compose, environment=environment):
+                    raise RancherApiError("Creating stack '%s' failed." % self.__stack_name)
+                if not wait:
+                    self.__log.info("Stack created. Not waiting for its services to start.")
+                    return self.__result(DeployOutcome.TRIGGERED)
+                self.__start_phase('wait')
+                if not rancher.wait_for_stack_state('active', target=target):
+                    raise UpgradeFailed("The services of stack '%s' did not start." % self.__stack_name,
+                                        self.__result(None))
+                self.__log.info("Stack was successfully created.")
+                return self.__result(DeployOutcome.CREATED)
+
+            self.__log.info("Upgrading stack %s in environment %s..." % (self.__stack_name, rancher.get_project_name()))
+            self.__start_phase('upgrade')
+            if (rancher.get_stack(target=target) or {}).get('state') == 'upgraded':
+                self.__log.warn("The current stack state is 'upgraded'. Finishing the previous upgrade before "
+                                "starting a new one...")
+                if not self.__finish_stack(target):
+                    raise UpgradeFailed("Failed to finish the previous stack upgrade.", self.__result(None))
+            if rancher.upgrade_stack(docker_compose, rancher_compose, environment, target=target) is None:
+                raise UpgradeFailed("The stack upgrade could not be started.", self.__result(None))
+            if not wait:
+                self.__log.info("Stack upgrade triggered. Not waiting for finish.")
+                return self.__result(DeployOutcome.TRIGGERED)
+
+            self.__start_phase('wait')
+            if not rancher.wait_for_stack_state('upgraded', target=target):
+                if not rollback:
+                    raise UpgradeFailed("The stack upgrade failed. Please investigate the cause and resolve any issues "
+                                        "before trying again.", self.__result(None))
+                self.__start_phase('rollback')
+                self.__log.info("Rolling back stack...")
+                if rancher.stack_action('rollback', target=target) is None or \
+                        not rancher.wait_for_stack_state('active', target=target):
+                    raise UpgradeFailed("Rolling back stack '%s' failed." % self.__stack_name, self.__result(None))
+                raise UpgradeFailed("Stack successfully rolled back. Please investigate why the upgrade failed and "
+                                    "resolve any issued before trying again.", self.__result(None), rolled_back=True)
+
+            if not finish:
+                self.__log.info("Stack upgraded. Upgrade still needs to be manually finished.")
+                return self.__result(DeployOutcome.UPGRADED)
+            self.__start_phase('finish')
+            if not self.__finish_stack(target):
+                raise UpgradeFailed("Finishing the upgrade of stack '%s' failed." % self.__stack_name,
+                                    self.__result(None))
+            self.__log.info("Stack upgrade finished.")
+            return self.__result(DeployOutcome.FINISHED)
+        finally:
+            self.__start_phase(None)
+
+    def __finish_stack(self, target):
+        return self.__connection.stack_action('finishupgrade', target=target) is not None and \
+            self.__connection.wait_for_stack_state('active', target=target)
+
+    def __start_phase(self, phase):
+        now = self.__connection.get_clock().monotonic()
+        requests = self.__connection.requests_sent()
+        if self.__phase is not None:
+            self.__timings[self.__phase] = self.__timings.get(self.__phase, 0.0) + now - self.__phase_started
+            self.__requests[self.__phase] = self.__requests.get(self.__phase, 0) + requests - self.__phase_requests
+        if phase != self.__phase and phase is not None:
+            self.__log = self.__log.bind(phase=phase)
+        self.__phase = phase
+        self.__phase_started = now
+        self.__phase_requests = requests
+
+    def __result(self, outcome, handle=None):
+        self.__start_phase(self.__phase)
+        # copies: the phase that is still running keeps adding to the deploy's own counters
+        return DeployResult(self.__stack_name, self.__service_name, self.__service_id, outcome, dict(self.__timings),
+                            handle, dict(self.__requests), self.__snapshot)
+
+
+def build_upgrade(lifecycle, target, image=None, batch_size=1, batch_interval=2, start_before_stopping=False,
+                  sidekicks=False, new_sidekick_images=None):
+    """Builds the payload of an in-service upgrade from the service's current launch configs."""
+    upgrade = {'inServiceStrategy': {
+        'batchSize': batch_size,
+        'intervalMillis': batch_interval * 1000,  # rancher expects milliseconds
+        'startFirst': start_before_stopping,
+        'launchConfig': {
+        },
+        'secondaryLaunchConfigs': []
+    }}
+
+    # copy over the current launchConfig
+    launch_config = lifecycle.launch_config()
+    upgrade['inServiceStrategy']['launchConfig'] = launch_config
+
+    if target.labels:
+        launch_config.setdefault('labels', {}).update(target.labels)
+
+    if target.variables:
+        launch_config.setdefault('environment', {}).update(target.variables)
+
+    # new_sidekick_images needs secondaryLaunchConfigs loaded
+    if sidekicks or new_sidekick_images:
+        # copy over existing sidekicks config
+        upgrade['inServiceStrategy']['secondaryLaunchConfigs'] = lifecycle.launch_config(True) or []
+
+    if image:
+        # place new image into config
+        launch_config['imageUuid'] = 'docker:%s' % image
+
+    for secondary_launch_config in upgrade['inServiceStrategy']['secondaryLaunchConfigs']:
+        if secondary_launch_config.get('name') in (new_sidekick_images or {}):
+            secondary_launch_config['imageUuid'] = 'docker:%s' % new_sidekick_images[secondary_launch_config['name']]
+
+    return upgrade
@@ -1,11 +1,26 @@
 #!/usr/bin/env python
 
+import json
 import logging
 import click
 import sys
-
-from .helpers import RancherConnection
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import api
+from . import fleet
+from . import history
+from . import reconcile as reconciling
+from . import release as releases
+from .helpers import Deadline
+from .helpers import DeployHandle
 from .helpers import Logger
+from .helpers import RancherToolError
+from .helpers import RollbackStrategy
+from .helpers import SamplingProfiler
+from .helpers import ServiceSnapshot
+from .helpers import ServiceState
+from .helpers import ServiceTarget
 
 try:
     from http.client import HTTPConnection  # py3
@@ -13,26 +28,161 @@ except ImportError:
     from httplib import HTTPConnection  # py2
 
 
-@click.command()
-@click.option('--rancher-url', envvar='RANCHER_URL', required=True,
-              help='The URL for your Rancher server.')
-@click.option('--rancher-key', envvar='RANCHER_ACCESS_KEY', required=True,
-              help="The environment or account API Access Key.")
-@click.option('--rancher-secret', envvar='RANCHER_SECRET_KEY', required=True,
-              help="The secret for the API Access Key.")
+class DefaultCommandGroup(click.Group):
+    """
+    A command group that falls back to a default command, so that 'ranchertool [OPTIONS]' keeps running an upgrade
+    while other operations are available as sub-commands.
+    """
+
+    def __init__(self, *args, default_command=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.default_command = default_command
+
+    def parse_args(self, ctx, args):
+        # the group's own options (e.g. --profile) come before the command
+        index = 0
+        while index < len(args):
+            option = next((param for param in self.params if args[index].split('=', 1)[0] in param.opts), None)
+            if option is None:
+                break
+            index += 1 if option.is_flag or '=' in args[index] else 2
+        if index >= len(args) or (args[index] not in self.commands and args[index] not in ctx.help_option_names):
+            args.insert(index, self.default_command)
+        return super().parse_args(ctx, args)
+
+
+# ======================================================================================================================
+# Options shared between commands
+# ======================================================================================================================
+rancher_url_option = click.option('--rancher-url', envvar='RANCHER_URL', required=True,
+                                  help='The URL for your Rancher server.')
+rancher_key_option = click.option('--rancher-key', envvar='RANCHER_ACCESS_KEY', required=True,
+                                  help="The environment or account API Access Key.")
+rancher_secret_option = click.option('--rancher-secret', envvar='RANCHER_SECRET_KEY', required=True,
+                                     help="The secret for the API Access Key.")
+api_version_option = click.option('--api-version', 'rancher_api_version', default='v2-beta', required=False,
+                                  type=click.Choice(['v1', 'v2-beta'], case_sensitive=True),
+                                  help="The API version to use. Rancher versions < 2 have API versions v1 and v2-beta. "
+                                       "The default is v2-beta.")
+environment_option = click.option('--environment', 'rancher_project_name', default=None,
+                                  help="The name of the Rancher environment to operate in. In the Rancher API, this "
+                                       "is called 'project'.This is only required if you are using an account API "
+                                       "key instead of an environment API key.")
+timeout_option = click.option('--timeout', default=5 * 60,
+                              help="Sets how many seconds to wait for Rancher to finish processing before assuming "
+                                   "something went wrong. Defaults to 300 seconds (5 mins). This setting is ignored "
+                                   "if --no-wait is used.")
+connect_timeout_option = click.option('--connect-timeout', default=10,
+                                      help="Sets how many seconds to wait for a connection to the Rancher server to be "
+                                           "established. Defaults to 10 seconds.")
+request_timeout_option = click.option('--request-timeout', default=30,
+                                      help="Sets how many seconds to wait for Rancher to respond to a single request. "
+                                           "Defaults to 30 seconds.")
+deadline_option = click.option('--deadline', default=None, type=int,
+                               help="Sets the maximum number of seconds the whole run (lookups, upgrade, waits and "
+                                    "finish) may take. Every request and wait is cut short once the deadline is "
+                                    "reached. By default there is no deadline.")
+rollback_option = click.option('--rollback/--no-rollback', 'rollback_on_error', default=False,
+                               help="Sets whether or not to roll back changes if an error occurs. Defaults to "
+                                    "--no-rollback. Only valid in conjunction with --wait.")
+rollback_strategy_option = click.option('--rollback-strategy', default=RollbackStrategy.AUTO.value,
+                                        type=click.Choice([strategy.value for strategy in RollbackStrategy]),
+                                        help="How --rollback brings the service back: 'action' uses Rancher's "
+                                             "rollback action, 'reapply' upgrades the service back to the launch "
+                                             "configs it had before, replacing all containers at once. 'auto' (the "
+                                             "default) re-applies them when the rollback action fails.")
+snapshot_option = click.option('--snapshot', 'snapshot_file', default=None,
+                               type=click.Path(dir_okay=False, writable=True),
+                               help="Saves the service's launch configs to this file before the upgrade starts, so "
+                                    "that 'ranchertool rollback --snapshot <file>' can bring the service back to "
+                                    "them, even after the upgrade was finished.")
+finish_option = click.option('--finish/--no-finish', 'finish_on_success', default=True,
+                             help="Sets whether or not to finish an upgrade when it completes. Defaults to --finish.")
+handle_file_option = click.option('--handle-file', default=None, type=click.Path(dir_okay=False),
+                                  help="A file of deploy handles, one per line. With --no-wait, the handle of the "
+                                       "triggered upgrade is appended to it; 'ranchertool wait' reads handles from it.")
+log_level_option = click.option('--log-level', envvar='LOG_LEVEL',
+                                type=click.Choice(['TRACE', 'DEBUG', 'INFO', 'WARN', 'ERROR', 'FATAL', 'SILENT'],
+                                                  case_sensitive=False),
+                                help="Determines how much information is written to the console. ranchertool will "
+                                     "first check to see if this argument is provided. If not, it will check for a "
+                                     "'LOG_LEVEL' environment variable. If the 'LOG_LEVEL' environment variable isn't "
+                                     "set, it will default to INFO.")
+debug_http_option = click.option('--debug-http/--no-debug-http', default=False,
+                                 help="Sets whether or not to enable debug mode for HTTP requests. Defaults to "
+                                      "--no-debug-http.")
+ssl_verify_option = click.option('--ssl-verify/--no-ssl-verify', default=True,
+                                 help="Sets whether or not to perform certificate checks. Defaults to --ssl-verify. "
+                                      "Use this to allow connecting to a HTTPS Rancher server using an self-signed "
+                                      "certificate")
+http2_option = click.option('--http2/--no-http2', default=False,
+                            help="Sets whether or not to speak HTTP/2 with Rancher when it (or the proxy in front of "
+                                 "it) supports it over https, so that concurrent requests share one connection. Needs "
+                                 "'pip install gitlab-ci-rancher-deploy[http2]'. Defaults to --no-http2.")
+inventory_option = click.option('--inventory/--no-inventory', default=False,
+                                help="Sets whether or not to look stacks and services up in an index of the whole "
+                                     "environment, built from one listing of all stacks and one of all services, "
+                                     "instead of one stack at a time. Pays off with --service-links to many stacks. "
+                                     "Defaults to --no-inventory.")
+
+record_option = click.option('--record', default=None, type=click.Path(dir_okay=False, writable=True),
+                             help="Records every request to Rancher and its response (with timings, without "
+                                  "credentials) to a cassette file that can be replayed with --replay.")
+replay_option = click.option('--replay', default=None, type=click.Path(exists=True, dir_okay=False),
+                             help="Answers every request from a cassette file recorded with --record instead of "
+                                  "talking to Rancher. Useful to reproduce or profile a run offline.")
+replay_speed_option = click.option('--replay-speed', default=None, type=float,
+                                   help="With --replay, how fast Rancher's recorded response times are replayed: 1 "
+                                        "for the recorded speed, 10 for ten times faster. By default responses are "
+                                        "replayed immediately.")
+history_option = click.option('--history', 'history_file', envvar='RANCHERTOOL_HISTORY', default=None,
+                              type=click.Path(dir_okay=False),
+                              help="A SQLite file to append the timings of this run (per phase, with request counts) "
+                                   "to. Can also be set with a 'RANCHERTOOL_HISTORY' environment variable. See "
+                                   "'ranchertool history'.")
+
+
+@click.group(cls=DefaultCommandGroup, default_command='upgrade')
+@click.option('--profile', 'profile_file', default=None, type=click.Path(dir_okay=False, writable=True),
+              help="Profiles the run: writes the sampled stacks of all threads to this file in the collapsed format of "
+                   "flamegraph.pl/speedscope and prints a summary of the client hotspots at exit.")
+@click.option('--profile-top', default=15,
+              help="The number of hotspots shown in the --profile summary. Defaults to 15.")
+@click.option('--log-format', envvar='LOG_FORMAT', default='text', type=click.Choice(['text', 'json']),
+              help="Sets the format of log messages: colored text, or one JSON object per line on stderr with "
+                   "machine-readable fields (phase, service, state, request latency, ...). Can also be set with a "
+                   "'LOG_FORMAT' environment variable. Defaults to text.")
+@click.pass_context
+def main(ctx, profile_file, profile_top, log_format):
+    """
+    Performs an operation on a Rancher service specified on the command line. Without a command, runs 'upgrade'.
+    """
+    Logger.configure(log_format)
+    ctx.call_on_close(Logger.flush)
+    if profile_file:
+        profiler = SamplingProfiler().start()
+
+        def report():
+            profiler.stop()
+            profiler.write_collapsed(profile_file)
+            click.echo(profiler.summary(profile_top), err=True)
+            click.echo("Collapsed stacks written to %s." % profile_file, err=True)
+
+        ctx.call_on_close(report)
+
+
+@main.command()
+@rancher_url_option
+@rancher_key_option
+@rancher_secret_option
 @click.option('--stack', 'rancher_stack_name', envvar='CI_PROJECT_NAMESPACE', default=None, required=True,
               help="The name of the target stack in Rancher. Defaults to the name of the GitLab project group as "
                    "defined in the CI_PROJECT_NAMESPACE environment variable.")
 @click.option('--service', 'rancher_service_name', envvar='CI_PROJECT_NAME', default=None, required=True,
               help="The name of the service in Rancher to upgrade/create. Defaults to the name of the GitLab project "
                    "as defined in the CI_PROJECT_NAME environment variable.")
-@click.option('--api-version', 'rancher_api_version', default='v2-beta', required=False,
-              type=click.Choice(['v1', 'v2-beta'], case_sensitive=True),
-              help="The API version to use. Rancher versions < 2 have API versions v1 and v2-beta. The default is "
-                   "v2-beta.")
-@click.option('--environment', 'rancher_project_name', default=None,
-              help="The name of the Rancher environment to operate in. In the Rancher API, this is called 'project'." +
-                   "This is only required if you are using an account API key instead of an environment API key.")
+@api_version_option
+@environment_option
 @click.option('--start-before-stopping/--no-start-before-stopping', default=False,
               help="Controls whether or not new containers should be started before the old ones are stopped. Defaults "
                    "to --no-start-before-stopping.")
@@ -40,19 +190,21 @@ except ImportError:
               help="Sets the number of containers to upgrade simultaneously. Defaults to 1.")
 @click.option('--batch-interval', default=2,
               help="Sets the number of seconds to wait between batches. Defaults to 2 seconds.")
-@click.option('--timeout', default=5 * 60,
-              help="Sets how many seconds to wait for Rancher to finish processing before assuming something went "
-                   "wrong. Defaults to 300 seconds (5 mins). This setting is ignored if --no-wait is used.")
+@timeout_option
+@connect_timeout_option
+@request_timeout_option
+@deadline_option
 @click.option('--wait/--no-wait', 'wait_for_finish', default=True,
               help="Sets whether or not to wait for Rancher to finish processing the request. Defaults to --wait. If "
-                   "--no-wait is used, --timeout is ignored.")
-@click.option('--rollback/--no-rollback', 'rollback_on_error', default=False,
-              help="Sets whether or not to roll back changes if an error occurs. Defaults to --no-rollback. Only valid "
-                   "in conjunction with --wait.")
+                   "--no-wait is used, --timeout is ignored and a deploy handle is printed that 'ranchertool wait' "
+                   "accepts to finish the upgrade later.")
+@handle_file_option
+@rollback_option
+@rollback_strategy_option
+@snapshot_option
 @click.option('--image', 'new_service_image', default=None,
               help="If specified, replaces the current service's image (and :tag) with the one specified.")
-@click.option('--finish/--no-finish', 'finish_on_success', default=True,
-              help="Sets whether or not to finish an upgrade when it completes. Defaults to --finish.")
+@finish_option
 @click.option('--sidekicks/--no-sidekicks', default=False,
               help="Sets whether or not to upgrade service sidekicks at the same time. Defaults to --no-sidekicks.")
 @click.option('--new-sidekick-image', default=None, multiple=True,
@@ -60,6 +212,10 @@ except ImportError:
                    "defined more than once to upgrade multiple sidekicks. "
                    "Example: '--new-sidekick-image <sidekick-name> <new-image>'",
               type=(str, str))
+@click.option('--pre-pull/--no-pre-pull', default=False,
+              help="Sets whether or not to pull the new --image and --new-sidekick-image images on all hosts before "
+                   "the upgrade is started, so the upgrade itself only has to restart containers. Defaults to "
+                   "--no-pre-pull.")
 @click.option('--create-stack/--no-create-stack', default=False,
               help="Sets whether or not to create the targeted Rancher stack if it doesn't exist. Defaults "
                    "to --no-create-stack.")
@@ -85,21 +241,21 @@ except ImportError:
 @click.option('--service-link', default=None, multiple=True,
               help="Another way to add service links to a service. See --label for syntax.",
               type=(str, str))
-@click.option('--log-level', envvar='LOG_LEVEL',
-              type=click.Choice(['TRACE', 'DEBUG', 'INFO', 'WARN', 'ERROR', 'FATAL', 'SILENT'], case_sensitive=False),
-              help="Determines how much information is written to the console. ranchertool will first check to see if "
-                   "this argument is provided. If not, it will check for a 'LOG_LEVEL' environment variable. If the "
-                   "'LOG_LEVEL' environment variable isn't set, it will default to INFO.")
-@click.option('--debug-http/--no-debug-http', default=False,
-              help="Sets whether or not to enable debug mode for HTTP requests. Defaults to --no-debug-http.")
-@click.option('--ssl-verify/--no-ssl-verify', default=True,
-              help="Sets whether or not to perform certificate checks. Defaults to --ssl-verify. Use this to allow "
-                   "connecting to a HTTPS Rancher server using an self-signed certificate")
-def main(rancher_url, rancher_key, rancher_secret, rancher_api_version, rancher_project_name, rancher_stack_name,
-         rancher_service_name, new_service_image, batch_size, batch_interval,
-         start_before_stopping, timeout, wait_for_finish, rollback_on_error, finish_on_success,
-         sidekicks, new_sidekick_image, create_stack, create_service, labels, label, variables, variable,
-         service_links, service_link, log_level, debug_http, ssl_verify):
+@log_level_option
+@debug_http_option
+@ssl_verify_option
+@http2_option
+@inventory_option
+@record_option
+@replay_option
+@replay_speed_option
+@history_option
+def upgrade(rancher_url, rancher_key, rancher_secret, rancher_api_version, rancher_project_name, rancher_stack_name,
+            rancher_service_name, new_service_image, batch_size, batch_interval, start_before_stopping, timeout,
+            connect_timeout, request_timeout, deadline, wait_for_finish, handle_file, rollback_on_error,
+            rollback_strategy, snapshot_file, finish_on_success, sidekicks, new_sidekick_image, pre_pull, create_stack,
+            create_service, labels, label, variables, variable, service_links, service_link, log_level, debug_http,
+            ssl_verify, http2, inventory, record, replay, replay_speed, history_file):
     """
     Performs an in service upgrade of the service specified on the command line
     """
@@ -107,155 +263,636 @@ def main(rancher_url, rancher_key, rancher_secret, rancher_api_version, rancher_
     log = Logger(log_level, 'Main')
     log.trace('Log level set to ' + log.level.name)
 
+    try:
+        rancher = _connect(log, rancher_url, rancher_key, rancher_secret, rancher_api_version, ssl_verify, timeout,
+                           connect_timeout, request_timeout, Deadline(deadline), debug_http,
+                           project_name=rancher_project_name, record=record, replay=replay, replay_speed=replay_speed,
+                           http2=http2, inventory=inventory)
+        result = api.deploy(
+            rancher, rancher_stack_name, rancher_service_name, image=new_service_image, batch_size=batch_size,
+            batch_interval=batch_interval, start_before_stopping=start_before_stopping, wait=wait_for_finish,
+            finish=finish_on_success, rollback=rollback_on_error, sidekicks=sidekicks,
+            new_sidekick_images=new_sidekick_image, create_stack=create_stack, create_service=create_service,
+            labels=_merge(rancher.parse_labels, labels, label),
+            variables=_merge(rancher.parse_variables, variables, variable),
+            service_links=_split_pairs(service_links) + list(service_link), pre_pull=pre_pull, log_level=log.level,
+            snapshot_file=snapshot_file, rollback_strategy=rollback_strategy)
+    except RancherToolError as e:
+        _record_history(log, history_file, [e.result], failed=True)
+        log.fatal(format(e))
+    _record_history(log, history_file, [result])
+
+    if result.handle is not None:
+        handle = result.handle.encode()
+        log.info("Resume with 'ranchertool wait %s'." % handle)
+        click.echo(handle)
+        if handle_file:
+            with open(handle_file, 'a') as f:
+                f.write(handle + '\n')
+
+    log.info("Processing complete. Have a nice day!")
+    sys.exit(0)
+
+
+@main.command()
+@click.argument('handles', nargs=-1)
+@rancher_url_option
+@rancher_key_option
+@rancher_secret_option
+@api_version_option
+@timeout_option
+@connect_timeout_option
+@request_timeout_option
+@deadline_option
+@handle_file_option
+@rollback_option
+@finish_option
+@log_level_option
+@debug_http_option
+@ssl_verify_option
+@http2_option
+def wait(handles, rancher_url, rancher_key, rancher_secret, rancher_api_version, timeout, connect_timeout,
+         request_timeout, deadline, handle_file, rollback_on_error, finish_on_success, log_level, debug_http,
+         ssl_verify, http2):
+    """
+    Resumes upgrades started with --no-wait: waits for each service in HANDLES (and --handle-file) to finish upgrading
+    and finishes the upgrade. All handles are watched concurrently.
+    """
+    deadline = Deadline(deadline)
+    log = Logger(log_level, 'Wait')
+
+    handles = list(handles)
+    if handle_file:
+        with open(handle_file) as f:
+            handles.extend(line for line in f.read().splitlines() if line.strip())
+    if not handles:
+        log.fatal("No deploy handles given. Pass them as arguments or with --handle-file.")
+    try:
+        handles = [DeployHandle.decode(handle) for handle in handles]
+    except ValueError as e:
+        log.fatal(format(e))
+
+    connections = {}
+    for handle in handles:
+        if handle.project_id not in connections:
+            connections[handle.project_id] = _connect(log, rancher_url, rancher_key, rancher_secret,
+                                                      rancher_api_version, ssl_verify, timeout, connect_timeout,
+                                                      request_timeout, deadline, debug_http,
+                                                      project_id=handle.project_id, http2=http2)
+
+    def resume(handle):
+        rancher = connections[handle.project_id]
+        lifecycle = rancher.lifecycle(ServiceTarget(handle.stack_name, handle.service_name, handle.stack_id,
+                                                    handle.service_id))
+        try:
+            if not lifecycle.wait_until(handle.expected_state):
+                log.error("%s did not reach state '%s'." % (handle.reference(), handle.expected_state))
+                if rollback_on_error and lifecycle.rollback() and lifecycle.wait_until(ServiceState.ACTIVE):
+                    log.warn("%s was rolled back." % handle.reference())
+                return False
+            if finish_on_success and handle.expected_state == ServiceState.UPGRADED.value and not lifecycle.finish():
+                log.error("Finishing the upgrade of %s failed." % handle.reference())
+                return False
+        except RancherToolError as e:
+            log.error("%s: %s" % (handle.reference(), format(e)))
+            return False
+        log.info("%s is done (%.0f seconds after the upgrade was started)." % (handle.reference(), handle.elapsed()))
+        return True
+
+    with ThreadPoolExecutor(max_workers=min(len(handles), 16)) as pool:
+        results = list(pool.map(resume, handles))
+    for rancher in connections.values():
+        rancher.close()
+
+    failed = results.count(False)
+    if failed:
+        log.fatal("%d of %d upgrades did not complete." % (failed, len(handles)))
+    log.info("Processing complete. Have a nice day!")
+    sys.exit(0)
+
+
+@main.command('rollback')
+@click.option('--snapshot', 'snapshot_file', required=True, type=click.Path(exists=True, dir_okay=False),
+              help="The snapshot file written by 'ranchertool upgrade --snapshot'.")
+@rancher_url_option
+@rancher_key_option
+@rancher_secret_option
+@api_version_option
+@click.option('--strategy', default=RollbackStrategy.AUTO.value,
+              type=click.Choice([strategy.value for strategy in RollbackStrategy]),
+              help="'action' uses Rancher's rollback action, which only works while the upgrade is in progress. "
+                   "'reapply' upgrades the service back to the snapshot's launch configs. 'auto' (the default) uses "
+                   "the rollback action while the upgrade is in progress and re-applies the snapshot otherwise.")
+@click.option('--batch-size', default=None, type=int,
+              help="Sets the number of containers to replace simultaneously when re-applying the snapshot. Defaults "
+                   "to all of them, for the fastest recovery.")
+@click.option('--batch-interval', default=0,
+              help="Sets the number of seconds to wait between batches. Defaults to 0 seconds.")
+@click.option('--start-before-stopping/--no-start-before-stopping', default=False,
+              help="Controls whether or not new containers should be started before the old ones are stopped. Defaults "
+                   "to --no-start-before-stopping.")
+@timeout_option
+@connect_timeout_option
+@request_timeout_option
+@deadline_option
+@log_level_option
+@debug_http_option
+@ssl_verify_option
+@http2_option
+def rollback_command(snapshot_file, rancher_url, rancher_key, rancher_secret, rancher_api_version, strategy,
+                     batch_size, batch_interval, start_before_stopping, timeout, connect_timeout, request_timeout,
+                     deadline, log_level, debug_http, ssl_verify, http2):
+    """
+    Brings a service back to the launch configs saved with 'ranchertool upgrade --snapshot', e.g. after a bad deploy
+    was noticed only after its upgrade was finished.
+    """
+    log = Logger(log_level, 'Rollback')
+    try:
+        snapshot = ServiceSnapshot.load(snapshot_file)
+    except (OSError, ValueError) as e:
+        log.fatal(format(e))
+    rancher = _connect(log, rancher_url, rancher_key, rancher_secret, rancher_api_version, ssl_verify, timeout,
+                       connect_timeout, request_timeout, Deadline(deadline), debug_http,
+                       project_id=snapshot.project_id, http2=http2)
+    try:
+        result = api.rollback(rancher, snapshot, strategy, batch_size, batch_interval, start_before_stopping,
+                              log_level=log.level)
+    except RancherToolError as e:
+        log.fatal(format(e))
+    finally:
+        rancher.close()
+    log.info("Rolled back %s in %.1f seconds." % (snapshot.reference(), result.duration))
+    sys.exit(0)
+
+
+@main.command()
+@click.argument('services', nargs=-1)
+@rancher_url_option
+@rancher_key_option
+@rancher_secret_option
+@click.option('--stack', 'rancher_stack_name', envvar='CI_PROJECT_NAMESPACE', default=None,
+              help="The stack to look bare service names up in. Without SERVICES, every service of the stack is shown. "
+                   "Defaults to the CI_PROJECT_NAMESPACE environment variable.")
+@api_version_option
+@environment_option
+@click.option('--format', 'output_format', default='table', type=click.Choice(['table', 'json']),
+              help="Sets the output format. Defaults to table.")
+@click.option('--require-state', default=None,
+              help="If specified, exits with an error unless every requested service exists and is in this state "
+                   "(e.g. 'active').")
+@connect_timeout_option
+@request_timeout_option
+@log_level_option
+@debug_http_option
+@ssl_verify_option
+@http2_option
+@record_option
+@replay_option
+@replay_speed_option
+def status(services, rancher_url, rancher_key, rancher_secret, rancher_stack_name, rancher_api_version,
+           rancher_project_name, output_format, require_state, connect_timeout, request_timeout, log_level,
+           debug_http, ssl_verify, http2, record, replay, replay_speed):
+    """
+    Shows state, health, scale and image of SERVICES (names or '<stack>/<service>' references). All services are
+    fetched with a single filtered request.
+    """
+    log = Logger(log_level or 'WARN', 'Status')
+    if not services and not rancher_stack_name:
+        log.fatal("Specify the services to show, or a --stack to show all of its services.")
+    rancher = _connect(log, rancher_url, rancher_key, rancher_secret, rancher_api_version, ssl_verify, None,
+                       connect_timeout, request_timeout, Deadline(), debug_http, project_name=rancher_project_name,
+                       record=record, replay=replay, replay_speed=replay_speed, http2=http2)
+    try:
+        found = rancher.find_services(list(services), rancher_stack_name)
+    except RancherToolError as e:
+        log.fatal(format(e))
+    rows = []
+    for stack_name, service in found:
+        rows.append({
+            'stack': stack_name,
+            'service': service.name,
+            'id': service.id,
+            'state': service.state,
+            'health': service.health_state,
+            'scale': service.scale,
+            'image': service.launch_config.image or '',
+        })
+    rancher.close()
+
+    _echo_rows(rows, ['stack', 'service', 'state', 'health', 'scale', 'image'], output_format)
+
+    missing = [reference for reference in services
+               if not any(reference in (row['service'], '%s/%s' % (row['stack'], row['service'])) for row in rows)]
+    if missing:
+        log.error("Services not found: %s" % ', '.join(missing))
+    if require_state and (missing or any(row['state'] != require_state for row in rows)):
+        sys.exit(1)
+
+
+@main.command()
+@rancher_url_option
+@rancher_key_option
+@rancher_secret_option
+@click.option('--stack', 'rancher_stack_name', envvar='CI_PROJECT_NAMESPACE', default=None, required=True,
+              help="The name of the stack to create or upgrade. Defaults to the CI_PROJECT_NAMESPACE environment "
+                   "variable.")
+@click.option('--docker-compose', 'docker_compose_file', default='docker-compose.yml',
+              type=click.Path(exists=True, dir_okay=False),
+              help="The docker-compose file describing the services of the stack. Defaults to docker-compose.yml.")
+@click.option('--rancher-compose', 'rancher_compose_file', default=None, type=click.Path(exists=True, dir_okay=False),
+              help="The rancher-compose file with the Rancher specific settings (scale, health checks, ...) of the "
+                   "services, if any.")
+@api_version_option
+@environment_option
+@click.option('--create-stack/--no-create-stack', default=True,
+              help="Sets whether or not to create the stack if it doesn't exist. Defaults to --create-stack.")
+@click.option('--variables', default=None,
+              help="If specified, variables to interpolate into the compose files, as a pipe-delimited (|) list of "
+                   "<key>=<value> pairs. Example: '--variables TAG=42|DOMAIN=preview.example.com'.")
+@click.option('--variable', default=None, multiple=True,
+              help="Another way to add variables to interpolate into the compose files. Example: '--variable TAG "
+                   "42'. Can be defined multiple times.", type=(str, str))
+@timeout_option
+@connect_timeout_option
+@request_timeout_option
+@deadline_option
+@click.option('--wait/--no-wait', 'wait_for_finish', default=True,
+              help="Sets whether or not to wait for the stack to be created or upgraded. Defaults to --wait.")
+@rollback_option
+@finish_option
+@log_level_option
+@debug_http_option
+@ssl_verify_option
+@http2_option
+@record_option
+@replay_option
+@replay_speed_option
+@history_option
+def compose(rancher_url, rancher_key, rancher_secret, rancher_stack_name, docker_compose_file, rancher_compose_file,
+            rancher_api_version, rancher_project_name, create_stack, variables, variable, timeout, connect_timeout,
+            request_timeout, deadline, wait_for_finish, rollback_on_error, finish_on_success, log_level, debug_http,
+            ssl_verify, http2, record, replay, replay_speed, history_file):
+    """
+    Creates or upgrades all services of a stack from a docker-compose (and rancher-compose) file with a single stack
+    create or upgrade request.
+    """
+    log = Logger(log_level, 'Compose')
+
+    with open(docker_compose_file) as f:
+        docker_compose = f.read()
+    rancher_compose = None
+    if rancher_compose_file:
+        with open(rancher_compose_file) as f:
+            rancher_compose = f.read()
+
+    try:
+        rancher = _connect(log, rancher_url, rancher_key, rancher_secret, rancher_api_version, ssl_verify, timeout,
+                           connect_timeout, request_timeout, Deadline(deadline), debug_http,
+                           project_name=rancher_project_name, record=record, replay=replay, replay_speed=replay_speed,
+                           http2=http2)
+        result = api.apply_compose(rancher, rancher_stack_name, docker_compose, rancher_compose,
+                                   environment=_merge(rancher.parse_variables, variables, variable),
+                                   create_stack=create_stack, wait=wait_for_finish, finish=finish_on_success,
+                                   rollback=rollback_on_error, log_level=log.level)
+    except RancherToolError as e:
+        _record_history(log, history_file, [e.result], failed=True)
+        log.fatal(format(e))
+    _record_history(log, history_file, [result])
+
+    log.info("Processing complete. Have a nice day!")
+    sys.exit(0)
+
+
+@main.command('fleet')
+@click.option('--config', 'fleet_file', required=True, type=click.Path(exists=True, dir_okay=False),
+              help="A JSON file listing the Rancher servers and environments to deploy to. See the README for its "
+                   "format.")
+@click.option('--stack', 'rancher_stack_name', envvar='CI_PROJECT_NAMESPACE', default=None, required=True,
+              help="The name of the stack in Rancher (defaults to the name of the group in GitLab).")
+@click.option('--service', 'rancher_service_name', envvar='CI_PROJECT_NAME', default=None, required=True,
+              help="The name of the service in Rancher to upgrade (defaults to the name of the service in GitLab).")
+@click.option('--image', 'new_service_image', default=None,
+              help="If specified, replaces the existing image (and :tag) with this one during the upgrade.")
+@click.option('--ordering', default=None, type=click.Choice([ordering.value for ordering in fleet.FleetOrdering]),
+              help="How to order the deploys: all targets at once, wave by wave (stopping after a wave with a "
+                   "failure) or one target after the other, stopping on the first failure. Overrides the 'ordering' "
+                   "of the config file. Defaults to all-at-once.")
+@click.option('--max-parallel', default=None, type=int,
+              help="The maximum number of targets to deploy to at the same time. By default there is no limit.")
+@click.option('--start-before-stopping/--no-start-before-stopping', default=False,
+              help="Sets whether or not to start the new containers before stopping the old ones. Defaults to "
+                   "--no-start-before-stopping.")
+@click.option('--batch-size', default=1,
+              help="Sets the number of containers to upgrade at once. Defaults to 1.")
+@click.option('--batch-interval', default=2,
+              help="Sets the number of seconds to wait between each batch of upgrades. Defaults to 2.")
+@timeout_option
+@connect_timeout_option
+@request_timeout_option
+@deadline_option
+@rollback_option
+@finish_option
+@click.option('--new-sidekick-image', default=None, multiple=True, type=(str, str),
+              help="If specified, replaces the existing sidekick image (and :tag) with the specified one. See the "
+                   "'upgrade' command for syntax.")
+@click.option('--pre-pull/--no-pre-pull', default=False,
+              help="Sets whether or not to pull the new images on all hosts before the upgrade is started. Defaults "
+                   "to --no-pre-pull.")
+@click.option('--label', default=None, multiple=True, type=(str, str),
+              help="A label to add to the service. See the 'upgrade' command for syntax.")
+@click.option('--variable', default=None, multiple=True, type=(str, str),
+              help="An environment variable to add to the service. See the 'upgrade' command for syntax.")
+@click.option('--format', 'output_format', default='table', type=click.Choice(['table', 'json']),
+              help="Sets the format of the report. Defaults to table.")
+@log_level_option
+@debug_http_option
+@http2_option
+def fleet_command(fleet_file, rancher_stack_name, rancher_service_name, new_service_image, ordering, max_parallel,
+                  start_before_stopping, batch_size, batch_interval, timeout, connect_timeout, request_timeout,
+                  deadline, rollback_on_error, finish_on_success, new_sidekick_image, pre_pull, label, variable,
+                  output_format, log_level, debug_http, http2):
+    """
+    Upgrades a service on several Rancher servers and environments concurrently, as listed in a --config file, and
+    prints a merged report. Exits with an error if any target failed.
+    """
+    log = Logger(log_level, 'Fleet')
     if debug_http:
         debug_requests_on()
+    try:
+        targets, configured_ordering = fleet.load_fleet(fleet_file)
+    except RancherToolError as e:
+        log.fatal(format(e))
+
+    report = fleet.deploy_fleet(
+        targets, rancher_stack_name, rancher_service_name,
+        ordering=ordering or configured_ordering or fleet.FleetOrdering.ALL_AT_ONCE, max_parallel=max_parallel,
+        timeout=timeout, connect_timeout=connect_timeout, request_timeout=request_timeout, deadline=deadline,
+        log_level=log.level, http2=http2, image=new_service_image, batch_size=batch_size,
+        batch_interval=batch_interval, start_before_stopping=start_before_stopping, finish=finish_on_success,
+        rollback=rollback_on_error, new_sidekick_images=new_sidekick_image, pre_pull=pre_pull, labels=dict(label),
+        variables=dict(variable))
+
+    rows = report.as_dicts()
+    _echo_rows(rows, ['target', 'environment', 'wave', 'status', 'duration', 'error'], output_format)
+
+    if not report.succeeded:
+        log.fatal("The deploy failed on %d of %d targets." % (len(report.failed()), len(rows)))
+    log.info("Processing complete. Have a nice day!")
+    sys.exit(0)
 
-    # split url to protocol and host
-    if "://" not in rancher_url:
-        log.fatal("The Rancher URL doesn't look right. Please verify that it's a valid URL (i.e. "
-                  "https://my.rancher.com).")
-
-    proto, host = rancher_url.split("://")
-
-    rancher = RancherConnection(
-        "%s://%s" % (proto, host),
-        rancher_key,
-        rancher_secret,
-        rancher_project_name,
-        rancher_stack_name,
-        rancher_service_name,
-        ssl_verify,
-        rancher_api_version,
-        log.level,
-        timeout
-    )
-
-    # Check for labels and environment variables to set
-    rancher.set_labels(labels)
-    rancher.set_labels(label)
-    rancher.set_variables(variables)
-    rancher.set_variables(variable)
-    rancher.set_service_links(service_links)
-    rancher.set_service_links(service_link)
-
-    # 1 -> Find the environment id in Rancher (aka "project")
-
-    # While we're here, let's define service links if provided
-
-    # 2 -> Find the stack (aka "environment") in the environment (aka "project")
-    if not rancher.stack_exists():
-        if create_stack:
-            if rancher.create_stack():
-                log.info('Successfully created stack')
-            else:
-                log.fatal("Creating stack failed.")
-        else:
-            log.fatal("Unable to find a stack called '%s'. Does it exist in the '%s' environment?" % (
-                rancher.get_stack_name(), rancher.get_project_name()))
-
-    # 3 -> Find the service in the stack
-    if not rancher.service_exists():
-        # We didn't find the specified service, so if the 'create' flag is set, let's try to create a new service
-        if create_service:
-            if not rancher.create_service(new_service_image):
-                log.fatal("Failed to create a service called '%s'." % rancher.get_service_name())
-            log.info("Service was successfully created. Thank you and have a nice day!")
-            exit(0)
-        else:
-            log.fatal("Unable to find a service called '%s', does it exist in Rancher?" % rancher.get_service_name())
-
-    # 4 -> Is the service eligible for upgrade?
-    if rancher.get_service_state() == 'upgraded':
-        log.warn(
-            "The current service state is 'upgraded'. Finishing the previous upgrade before starting a new "
-            "one...")
-        rancher.finish_upgrade()
-
-    log.info("Upgrading %s/%s in environment %s..."
-             % (rancher.get_stack_name(), rancher.get_service_name(), rancher.get_project_name()))
-
-    upgrade = {'inServiceStrategy': {
-        'batchSize': batch_size,
-        'intervalMillis': batch_interval * 1000,  # rancher expects milliseconds
-        'startFirst': start_before_stopping,
-        'launchConfig': {
-        },
-        'secondaryLaunchConfigs': []
-    }}
-
-    # copy over the current launchConfig
-    upgrade['inServiceStrategy']['launchConfig'] = rancher.get_launch_config()
-
-    if rancher.get_labels():
-        upgrade['inServiceStrategy']['launchConfig']['labels'].update(rancher.get_labels())
-
-    if rancher.get_variables():
-        upgrade['inServiceStrategy']['launchConfig']['environment'].update(rancher.get_variables())
-
-    # new_sidekick_image parameter needs secondaryLaunchConfigs loaded
-    if sidekicks or new_sidekick_image:
-        # copy over existing sidekicks config
-        upgrade['inServiceStrategy']['secondaryLaunchConfigs'] = rancher.get_launch_config(True)
-
-    if new_service_image:
-        # place new image into config
-        upgrade['inServiceStrategy']['launchConfig']['imageUuid'] = 'docker:%s' % new_service_image
-
-    if new_sidekick_image:
-        new_sidekick_image = dict(new_sidekick_image)
-
-        for idx, secondaryLaunchConfigs in enumerate(upgrade['secondaryLaunchConfigs']):
-            if secondaryLaunchConfigs['name'] in new_sidekick_image:
-                upgrade['inServiceStrategy']['secondaryLaunchConfigs'][idx]['imageUuid'] = 'docker:%s' % \
-                                                                                           new_sidekick_image[
-                                                                                               secondaryLaunchConfigs[
-                                                                                                   'name']]
-
-    # 5 -> Start the upgrade
-    rancher.do_upgrade(upgrade)
-
-    # 6 -> Wait for the upgrade to finish
-
-    if not wait_for_finish:
-        log.info("Upgrade triggered. Not waiting for finish.")
-    else:
-        log.info("Upgrade started, waiting for upgrade to complete...")
-        if not rancher.wait_for_state('upgraded'):
-            if rollback_on_error:
-                log.info("Processing image rollback...")
-                if not rancher.rollback():
-                    log.fatal("Rollback failed.")
-                log.info("Rollback request submitted. Waiting for container to come back online.")
-                attempts = 0
-                if not rancher.wait_for_state('active'):
-                    log.fatal("A timeout occurred while waiting for Rancher to rollback the upgrade to its "
-                              "latest running state. Please check Rancher and resolve the problem.")
-
-                log.fatal("Service successfully rolled back. Please investigate why the upgrade failed and resolve "
-                          "any issued before trying again.")
-            else:
-                log.fatal("The upgrade failed. Please investigate the cause and resolve "
-                          "any issues before trying again.")
-
-        if not finish_on_success:
-            log.info("Service upgraded. Upgrade still needs to be manually finished.")
-        else:
-            log.info("Finishing upgrade...")
-            rancher.finish_upgrade()
-
-            if not rancher.wait_for_state('active'):
-                log.fatal("Something happened while waiting for the upgraded to be finished. Please investigate the "
-                          "cause and resolve any issues before trying again.")
-
-            log.info("Upgrade finished.")
-
-            # if rancher.get_service_links():
-            #     set_service_links(defined_service_links)
 
+@main.command()
+@click.option('--plan', 'plan_file', required=True, type=click.Path(exists=True, dir_okay=False),
+              help="A JSON file listing the services to deploy and their dependencies. See the README for its format.")
+@rancher_url_option
+@rancher_key_option
+@rancher_secret_option
+@api_version_option
+@environment_option
+@click.option('--max-parallel', default=4,
+              help="The maximum number of services to deploy at the same time. Defaults to 4.")
+@timeout_option
+@connect_timeout_option
+@request_timeout_option
+@deadline_option
+@rollback_option
+@click.option('--format', 'output_format', default='table', type=click.Choice(['table', 'json']),
+              help="Sets the format of the report. Defaults to table.")
+@log_level_option
+@debug_http_option
+@ssl_verify_option
+@http2_option
+@record_option
+@replay_option
+@replay_speed_option
+@history_option
+def release(plan_file, rancher_url, rancher_key, rancher_secret, rancher_api_version, rancher_project_name,
+            max_parallel, timeout, connect_timeout, request_timeout, deadline, rollback_on_error, output_format,
+            log_level, debug_http, ssl_verify, http2, record, replay, replay_speed, history_file):
+    """
+    Deploys the services of a --plan in dependency order: every service is deployed as soon as the services it links
+    to or depends on are active, and independent services are deployed concurrently.
+    """
+    log = Logger(log_level, 'Release')
+    try:
+        steps = releases.load_plan(plan_file)
+    except RancherToolError as e:
+        log.fatal(format(e))
+
+    rancher = _connect(log, rancher_url, rancher_key, rancher_secret, rancher_api_version, ssl_verify, timeout,
+                       connect_timeout, request_timeout, Deadline(deadline), debug_http,
+                       project_name=rancher_project_name, record=record, replay=replay, replay_speed=replay_speed,
+                       http2=http2, inventory=True)
+    report = releases.run_release(rancher, steps, max_parallel, log.level, rollback=rollback_on_error)
+    rancher.close()
+    _record_history(log, history_file, [outcome.result for outcome in report.outcomes if outcome.succeeded])
+    _record_history(log, history_file, [outcome.result for outcome in report.failed()], failed=True)
+
+    rows = report.as_dicts()
+    _echo_rows(rows, ['service', 'status', 'duration', 'error'], output_format)
+
+    if not report.succeeded:
+        log.fatal("%d of %d services failed to deploy." % (len(report.failed()), len(rows)))
+    log.info("Processing complete. Have a nice day!")
+    sys.exit(0)
+
+
+@main.command('reconcile')
+@click.argument('definitions_dir', type=click.Path(exists=True, file_okay=False))
+@rancher_url_option
+@rancher_key_option
+@rancher_secret_option
+@api_version_option
+@environment_option
+@click.option('--state', 'state_file', envvar='RANCHERTOOL_RECONCILE_STATE', default=None,
+              type=click.Path(dir_okay=False),
+              help="A JSON file to keep the hashes of the applied definitions in, so that a restarted loop doesn't "
+                   "upgrade services again whose definitions didn't change. Can also be set with a "
+                   "'RANCHERTOOL_RECONCILE_STATE' environment variable.")
+@click.option('--interval', default=0.0, type=float,
+              help="Reconciles every INTERVAL seconds until interrupted. By default, reconciles once and exits.")
+@click.option('--cycles', default=None, type=int,
+              help="With --interval, stops after this many cycles.")
+@click.option('--max-parallel', default=4,
+              help="The maximum number of services to upgrade at the same time. Defaults to 4.")
+@click.option('--dry-run/--no-dry-run', default=False,
+              help="Only reports which services drifted, without upgrading them. Defaults to --no-dry-run.")
+@timeout_option
+@connect_timeout_option
+@request_timeout_option
+@rollback_option
+@click.option('--format', 'output_format', default='table', type=click.Choice(['table', 'json']),
+              help="Sets the format of the report. Defaults to table.")
+@log_level_option
+@debug_http_option
+@ssl_verify_option
+@http2_option
+@history_option
+def reconcile_command(definitions_dir, rancher_url, rancher_key, rancher_secret, rancher_api_version,
+                      rancher_project_name, state_file, interval, cycles, max_parallel, dry_run, timeout,
+                      connect_timeout, request_timeout, rollback_on_error, output_format, log_level, debug_http,
+                      ssl_verify, http2, history_file):
+    """
+    Upgrades the services defined in the JSON files of DEFINITIONS_DIR that drifted from their definition: either the
+    definition changed since it was last applied, or the service's image, labels, variables or sidekick images no
+    longer match it. Services that are in sync cost no upgrade, and a cycle in which nothing changed costs a single
+    request.
+    """
+    log = Logger(log_level, 'Reconcile')
+    try:
+        state = reconciling.ReconcileState(state_file)
+    except RancherToolError as e:
+        log.fatal(format(e))
+    rancher = _connect(log, rancher_url, rancher_key, rancher_secret, rancher_api_version, ssl_verify, timeout,
+                       connect_timeout, request_timeout, Deadline(), debug_http, project_name=rancher_project_name,
+                       http2=http2, inventory=True)
+
+    def report_cycle(report):
+        if isinstance(report, RancherToolError):
+            return
+        _record_history(log, history_file, [outcome.result for outcome in report.changed()])
+        _record_history(log, history_file, [outcome.result for outcome in report.outcomes
+                                            if outcome.action == 'failed'], failed=True)
+        rows = report.as_dicts()
+        if interval:
+            rows = [row for row in rows if row['action'] != 'in-sync']
+            log.info("%d of %d services in sync." % (len(report.outcomes) - len(rows), len(report.outcomes)))
+        if rows or not interval:
+            _echo_rows(rows, ['service', 'action', 'reason', 'duration', 'error'], output_format)
+
+    try:
+        report = reconciling.run_reconcile(rancher, reconciling.DefinitionDirectory(definitions_dir), state, interval,
+                                           cycles if interval else 1, report_cycle, log.level,
+                                           max_parallel=max_parallel, dry_run=dry_run, rollback=rollback_on_error)
+    except KeyboardInterrupt:
+        log.info("Interrupted.")
+        sys.exit(0)
+    finally:
+        rancher.close()
+
+    if isinstance(report, RancherToolError):
+        log.fatal(format(report))
+    if not report.succeeded:
+        log.fatal("%d of %d services could not be reconciled." % (len(report.failed()), len(report.outcomes)))
     log.info("Processing complete. Have a nice day!")
     sys.exit(0)
 
 
+@main.command('history')
+@click.argument('services', nargs=-1)
+@click.option('--history', 'history_file', envvar='RANCHERTOOL_HISTORY', required=True,
+              type=click.Path(exists=True, dir_okay=False),
+              help="The SQLite file the timings were recorded to with --history. Can also be set with a "
+                   "'RANCHERTOOL_HISTORY' environment variable.")
+@click.option('--days', default=None, type=float,
+              help="Only reports the runs of the last DAYS days. Older runs still count towards the baselines. "
+                   "By default all runs are reported.")
+@click.option('--baseline-runs', default=20,
+              help="The number of previous runs of a service whose median is its baseline. Defaults to 20.")
+@click.option('--threshold', default=1.5,
+              help="How many times longer than its baseline a run has to take to be flagged as a regression. "
+                   "Defaults to 1.5.")
+@click.option('--fail-on-regression/--no-fail-on-regression', default=False,
+              help="Exits with an error if the latest run of a service is a regression. Defaults to "
+                   "--no-fail-on-regression.")
+@click.option('--format', 'output_format', default='table', type=click.Choice(['table', 'json']),
+              help="Sets the format of the report. Defaults to table.")
+@log_level_option
+def history_command(services, history_file, days, baseline_runs, threshold, fail_on_regression, output_format,
+                    log_level):
+    """
+    Reports the duration percentiles of the runs recorded with --history, per service ('<stack>/<service>', or
+    '<stack>' for compose runs) and outcome, and flags the runs that took significantly longer than their baseline.
+    """
+    log = Logger(log_level or 'WARN', 'History')
+    since = time.time() - days * 24 * 3600 if days else None
+    try:
+        with history.DeployHistory(history_file) as deploys:
+            stats, regressions, latest = [], [], {}
+            for service in services or [None]:
+                stats += deploys.stats(service, since)
+                regressions += deploys.regressions(service, since, baseline_runs, threshold=threshold)
+                for run in deploys.runs(service, since):
+                    latest[run.service] = run.id
+    except RancherToolError as e:
+        log.fatal(format(e))
+
+    rows = [row.as_dict() for row in stats]
+    regression_rows = [regression.as_dict() for regression in regressions]
+    if output_format == 'json':
+        click.echo(json.dumps({'services': rows, 'regressions': regression_rows}, indent=2))
+    else:
+        _echo_rows(rows, ['service', 'outcome', 'runs', 'p50', 'p90', 'p99', 'max', 'requests'], output_format)
+        if regression_rows:
+            click.echo()
+            _echo_rows(regression_rows, ['service', 'started', 'duration', 'baseline', 'ratio', 'phase',
+                                         'phase_duration', 'phase_baseline'], output_format)
+
+    regressed = sorted(regression.run.service for regression in regressions
+                       if latest.get(regression.run.service) == regression.run.id)
+    if regressed:
+        log.warn("The latest run of %s was slower than usual." % ', '.join(regressed))
+        if fail_on_regression:
+            sys.exit(1)
+
+
+def _record_history(log, history_file, results, failed=False):
+    """Appends the results of a run to the --history file, if any. Problems with the file are only logged."""
+    results = [result for result in results if result is not None]
+    if not history_file or not results:
+        return
+    try:
+        with history.DeployHistory(history_file) as deploys:
+            for result in results:
+                deploys.record(result, failed)
+    except RancherToolError as e:
+        log.warn(format(e))
+
+
+def _connect(log, rancher_url, rancher_key, rancher_secret, rancher_api_version, ssl_verify, timeout, connect_timeout,
+             request_timeout, deadline, debug_http, project_name=None, project_id=None, record=None, replay=None,
+             replay_speed=None, http2=False, inventory=False):
+    """Opens a RancherConnection for a command, turning configuration errors into a fatal log message."""
+    if debug_http:
+        debug_requests_on()
+
+    try:
+        return api.connect(rancher_url, rancher_key, rancher_secret, project_name, rancher_api_version, ssl_verify,
+                           timeout, connect_timeout, request_timeout, deadline, log.level, project_id, record=record,
+                           replay=replay, replay_speed=replay_speed, http2=http2, inventory=inventory)
+    except RancherToolError as e:
+        log.fatal(format(e))
+
+
+def _echo_rows(rows, columns, output_format):
+    """Prints report rows as JSON or as a table of the given columns."""
+    if output_format == 'json':
+        click.echo(json.dumps(rows, indent=2))
+        return
+    cells = [['' if row[column] is None else str(row[column]) for column in columns] for row in rows]
+    widths = [max([len(column)] + [len(line[index]) for line in cells]) for index, column in enumerate(columns)]
+    click.echo('  '.join(column.upper().ljust(width) for column, width in zip(columns, widths)).rstrip())
+    for line in cells:
+        click.echo('  '.join(cell.ljust(width) for cell, width in zip(line, widths)).rstrip())
+
+
+def _merge(parse, text, pairs):
+    """Merges a delimited string and a tuple of (name, value) pairs given for the same option into a dict."""
+    merged = {}
+    if text:
+        merged.update(parse(text))
+    if pairs:
+        merged.update(parse(list(pairs)))
+    return merged
+
+
+def _split_pairs(text, delimiter=','):
+    """Splits '<name>=<value>,<name>=<value>' into a list of (name, value) pairs."""
+    if not text:
+        return []
+    return [tuple(pair.split('=', 1)) for pair in text.split(delimiter)]
+
+
 # # ======================================================================================================================
 # # A function to set service links on a service
 # # ======================================================================================================================
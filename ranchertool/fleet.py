@@ -0,0 +1,196 @@
+"""
+Deploying the same service to several Rancher servers and environments at once.
+
+A fleet is a list of FleetTargets, usually loaded from a JSON file with load_fleet():
+
+    {
+      "ordering": "waves",
+      "targets": [
+        {"name": "staging", "url": "https://rancher.staging.example.com", "access_key_env": "STAGING_KEY",
+         "secret_key_env": "STAGING_SECRET", "wave": 0},
+        {"name": "eu", "url": "https://rancher.eu.example.com", "environment": "Production", "access_key": "...",
+         "secret_key": "...", "wave": 1}
+      ]
+    }
+
+Every target gets its own RancherConnection (and so its own connection pool and credentials); deploy_fleet() runs
+api.deploy() against them concurrently and merges the results into a FleetReport.
+"""
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from typing import List, NamedTuple, Optional
+
+from . import api
+from .helpers import ConfigurationError, LogLevel, Logger, RancherToolError
+
+
+class FleetOrdering(Enum):
+    ALL_AT_ONCE = 'all-at-once'
+    WAVES = 'waves'
+    STOP_ON_FIRST_FAILURE = 'stop-on-first-failure'
+
+
+class FleetTarget(NamedTuple):
+    """One Rancher server/environment to deploy to."""
+    name: str
+    url: str
+    access_key: str
+    secret_key: str
+    environment: Optional[str] = None
+    api_version: str = 'v2-beta'
+    ssl_verify: bool = True
+    wave: int = 0
+
+
+class FleetOutcome(NamedTuple):
+    """What happened on one target: the DeployResult if the deploy succeeded, the error if it didn't."""
+    target: FleetTarget
+    result: Optional[api.DeployResult] = None
+    error: Optional[str] = None
+    skipped: bool = False
+
+    @property
+    def succeeded(self):
+        return self.result is not None and self.error is None
+
+    def status(self):
+        if self.skipped:
+            return 'skipped'
+        if not self.succeeded:
+            return 'failed'
+        return self.result.outcome.value
+
+
+class FleetReport(NamedTuple):
+    """The merged outcome of a fleet deploy, in the order of the targets."""
+    outcomes: List[FleetOutcome]
+
+    @property
+    def succeeded(self):
+        return all(outcome.succeeded for outcome in self.outcomes)
+
+    def failed(self):
+        return [outcome for outcome in self.outcomes if not outcome.succeeded and not outcome.skipped]
+
+    def as_dicts(self):
+        rows = []
+        for outcome in self.outcomes:
+            result = outcome.result
+            rows.append({
+                'target': outcome.target.name,
+                'url': outcome.target.url,
+                'environment': outcome.target.environment,
+                'wave': outcome.target.wave,
+                'status': outcome.status(),
+                'service_id': result.service_id if result else None,
+                'duration': round(result.duration, 3) if result else None,
+                'timings': {phase: round(seconds, 3) for phase, seconds in result.timings.items()} if result else {},
+                'error': outcome.error,
+            })
+        return rows
+
+
+def load_fleet(path):
+    """
+    Reads a fleet definition file.
+
+    :return: A (list of FleetTargets, FleetOrdering or None) pair
+    :raises ConfigurationError: if the file is not a valid fleet definition
+    """
+    try:
+        with open(path) as f:
+            definition = json.load(f)
+    except (OSError, ValueError) as e:
+        raise ConfigurationError("Unable to read the fleet definition '%s': %s" % (path, format(e)))
+    if isinstance(definition, list):
+        definition = {'targets': definition}
+    if not isinstance(definition, dict) or not definition.get('targets'):
+        raise ConfigurationError("The fleet definition '%s' has no targets." % path)
+
+    targets = []
+    for index, entry in enumerate(definition['targets']):
+        name = entry.get('name') or 'target-%d' % (index + 1)
+        if not entry.get('url'):
+            raise ConfigurationError("Fleet target '%s' has no url." % name)
+        targets.append(FleetTarget(name, entry['url'], _credential(entry, 'access_key', name),
+                                   _credential(entry, 'secret_key', name), entry.get('environment'),
+                                   entry.get('api_version', 'v2-beta'), entry.get('ssl_verify', True),
+                                   int(entry.get('wave', 0))))
+    if len({target.name for target in targets}) != len(targets):
+        raise ConfigurationError("The fleet definition '%s' has duplicate target names." % path)
+
+    ordering = definition.get('ordering')
+    try:
+        return targets, FleetOrdering(ordering) if ordering else None
+    except ValueError:
+        raise ConfigurationError("Unknown fleet ordering '%s'. Use one of: %s." %
+                                 (ordering, ', '.join(option.value for option in FleetOrdering)))
+
+
+def deploy_fleet(targets, stack_name, service_name, ordering=FleetOrdering.ALL_AT_ONCE, max_parallel=None,
+                 timeout=300, connect_timeout=10, request_timeout=30, deadline=None, log_level=LogLevel.INFO,
+                 http2=False, **deploy_options):
+    """
+    Deploys a service to every target.
+
+    :param ordering: ALL_AT_ONCE deploys to all targets concurrently. WAVES deploys the targets of each wave
+                     concurrently, wave by wave, and skips later waves once a wave had a failure.
+                     STOP_ON_FIRST_FAILURE deploys to one target after the other and skips the rest after a failure.
+    :param max_parallel: The maximum number of concurrent deploys. Defaults to no limit.
+    :param deadline: Seconds each target's deploy may take.
+    :param http2: Speaks HTTP/2 with the targets that support it.
+    :param deploy_options: Passed on to api.deploy() (image, batch_size, labels, ...).
+    :return: A FleetReport
+    """
+    ordering = FleetOrdering(ordering)
+    log = Logger(log_level, 'Fleet')
+    targets = list(targets)
+
+    def deploy_to(target):
+        log.info("Deploying %s/%s to %s..." % (stack_name, service_name, target.name))
+        try:
+            connection = api.connect(target.url, target.access_key, target.secret_key, target.environment,
+                                     target.api_version, target.ssl_verify, timeout, connect_timeout,
+                                     request_timeout, log_level=log_level, http2=http2)
+        except RancherToolError as e:
+            log.error("%s: %s" % (target.name, format(e)))
+            return FleetOutcome(target, e.result, format(e))
+        try:
+            result = api.deploy(connection, stack_name, service_name, deadline=deadline, log_level=log_level,
+                                **deploy_options)
+        except RancherToolError as e:
+            log.error("%s: %s" % (target.name, format(e)))
+            return FleetOutcome(target, e.result, format(e))
+        finally:
+            connection.close()
+        log.info("%s: %s in %.1f seconds." % (target.name, result.outcome.value, result.duration))
+        return FleetOutcome(target, result)
+
+    if ordering is FleetOrdering.ALL_AT_ONCE:
+        batches = [targets]
+    elif ordering is FleetOrdering.WAVES:
+        batches = [[target for target in targets if target.wave == wave]
+                   for wave in sorted({target.wave for target in targets})]
+    else:
+        batches = [[target] for target in targets]
+
+    outcomes = {}
+    with ThreadPoolExecutor(max_workers=max_parallel or max([1] + [len(batch) for batch in batches])) as pool:
+        for batch in batches:
+            if any(not outcome.succeeded for outcome in outcomes.values()):
+                outcomes.update({target.name: FleetOutcome(target, skipped=True) for target in batch})
+                continue
+            outcomes.update({target.name: outcome for target, outcome in zip(batch, pool.map(deploy_to, batch))})
+    return FleetReport([outcomes[target.name] for target in targets])
+
+
+def _credential(entry, key, name):
+    """Reads a credential from the target entry itself or from the environment variable named by '<key>_env'."""
+    if entry.get(key):
+        return entry[key]
+    variable = entry.get(key + '_env')
+    if variable and os.environ.get(variable):
+        return os.environ[variable]
+    raise ConfigurationError("Fleet target '%s' has no %s. Set '%s' or '%s_env'." % (name, key, key, key))
@@ -0,0 +1,180 @@
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from http import HTTPStatus
+from urllib.parse import urlsplit
+
+import requests
+import requests.adapters
+from requests.structures import CaseInsensitiveDict
+
+CASSETTE_VERSION = 1
+
+# fields whose values are as often as not secrets (passwords, tokens); only their keys are recorded
+REDACTED_FIELDS = ('environment', 'secrets')
+REDACTED = '<redacted>'
+
+
+class Cassette:
+    """
+    A recording of the HTTP exchanges of a run: one JSON object per line, starting with a header line. Each exchange
+    holds the request's method, path (with query) and JSON body, the response's status, content type, ETag and body,
+    how long Rancher took to answer and when the request was sent. Credentials and hosts are never recorded, so a cassette
+    can be replayed against any --rancher-url. The values of 'environment' and 'secrets' fields (service environment
+    variables, stack variables) are replaced with '<redacted>' in request and response bodies alike; docker-compose
+    files are recorded as they were sent.
+    """
+
+    def __init__(self, exchanges=None):
+        self.exchanges = list(exchanges or [])
+
+    @classmethod
+    def load(cls, path):
+        """
+        :raises ValueError: if the file is not a cassette
+        """
+        with open(path) as f:
+            lines = [line for line in f.read().splitlines() if line.strip()]
+        if not lines or json.loads(lines[0]).get('cassette') != CASSETTE_VERSION:
+            raise ValueError("'%s' is not a ranchertool cassette." % path)
+        return cls(json.loads(line) for line in lines[1:])
+
+    @staticmethod
+    def key(method, url, body):
+        """
+        What a request is matched on when replaying: method, path with query and the canonical JSON body, redacted as
+        it is recorded.
+        """
+        parts = urlsplit(url)
+        path = parts.path.rstrip('/') + ('?' + parts.query if parts.query else '')
+        if isinstance(body, bytes):
+            body = body.decode('utf-8')
+        if isinstance(body, str):
+            try:
+                body = json.loads(body)
+            except ValueError:
+                pass
+        return method, path, json.dumps(redact(body), sort_keys=True)
+
+    def duration(self):
+        """Seconds between the first request and the last response of the recording."""
+        if not self.exchanges:
+            return 0.0
+        return max(exchange['at'] + exchange['elapsed'] for exchange in self.exchanges)
+
+
+def redact(value):
+    """Returns a copy of a decoded JSON document with the values of all REDACTED_FIELDS replaced, at any depth."""
+    if isinstance(value, dict):
+        return {key: _redacted(item) if key in REDACTED_FIELDS else redact(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [redact(item) for item in value]
+    return value
+
+
+def _redacted(value):
+    if isinstance(value, dict):
+        return {key: REDACTED for key in value}
+    if isinstance(value, list):
+        return [REDACTED for _ in value]
+    return None if value is None else REDACTED
+
+
+def _redact_content(content):
+    try:
+        return json.dumps(redact(json.loads(content)), separators=(',', ':')) if content else content
+    except ValueError:
+        return content
+
+
+class RecordingTransport(requests.adapters.BaseAdapter):
+    """
+    A transport adapter that sends requests through a regular pooled HTTPAdapter (or another transport adapter) and
+    appends every exchange to a cassette file as it happens.
+    """
+
+    def __init__(self, path, pool_size=10, adapter=None):
+        super().__init__()
+        self.__adapter = adapter or requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.__lock = threading.Lock()
+        self.__started = time.monotonic()
+        self.__file = open(path, 'w')
+        self.__file.write(json.dumps({'cassette': CASSETTE_VERSION, 'recorded': round(time.time(), 3)}) + '\n')
+        self.__file.flush()
+
+    def send(self, request, **kwargs):
+        sent = time.monotonic()
+        response = self.__adapter.send(request, **kwargs)
+        elapsed = time.monotonic() - sent
+        method, path, body = Cassette.key(request.method, request.url, request.body)
+        exchange = {
+            'method': method,
+            'path': path,
+            'body': json.loads(body),
+            'status': response.status_code,
+            'content_type': response.headers.get('Content-Type'),
+            'etag': response.headers.get('ETag'),
+            'content': _redact_content(response.text),
+            'elapsed': round(elapsed, 4),
+            'at': round(sent - self.__started, 4),
+        }
+        with self.__lock:
+            self.__file.write(json.dumps(exchange, separators=(',', ':')) + '\n')
+            self.__file.flush()
+        return response
+
+    def close(self):
+        self.__adapter.close()
+        with self.__lock:
+            if not self.__file.closed:
+                self.__file.close()
+
+
+class ReplayTransport(requests.adapters.BaseAdapter):
+    """
+    A transport adapter that answers requests from a cassette instead of a Rancher server. Identical requests are
+    answered with their recorded responses in recorded order (the last one is repeated if a request is sent more often
+    than it was recorded), so a replay of the same operation is deterministic.
+    """
+
+    def __init__(self, cassette, speed=None):
+        """
+        :param cassette: A Cassette, or the path of a cassette file.
+        :param speed: None or 0 answers immediately; 1 answers after the recorded response time, 10 ten times faster.
+        """
+        super().__init__()
+        if not isinstance(cassette, Cassette):
+            cassette = Cassette.load(cassette)
+        self.__speed = speed
+        self.__lock = threading.Lock()
+        self.__responses = defaultdict(deque)
+        for exchange in cassette.exchanges:
+            self.__responses[(exchange['method'], exchange['path'],
+                              json.dumps(exchange['body'], sort_keys=True))].append(exchange)
+
+    def send(self, request, **kwargs):
+        key = Cassette.key(request.method, request.url, request.body)
+        with self.__lock:
+            recorded = self.__responses.get(key)
+            if not recorded:
+                raise requests.exceptions.ConnectionError("No recorded response for %s %s." % key[:2],
+                                                          request=request)
+            exchange = recorded.popleft() if len(recorded) > 1 else recorded[0]
+        if self.__speed:
+            time.sleep(exchange['elapsed'] / self.__speed)
+
+        response = requests.Response()
+        response.status_code = exchange['status']
+        response.reason = HTTPStatus(exchange['status']).phrase
+        response.headers = CaseInsensitiveDict({'Content-Type': exchange.get('content_type') or 'application/json'})
+        if exchange.get('etag'):
+            response.headers['ETag'] = exchange['etag']
+        response._content = (exchange.get('content') or '').encode('utf-8')
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
@@ -0,0 +1,44 @@
+import threading
+import time
+
+
+class Clock:
+    """
+    The time source and sleep of everything that waits on Rancher: state polls, deadlines and phase timings. The
+    default clock is the system's; tests and simulations inject a VirtualClock instead.
+    """
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class VirtualClock(Clock):
+    """
+    A clock whose time only moves when something sleeps on it (or advance() is called), so that waits which would take
+    minutes finish instantly. Sleeps of concurrent threads add up rather than overlap, which keeps every run
+    deterministic.
+    """
+
+    def __init__(self, start=0.0):
+        self.__now = start
+        self.__lock = threading.Lock()
+        self.slept = 0.0
+
+    def monotonic(self):
+        return self.__now
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+        with self.__lock:
+            self.slept += max(0.0, seconds)
+
+    def advance(self, seconds):
+        """Moves the time forward without sleeping."""
+        with self.__lock:
+            self.__now += max(0.0, seconds)
+
+
+SYSTEM_CLOCK = Clock()
@@ -0,0 +1,57 @@
+from .Clock import SYSTEM_CLOCK
+from .Errors import DeadlineExceeded
+
+
+class Deadline:
+    """
+    A point in time by which a whole deploy has to be done.
+
+    One Deadline is created when the deploy starts and handed to everything that waits on Rancher (HTTP requests,
+    state polling, sleeps), so each step only gets the time that is left instead of its own full timeout.
+    """
+
+    def __init__(self, seconds=None, clock=None):
+        """
+        :param seconds: How long from now the deadline expires. None means the deadline never expires.
+        :param clock: The Clock to measure the time with. Defaults to the system's.
+        """
+        self.__seconds = seconds
+        self.__clock = clock or SYSTEM_CLOCK
+        self.__expires_at = None if seconds is None else self.__clock.monotonic() + seconds
+
+    @property
+    def seconds(self):
+        return self.__seconds
+
+    def remaining(self):
+        """Seconds left before the deadline, None if there is no deadline."""
+        if self.__expires_at is None:
+            return None
+        return max(0.0, self.__expires_at - self.__clock.monotonic())
+
+    def expired(self):
+        return self.__expires_at is not None and self.__clock.monotonic() >= self.__expires_at
+
+    def cap(self, seconds):
+        """Returns the given duration, shortened to the time left before the deadline."""
+        remaining = self.remaining()
+        if remaining is None:
+            return seconds
+        if seconds is None:
+            return remaining
+        return min(seconds, remaining)
+
+    def request_timeout(self, connect_timeout, read_timeout):
+        """
+        Returns a (connect, read) timeout pair for requests, capped to the time left before the deadline.
+
+        :raises DeadlineExceeded: if no time is left (requests rejects a timeout of 0)
+        """
+        # a single reading of the clock, so that an expiry check can't race the capped timeouts down to 0
+        remaining = self.remaining()
+        if remaining is None:
+            return connect_timeout, read_timeout
+        if remaining <= 0:
+            raise DeadlineExceeded("The deploy deadline of %s seconds was exceeded." % self.__seconds)
+        return tuple(remaining if timeout is None else min(timeout, remaining)
+                     for timeout in (connect_timeout, read_timeout))
@@ -0,0 +1,54 @@
+import base64
+import json
+import time
+from typing import NamedTuple, Optional
+
+HANDLE_PREFIX = 'rt1.'
+
+
+class DeployHandle(NamedTuple):
+    """
+    Everything needed to pick up an upgrade that was started with --no-wait: where the service lives, which state the
+    upgrade is heading to and when it was started. Handles are encoded as short, shell-safe strings so they can be
+    passed between CI jobs as plain text.
+    """
+    project_id: str
+    stack_id: str
+    service_id: str
+    stack_name: Optional[str] = None
+    service_name: Optional[str] = None
+    expected_state: str = 'upgraded'
+    started_at: float = 0.0
+
+    @classmethod
+    def start(cls, project_id, target, expected_state='upgraded'):
+        """Creates a handle for an operation on a resolved ServiceTarget that is starting now."""
+        return cls(project_id, target.stack_id, target.service_id, target.stack_name, target.service_name,
+                   expected_state, round(time.time(), 3))
+
+    def encode(self):
+        payload = json.dumps([self.project_id, self.stack_id, self.service_id, self.stack_name, self.service_name,
+                              self.expected_state, self.started_at], separators=(',', ':'))
+        return HANDLE_PREFIX + base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii').rstrip('=')
+
+    @classmethod
+    def decode(cls, text):
+        """
+        :raises ValueError: if the text is not a deploy handle
+        """
+        text = text.strip()
+        if not text.startswith(HANDLE_PREFIX):
+            raise ValueError("'%s' is not a ranchertool deploy handle." % text)
+        encoded = text[len(HANDLE_PREFIX):]
+        try:
+            payload = base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4))
+            return cls(*json.loads(payload.decode('utf-8')))
+        except (TypeError, ValueError) as e:
+            raise ValueError("'%s' is not a valid ranchertool deploy handle: %s" % (text, format(e)))
+
+    def reference(self):
+        return '%s/%s' % (self.stack_name or self.stack_id, self.service_name or self.service_id)
+
+    def elapsed(self):
+        """Seconds since the operation was started."""
+        return time.time() - self.started_at
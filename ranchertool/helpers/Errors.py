@@ -0,0 +1,34 @@
+class RancherToolError(Exception):
+    """Base class of all errors raised by ranchertool. The command line turns these into a fatal log message."""
+
+    def __init__(self, message, result=None):
+        """
+        :param message: What went wrong.
+        :param result: The DeployResult of the deploy that failed, if the error ended a deploy.
+        """
+        super().__init__(message)
+        self.result = result
+
+
+class ConfigurationError(RancherToolError):
+    """The options given can't work (bad URL, unknown API version, missing image, ...)."""
+
+
+class RancherApiError(RancherToolError):
+    """Rancher rejected a request or could not be reached."""
+
+
+class NotFoundError(RancherToolError):
+    """A project, stack or service does not exist."""
+
+
+class DeadlineExceeded(RancherToolError):
+    """The deploy-wide deadline passed before the deploy was done."""
+
+
+class UpgradeFailed(RancherToolError):
+    """An upgrade was started but didn't complete."""
+
+    def __init__(self, message, result=None, rolled_back=False):
+        super().__init__(message, result)
+        self.rolled_back = rolled_back
@@ -0,0 +1,97 @@
+import asyncio
+import ssl
+import threading
+from http import HTTPStatus
+
+import requests
+import requests.adapters
+from requests.structures import CaseInsensitiveDict
+from requests.utils import select_proxy
+
+from .Errors import ConfigurationError
+
+try:
+    import httpx
+except ImportError:  # optional: pip install gitlab-ci-rancher-deploy[http2]
+    httpx = None
+
+# headers that are specific to an HTTP/1.1 connection and not allowed in HTTP/2
+HOP_BY_HOP_HEADERS = ('connection', 'keep-alive', 'proxy-connection', 'transfer-encoding', 'upgrade')
+
+
+class Http2Transport(requests.adapters.BaseAdapter):
+    """
+    A transport adapter that sends requests through an httpx client speaking HTTP/2 when the Rancher server (or the
+    proxy in front of it) supports it. HTTP/2 is negotiated over TLS, so plain http:// URLs and servers without HTTP/2
+    support keep using HTTP/1.1. Over HTTP/2, all concurrent requests share a single multiplexed connection instead of
+    needing one connection each.
+
+    The requests are sent by an asyncio client running on a thread of its own: the synchronous httpx client is not safe
+    to use for concurrent requests over one HTTP/2 connection (streams can be opened out of order).
+
+    Requests that have to go through a proxy (HTTPS_PROXY, HTTP_PROXY and NO_PROXY, as requests reads them) or present
+    a client certificate are sent over HTTP/1.1 by a regular HTTPAdapter instead, so that --http2 never bypasses them.
+    """
+
+    def __init__(self, verify=True, pool_size=10):
+        """
+        :param verify: Whether to verify the server's certificate, or the path of the CA bundle to verify it with.
+        :param pool_size: The maximum number of connections, for servers that only speak HTTP/1.1.
+        :raises ConfigurationError: if httpx or its HTTP/2 support is not installed
+        """
+        super().__init__()
+        if httpx is None:
+            raise ConfigurationError("HTTP/2 needs the httpx package. Install it with "
+                                     "'pip install gitlab-ci-rancher-deploy[http2]'.")
+        if isinstance(verify, str):
+            verify = ssl.create_default_context(cafile=verify)
+        try:
+            self.__client = httpx.AsyncClient(http2=True, verify=verify, trust_env=False,
+                                              limits=httpx.Limits(max_connections=pool_size,
+                                                                  max_keepalive_connections=pool_size))
+        except ImportError:
+            raise ConfigurationError("HTTP/2 needs the h2 package. Install it with "
+                                     "'pip install gitlab-ci-rancher-deploy[http2]'.")
+        self.__fallback = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.__loop = asyncio.new_event_loop()
+        self.__thread = threading.Thread(target=self.__loop.run_forever, name='http2-transport', daemon=True)
+        self.__thread.start()
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        if cert or select_proxy(request.url, proxies):
+            return self.__fallback.send(request, stream=stream, timeout=timeout, verify=verify, cert=cert,
+                                        proxies=proxies)
+        connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        headers = [(name, value) for name, value in request.headers.items()
+                   if name.lower() not in HOP_BY_HOP_HEADERS]
+        try:
+            response = asyncio.run_coroutine_threadsafe(
+                self.__client.request(request.method, request.url, headers=headers, content=request.body,
+                                      timeout=httpx.Timeout(read_timeout, connect=connect_timeout)),
+                self.__loop).result()
+        except httpx.ConnectTimeout as e:
+            raise requests.exceptions.ConnectTimeout(e, request=request)
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.ReadTimeout(e, request=request)
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(e, request=request)
+
+        result = requests.Response()
+        result.status_code = response.status_code
+        result.reason = response.reason_phrase or HTTPStatus(response.status_code).phrase
+        result.headers = CaseInsensitiveDict(response.headers.items())
+        result._content = response.content
+        result.encoding = response.encoding
+        result.url = request.url
+        result.request = request
+        result.http_version = response.http_version
+        return result
+
+    def close(self):
+        self.__fallback.close()
+        if self.__loop.is_closed():
+            return
+        asyncio.run_coroutine_threadsafe(self.__client.aclose(), self.__loop).result()
+        self.__loop.call_soon_threadsafe(self.__loop.stop)
+        self.__thread.join()
+        self.__loop.close()
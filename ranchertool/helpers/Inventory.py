@@ -0,0 +1,131 @@
+import threading
+
+# the states of resources that are being (or have been) deleted; Rancher keeps listing them for a while
+REMOVED_STATES = ('removing', 'removed', 'purging', 'purged')
+
+
+class Inventory:
+    """
+    An index of all stacks and services of a project, so that stack and service lookups by name, '<stack>/<service>'
+    reference or id take no request at all.
+
+    The index is built from one listing of all stacks and one of all services of the project. It is refreshed when a
+    lookup misses (e.g. for a service that was just created), with conditional requests: while nothing changed in the
+    project, a refresh costs one '304 Not Modified' response per listing and nothing is indexed again. Resources that
+    are being removed are left out. Ids and names are what the index is for; the states it holds are only as fresh as
+    the last refresh.
+    """
+
+    def __init__(self, list_stacks, list_services):
+        """
+        :param list_stacks: Returns the pages of all Stack records of the project, as a list of lists. A page that
+                            didn't change since the previous call must be the same list object.
+        :param list_services: The same, for all Service records of the project.
+        """
+        self.__list_stacks = list_stacks
+        self.__list_services = list_services
+        self.__lock = threading.Lock()
+        self.__stack_pages = None
+        self.__service_pages = None
+        self.__stacks_by_id = {}
+        self.__stacks_by_name = {}
+        self.__services_by_id = {}
+        self.__services_by_key = {}
+        self.__services_by_name = {}
+        self.__services_by_stack = {}
+
+    def refresh(self, stacks=True, services=True):
+        """
+        Fetches the listings and re-indexes the ones that changed.
+
+        :return: True if anything changed
+        """
+        changed = False
+        if stacks:
+            pages = self.__list_stacks()
+            if pages is not None and not _same_pages(pages, self.__stack_pages):
+                records = [stack for page in pages for stack in page if stack.state not in REMOVED_STATES]
+                by_id = {stack.id: stack for stack in records}
+                by_name = {stack.name: stack for stack in records}
+                with self.__lock:
+                    self.__stack_pages = pages
+                    self.__stacks_by_id, self.__stacks_by_name = by_id, by_name
+                changed = True
+        if services:
+            pages = self.__list_services()
+            if pages is not None and not _same_pages(pages, self.__service_pages):
+                records = [service for page in pages for service in page if service.state not in REMOVED_STATES]
+                by_id = {service.id: service for service in records}
+                by_key = {(service.stack_id, service.name): service for service in records}
+                by_name, by_stack = {}, {}
+                for service in records:
+                    by_name.setdefault(service.name, []).append(service)
+                    by_stack.setdefault(service.stack_id, []).append(service)
+                with self.__lock:
+                    self.__service_pages = pages
+                    self.__services_by_id, self.__services_by_key = by_id, by_key
+                    self.__services_by_name, self.__services_by_stack = by_name, by_stack
+                changed = True
+        return changed
+
+    def __len__(self):
+        return len(self.__services_by_id)
+
+    def stack(self, name):
+        """Returns the Stack with the given name, or None."""
+        return self.__lookup(lambda: self.__stacks_by_name.get(name), stacks=True)
+
+    def stack_by_id(self, stack_id):
+        return self.__lookup(lambda: self.__stacks_by_id.get(stack_id), stacks=True)
+
+    def service(self, stack_name, service_name):
+        """Returns the Service with the given name in the named stack, or None."""
+        stack = self.stack(stack_name)
+        if stack is None:
+            return None
+        return self.service_in(stack.id, service_name)
+
+    def service_in(self, stack_id, service_name):
+        """Returns the Service with the given name in the stack with the given id, or None."""
+        return self.__lookup(lambda: self.__services_by_key.get((stack_id, service_name)), services=True)
+
+    def service_by_reference(self, reference):
+        """Returns the Service a '<stack>/<service>' reference refers to, or None."""
+        stack_name, service_name = reference.split('/', 1)
+        return self.service(stack_name, service_name)
+
+    def service_by_id(self, service_id):
+        return self.__lookup(lambda: self.__services_by_id.get(service_id), services=True)
+
+    def services_named(self, service_name):
+        """Returns the Services with the given name, in all stacks."""
+        return list(self.__lookup(lambda: self.__services_by_name.get(service_name), services=True) or [])
+
+    def stack_services(self, stack_id):
+        """Returns the Services of the stack with the given id, as of the last refresh."""
+        if self.__service_pages is None:
+            self.refresh(stacks=False)
+        return list(self.__services_by_stack.get(stack_id) or [])
+
+    def discard_service(self, service_id):
+        """Drops a removed service from the index, so that lookups no longer find it."""
+        with self.__lock:
+            service = self.__services_by_id.pop(service_id, None)
+            if service is None:
+                return
+            self.__services_by_key.pop((service.stack_id, service.name), None)
+            for index, key in ((self.__services_by_name, service.name), (self.__services_by_stack, service.stack_id)):
+                index[key] = [indexed for indexed in index.get(key, []) if indexed is not service]
+
+    def __lookup(self, find, stacks=False, services=False):
+        found = find()
+        if found is None and self.refresh(stacks=stacks, services=services):
+            found = find()
+        return found
+
+
+def _same_pages(pages, previous):
+    """Whether a listing returned the very page objects of the previous one, i.e. nothing changed."""
+    if previous is None or len(pages) != len(previous):
+        return False
+    return all(page is old for page, old in zip(pages, previous))
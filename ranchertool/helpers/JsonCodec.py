@@ -0,0 +1,61 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # optional: pip install gitlab-ci-rancher-deploy[fast]
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+class JsonCodec:
+    """
+    Encodes request payloads and decodes response bodies. The fastest available library is used: orjson, then ujson,
+    then the standard library's json module.
+    """
+
+    def __init__(self, name, loads, dumps):
+        """
+        :param loads: A function decoding bytes to Python objects.
+        :param dumps: A function encoding Python objects to bytes.
+        """
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+
+    def __repr__(self):
+        return 'JsonCodec(%s)' % self.name
+
+
+def _stdlib_codec():
+    return JsonCodec('json', json.loads, lambda obj: json.dumps(obj, separators=(',', ':')).encode('utf-8'))
+
+
+def available_codecs():
+    """Returns {name: JsonCodec} for every JSON library that is installed, fastest first."""
+    codecs = {}
+    if orjson is not None:
+        codecs['orjson'] = JsonCodec('orjson', orjson.loads, orjson.dumps)
+    if ujson is not None:
+        codecs['ujson'] = JsonCodec('ujson', ujson.loads, lambda obj: ujson.dumps(obj).encode('utf-8'))
+    codecs['json'] = _stdlib_codec()
+    return codecs
+
+
+def get_codec(codec=None):
+    """
+    :param codec: A JsonCodec, the name of an installed library ('orjson', 'ujson', 'json') or None for the fastest
+                  one available.
+    :raises ValueError: if the named library is not installed
+    """
+    if isinstance(codec, JsonCodec):
+        return codec
+    codecs = available_codecs()
+    if codec is None:
+        return next(iter(codecs.values()))
+    if codec not in codecs:
+        raise ValueError("The JSON library '%s' is not installed. Available: %s." % (codec, ', '.join(codecs)))
+    return codecs[codec]
@@ -1,3 +1,9 @@
+import atexit
+import copy
+import json
+import queue
+import threading
+import time
 import warnings
 
 import click
@@ -7,6 +13,9 @@ from datetime import datetime
 
 datetime_string_format = '%Y-%m-%d %H:%M:%S.%f'
 
+# the fields of every JSON record; a caller's field of the same name is written with a trailing underscore instead
+RESERVED_FIELDS = ('ts', 'level', 'logger', 'message')
+
 
 class LogLevel(IntEnum):
     """The LogLevel class is an Enum to define available and set current logging levels."""
@@ -19,8 +28,108 @@ class LogLevel(IntEnum):
     SILENT = 0
 
 
+class JsonLogSink:
+    """
+    Writes log records as JSON lines from a background thread. Logging a record only puts it on a queue; formatting
+    and writing happen on the writer thread, in batches, so logging never waits on the output stream.
+    """
+
+    def __init__(self, stream=None, max_batch=500):
+        """
+        :param stream: The stream to write to. Defaults to the current sys.stderr at the time of each write, so that
+            records never mix with a command's output on stdout.
+        """
+        self.__stream = stream
+        self.__max_batch = max_batch
+        self.__queue = queue.SimpleQueue()
+        self.__thread = threading.Thread(target=self.__run, name='ranchertool-log-writer', daemon=True)
+        self.__thread.start()
+
+    def emit(self, record):
+        self.__queue.put(record)
+
+    def flush(self, timeout=5):
+        """Waits until every record emitted so far has been written."""
+        if self.__thread.is_alive():
+            written = threading.Event()
+            self.__queue.put(written)
+            written.wait(timeout)
+
+    def close(self):
+        if self.__thread.is_alive():
+            self.__queue.put(None)
+            self.__thread.join(5)
+
+    def __run(self):
+        while True:
+            batch = [self.__queue.get()]
+            while len(batch) < self.__max_batch:
+                try:
+                    batch.append(self.__queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            for item in batch:
+                if item is None:
+                    self.__write(lines)
+                    return
+                if isinstance(item, threading.Event):
+                    self.__write(lines)
+                    lines = []
+                    item.set()
+                    continue
+                try:
+                    lines.append(self.__format(item))
+                except Exception as e:
+                    # a record that can't be written is reported in its place; the writer keeps going
+                    lines.append(self.__format({'ts': time.time(), 'level': LogLevel.ERROR.name,
+                                                'logger': 'JsonLogSink', 'message': 'Dropped a log record: %r' % e}))
+            self.__write(lines)
+
+    @staticmethod
+    def __format(record):
+        record['ts'] = datetime.fromtimestamp(record['ts']).isoformat(timespec='milliseconds')
+        return json.dumps(record, default=str)
+
+    def __write(self, lines):
+        if lines:
+            stream = self.__stream or sys.stderr
+            try:
+                stream.write('\n'.join(lines) + '\n')
+                stream.flush()
+            except Exception as e:
+                sys.__stderr__.write('Failed to write %d log records: %r\n' % (len(lines), e))
+
+
 class Logger:
-    """A class to manage and write log messages."""
+    """
+    A class to manage and write log messages.
+
+    By default, messages are written as colored text. After Logger.configure('json'), every Logger writes JSON lines
+    to stderr instead, through a shared JsonLogSink; fields passed to the log methods or bound with bind() (e.g.
+    phase, service, state, latency_ms) become fields of the JSON records and are left out of text output.
+    """
+    _sink = None
+
+    @classmethod
+    def configure(cls, log_format='text', stream=None):
+        """
+        Selects the output format of all Loggers: 'text' or 'json'.
+
+        :param stream: For 'json', the stream to write to. Defaults to sys.stderr.
+        """
+        if cls._sink is not None:
+            cls._sink.close()
+            cls._sink = None
+        if log_format == 'json':
+            cls._sink = JsonLogSink(stream)
+            atexit.register(cls._sink.close)
+
+    @classmethod
+    def flush(cls):
+        """Waits until all buffered records have been written."""
+        if cls._sink is not None:
+            cls._sink.flush()
 
     def __init__(self, log_level=LogLevel.INFO, name='DefaultLogger', filter_deprecated=True):
         """
@@ -34,53 +143,93 @@ class Logger:
                 self.level = LogLevel[log_level.upper()]
             except KeyError:
                 self.level = LogLevel.INFO
+        elif log_level is None:
+            self.level = LogLevel.INFO
         else:
             self.level = log_level
         self.name = name
+        self.__context = {}
         self.__trace_cache = {datetime.now().strftime(datetime_string_format): "Cache initialized"}
         if filter_deprecated:
             warnings.filterwarnings("ignore", category=DeprecationWarning)
-        click.echo("")
+        if Logger._sink is None:
+            click.echo("")
+
+    def bind(self, **fields):
+        """Returns a Logger that adds the given fields to every record it writes in JSON mode."""
+        bound = copy.copy(self)
+        bound.__context = dict(self.__context, **fields)
+        return bound
 
-    def trace(self, message, cache=None):
+    def trace(self, message, cache=None, **fields):
         if self.level >= LogLevel.TRACE:
+            if Logger._sink is not None:
+                self.__emit(LogLevel.TRACE, message, fields)
+                return
             timestamp = datetime.now().strftime(datetime_string_format)
             if cache is not None:
                 self.__trace_cache[timestamp] = message + ": " + cache
             click.echo(click.style(timestamp +
                                    ' [TRACE] ' + self.name + ' ' + message, fg='white', dim=True))
 
-    def debug(self, title, content=''):
+    def debug(self, title, content='', **fields):
         if self.level >= LogLevel.DEBUG:
+            if Logger._sink is not None:
+                self.__emit(LogLevel.DEBUG, '%s: %s' % (title, content) if content else title, fields)
+                return
             click.echo(click.style(datetime.now().strftime(datetime_string_format) +
                                    ' [DEBUG] ' + self.name + ' ' + title.rjust(25) + ':  ' + content,
                                    fg='white', bg='blue'))
 
-    def info(self, message):
+    def info(self, message, **fields):
         if self.level >= LogLevel.INFO:
+            if Logger._sink is not None:
+                self.__emit(LogLevel.INFO, message, fields)
+                return
             click.echo(click.style(datetime.now().strftime(datetime_string_format) +
                                    ' [INFO] ' + self.name + ' ' + message, fg='green'))
 
-    def warn(self, message):
+    def warn(self, message, **fields):
         if self.level >= LogLevel.WARN:
+            if Logger._sink is not None:
+                self.__emit(LogLevel.WARN, message, fields)
+                return
             click.echo(click.style(datetime.now().strftime(datetime_string_format) +
                                    ' [WARN] ' + self.name + ' ' + message, fg='yellow'))
 
-    def error(self, message):
+    def error(self, message, **fields):
         if self.level >= LogLevel.ERROR:
+            if Logger._sink is not None:
+                self.__emit(LogLevel.ERROR, message, fields)
+                return
             click.echo(click.style(datetime.now().strftime(datetime_string_format) +
                                    ' [ERROR] ' + self.name + ' ' + message, fg='red'))
 
-    def fatal(self, message):
+    def fatal(self, message, **fields):
         if self.level >= LogLevel.FATAL:
-            click.echo(click.style(datetime.now().strftime(datetime_string_format) +
-                                   ' [FATAL] ' + self.name + ' ' + message, fg='bright_white', bg='red', bold=True))
+            if Logger._sink is not None:
+                self.__emit(LogLevel.FATAL, message, fields)
+                Logger.flush()
+            else:
+                click.echo(click.style(datetime.now().strftime(datetime_string_format) +
+                                       ' [FATAL] ' + self.name + ' ' + message, fg='bright_white', bg='red',
+                                       bold=True))
         self.trace_dump()
-        sys.exit('Fatal Error: %s' % message)
+        # in JSON mode, the message is already on record and stderr stays JSON-only
+        sys.exit(1 if Logger._sink is not None else 'Fatal Error: %s' % message)
+
+    def __emit(self, level, message, fields):
+        record = {'ts': time.time(), 'level': level.name, 'logger': self.name, 'message': message}
+        for name, value in dict(self.__context, **fields).items():
+            record[name + '_' if name in RESERVED_FIELDS else name] = value
+        Logger._sink.emit(record)
 
     def trace_dump(self):
+        if Logger._sink is not None:
+            # TRACE records have been written as they were logged
+            return
         if self.level >= LogLevel.TRACE:
-            for key, value in self.__trace_cache.items():
+            for key, value in list(self.__trace_cache.items()):
                 click.echo(click.style(key +
                                        ' [TRACE-DUMP] ' + self.name + ' ' + value, fg='white', dim=True))
             self.__trace_cache = {}
@@ -0,0 +1,132 @@
+import linecache
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# modules whose frames mean a thread is waiting on the network or on another thread rather than running client code
+WAITING_MODULES = ('socket', 'ssl', 'selectors', 'threading', 'queue', 'http/client', 'urllib3/connection',
+                   'urllib3/util/wait', 'concurrent/futures')
+
+
+class SamplingProfiler:
+    """
+    A wall-clock sampling profiler for all threads of a run.
+
+    A background thread takes a snapshot of every other thread's stack at a fixed interval. The samples are written as
+    collapsed stacks ('thread;frame;frame count' lines, the input format of flamegraph.pl, speedscope and inferno), and
+    summarized as the client code that the samples spent the most time in. Samples whose innermost frame is waiting
+    (on a socket, another thread or a sleep) count as waiting time rather than as client time.
+    """
+
+    def __init__(self, interval=0.005):
+        """
+        :param interval: Seconds between two samples.
+        """
+        self.__interval = interval
+        self.__stacks = Counter()
+        self.__waiting = 0
+        self.__samples = 0
+        self.__started = None
+        self.__elapsed = 0.0
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def start(self):
+        self.__started = time.monotonic()
+        self.__thread = threading.Thread(target=self.__run, name='ranchertool-profiler', daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        if self.__thread is not None:
+            self.__stop.set()
+            self.__thread.join()
+            self.__thread = None
+            self.__elapsed = time.monotonic() - self.__started
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    @property
+    def samples(self):
+        return self.__samples
+
+    def collapsed(self):
+        """Returns the sampled stacks as {'thread;outermost frame;...;innermost frame': sample count}."""
+        return dict(self.__stacks)
+
+    def write_collapsed(self, path):
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.__stacks.items()):
+                f.write('%s %d\n' % (stack, count))
+
+    def summary(self, top=15):
+        """A short report of where the time went, with the top client hotspots by self and total samples."""
+        client = self.__samples - self.__waiting
+        lines = ['Profiled %.2f seconds, %d samples: %.0f%% waiting on Rancher/network/sleeps, %.0f%% in client code.' %
+                 (self.__elapsed, self.__samples, self.__percent(self.__waiting, self.__samples),
+                  self.__percent(client, self.__samples))]
+        if not client:
+            return '\n'.join(lines)
+
+        own = Counter()
+        total = Counter()
+        for stack, count in self.__stacks.items():
+            frames = stack.split(';')[1:]
+            if not frames or frames[-1].endswith(' [waiting]'):
+                continue
+            own[frames[-1]] += count
+            for frame in set(frames):
+                total[frame] += count
+        lines.append('Top %d client hotspots (self time):' % top)
+        for frame, count in own.most_common(top):
+            lines.append('  %5.1f%%  %s' % (self.__percent(count, client), frame))
+        lines.append('Top %d client hotspots (including callees):' % top)
+        for frame, count in total.most_common(top):
+            lines.append('  %5.1f%%  %s' % (self.__percent(count, client), frame))
+        return '\n'.join(lines)
+
+    def __run(self):
+        own_id = threading.get_ident()
+        while not self.__stop.wait(self.__interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack, waiting = self.__collapse(frame)
+                self.__stacks['%s;%s' % (names.get(thread_id, thread_id), stack)] += 1
+                self.__samples += 1
+                if waiting:
+                    self.__waiting += 1
+
+    @staticmethod
+    def __collapse(frame):
+        frames = []
+        innermost = frame
+        while frame is not None:
+            code = frame.f_code
+            frames.append('%s:%s' % (_module(code.co_filename), code.co_name))
+            frame = frame.f_back
+        frames.reverse()
+        filename = innermost.f_code.co_filename.replace(os.sep, '/')
+        waiting = any('/%s.py' % module in filename or '/%s/' % module in filename for module in WAITING_MODULES) \
+            or 'sleep(' in linecache.getline(innermost.f_code.co_filename, innermost.f_lineno)
+        if waiting:
+            frames[-1] += ' [waiting]'
+        return ';'.join(frames), waiting
+
+    @staticmethod
+    def __percent(part, whole):
+        return 100.0 * part / whole if whole else 0.0
+
+
+def _module(filename):
+    """Shortens a source file name to 'package/module' for readable stacks."""
+    parts = filename.replace(os.sep, '/').rsplit('/', 2)
+    return '/'.join(parts[-2:]).rsplit('.py', 1)[0]
@@ -1,10 +1,31 @@
 import requests
-from time import sleep
+import requests.adapters
+import threading
+from collections import OrderedDict
+from concurrent.futures import TimeoutError as WaitTimeout
+from contextlib import contextmanager
+from time import monotonic
+from typing import Any, List, NamedTuple, Optional
 
+from .Clock import SYSTEM_CLOCK
+from .Deadline import Deadline
+from .Errors import ConfigurationError, DeadlineExceeded, NotFoundError, RancherApiError
+from .Inventory import Inventory, REMOVED_STATES
+from .JsonCodec import get_codec
 from .Logger import Logger, LogLevel
+from .Resources import Service, Stack
+from .ServiceLifecycle import ServiceLifecycle
+from .ServiceTarget import ServiceTarget
+from .SingleFlight import SingleFlight
 from enum import Enum, auto
 from sakstig import *
 import json
+from urllib.parse import urlencode, urljoin
+
+
+def _is_service_reference(reference):
+    """Whether a service link refers to '<stack>/<service>'."""
+    return isinstance(reference, str) and reference.count('/') == 1 and all(reference.split('/'))
 
 
 class UrlFragType(Enum):
@@ -21,53 +42,170 @@ class HttpMethod(Enum):
     POST = auto()
 
 
+# how many polled URLs a connection remembers the last response of
+POLLED_RESPONSES = 1024
+
+# how many resources the inventory asks for per page of a listing
+INVENTORY_PAGE_SIZE = 1000
+
+# the part of a name lookup's query that skips resources that are being (or have been) removed: Rancher keeps listing
+# them for a while, next to a resource created again under the same name
+LIVE_QUERY = 'not (@.state in [%s])' % ', '.join('"%s"' % state for state in REMOVED_STATES)
+
+
+class _PolledResponse(NamedTuple):
+    """The last response to a polled GET: its ETag, its raw body and the query result it produced."""
+    etag: Optional[str]
+    content: bytes
+    response: Any
+
+
+class _Page(NamedTuple):
+    """One page of a listing: its records and the URL of the next page, if any."""
+    records: List[Any]
+    next: Optional[str]
+
+
 class RancherConnection:
     """
     A class to package current info regarding the Rancher instance we're working with.
+
+    The connection only owns what is shared between operations: the HTTP session (and its connection pool), the
+    project id and the stack/service id caches. Everything specific to one stack/service lives in an immutable
+    ServiceTarget, so a single connection can serve many concurrent deploys. Every operation accepts an optional
+    target; when it is omitted, the default target built from the constructor arguments and the set_* methods is
+    used.
     """
 
-    def __init__(self, url, api_key, api_secret, project_name, stack_name, service_name,
-                 verify_ssl=True, api_version='v2-beta', log_level=LogLevel.INFO, operation_timeout=300):
+    def __init__(self, url, api_key, api_secret, project_name, stack_name=None, service_name=None,
+                 verify_ssl=True, api_version='v2-beta', log_level=LogLevel.INFO, operation_timeout=300,
+                 pool_size=10, connect_timeout=10, read_timeout=30, deadline=None, project_id=None, transport=None,
+                 codec=None, inventory=False, clock=None):
         """
         Default constructor
+
+        :param connect_timeout: Seconds to wait for a connection to Rancher to be established.
+        :param read_timeout: Seconds to wait for Rancher to send a response.
+        :param deadline: A Deadline for everything done through this connection. Every request and wait is capped to
+                         the time left before it.
+        :param project_id: The id of the project (environment), if already known. Skips the project lookup.
+        :param transport: A requests transport adapter to send all requests through (e.g. a RecordingTransport or
+                          ReplayTransport) instead of a pooled HTTPAdapter.
+        :param codec: The JsonCodec (or the name of the JSON library) to encode and decode bodies with. Defaults to
+                      the fastest library installed.
+        :param inventory: Looks stacks and services up in an Inventory of the whole project instead of listing the
+                          services of one stack at a time. Pays off when a run touches services in many stacks.
+        :param clock: The Clock to sleep on between state polls and to measure deadlines with. Defaults to the
+                      system's; simulations pass a VirtualClock.
         """
         self.__logger = Logger(log_level, 'RancherConnection')
         self.__logger.trace('Instantiating instance of RancherConnection....')
         self.__url = url
         self.__api_version = api_version
-        self.__stack_name = stack_name
-        self.__stack_id = None
-        self.__service_name = service_name
-        self.__service_id = None
         self.__project_name = project_name
+        self.__codec = get_codec(codec)
+        self.__service_record = Service.for_api(api_version)
         self.__session = requests.Session()
         self.__session.verify = verify_ssl
         self.__session.auth = (api_key, api_secret)
-        self.__labels = {}
-        self.__variables = {}
-        self.__service_links = {'serviceLinks': []}
+        adapter = transport or requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.__session.mount('http://', adapter)
+        self.__session.mount('https://', adapter)
+        self.__cache_lock = threading.Lock()
+        self.__stack_ids = {}
+        self.__service_ids = {}
+        self.__polled = OrderedDict()
+        self.__in_flight = SingleFlight()
+        self.__target = ServiceTarget(stack_name, service_name)
+        self.__connect_timeout = connect_timeout
+        self.__read_timeout = read_timeout
+        self.__clock = clock or SYSTEM_CLOCK
+        self.__deadline = deadline or Deadline(clock=self.__clock)
+        self.__local = threading.local()
         self.__api_endpoint = self.__url + '/' + self.__api_version
         self.__project_id = None
-        self.__project_id = self.__get_project_id()
-        self.__key = None
-        self.__secret = None
+        self.__project_id = project_id or self.__get_project_id()
         self.__timeout = operation_timeout
+        self.__inventory = None
+        if inventory:
+            self.__inventory = Inventory(
+                lambda: self.__list_all(self.__get_url_frag(UrlFragType.STACK_BASE), Stack,
+                                        "Failed to list the stacks."),
+                lambda: self.__list_all(self.__get_url_frag(UrlFragType.PROJECT) + '/services', self.__service_record,
+                                        "Failed to list the services."))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """Releases the pooled HTTP connections."""
+        self.__session.close()
 
     def get_project_name(self):
         return self.__project_name
 
-    def get_stack_name(self):
-        return self.__stack_name
+    @property
+    def inventory(self):
+        """The Inventory stacks and services are looked up in, or None if the connection looks them up one by one."""
+        return self.__inventory
+
+    def get_project_id(self):
+        return self.__project_id
+
+    def get_stack_name(self, target=None):
+        return self.__target_or_default(target).stack_name
+
+    def get_service_name(self, target=None):
+        return self.__target_or_default(target).service_name
 
-    def get_service_name(self):
-        return self.__service_name
+    def get_target(self):
+        """Returns the default target."""
+        return self.__target
+
+    def target(self, stack_name=None, service_name=None, labels=None, variables=None, service_links=None):
+        """
+        Builds a new target. Names default to the ones of the default target. Labels, variables and service links
+        accept the same formats as set_labels, set_variables and set_service_links.
+        """
+        new_target = ServiceTarget(stack_name or self.__target.stack_name, service_name or self.__target.service_name)
+        if labels:
+            new_target = new_target.with_labels(self.parse_labels(labels))
+        if variables:
+            new_target = new_target.with_variables(self.parse_variables(variables))
+        if service_links:
+            new_target = new_target.with_service_links(self.resolve_service_links(service_links))
+        return new_target
+
+    def resolve(self, target=None):
+        """
+        Returns a copy of the target with its stack and service ids filled in. Resolved targets skip the id lookups
+        in every later operation.
+        """
+        target = self.__target_or_default(target)
+        stack_id = self.__get_actionable_stack_id(target=target)
+        target = target._replace(stack_id=stack_id)
+        if target.service_name:
+            target = target._replace(service_id=self.__get_actionable_service_id(target=target))
+        return target
 
     def set_labels(self, labels_in):
         """
-        Process the labels arguments
+        Process the labels arguments and add them to the default target
         :param labels_in: A string of comma-delimited key=value pairs
         :return:
         """
+        self.__target = self.__target.with_labels(self.parse_labels(labels_in))
+
+    def parse_labels(self, labels_in):
+        """
+        Process the labels arguments
+        :param labels_in: A string of comma-delimited key=value pairs
+        :return: A dict of labels
+        """
+        labels = {}
         try:
             self.__logger.trace('Adding labels...')
             if labels_in is not None and isinstance(labels_in, str):
@@ -77,22 +215,27 @@ class RancherConnection:
                 for label_pair in label_array:
                     label, value = label_pair.split('=', 1)
                     self.__logger.trace("Adding label '" + label + "' with value '" + value + "'.")
-                    self.__labels[label] = value
+                    labels[label] = value
             elif labels_in and (isinstance(labels_in, tuple) or isinstance(labels_in, list)):
                 self.__logger.trace('adding labels from a tuple or list')
                 for label in labels_in:
                     name, value = label
                     self.__logger.trace("Adding label '" + name + "' with value '" + value + "'.")
-                    self.__labels[name] = value
+                    labels[name] = value
             else:
                 self.__logger.error('Unknown type of labels provided. Ignoring them.')
         except Exception as e:
             self.__logger.error("%s" % format(e))
+        return labels
 
-    def get_labels(self):
-        return self.__labels
+    def get_labels(self, target=None):
+        return dict(self.__target_or_default(target).labels)
 
     def set_variables(self, vars_in):
+        self.__target = self.__target.with_variables(self.parse_variables(vars_in))
+
+    def parse_variables(self, vars_in):
+        variables = {}
         try:
             if vars_in is not None and isinstance(vars_in, str):
                 self.__logger.trace("Processing a string of variables")
@@ -100,65 +243,113 @@ class RancherConnection:
                 variables_as_array = vars_in.split('|')
                 for variable_item in variables_as_array:
                     key, value = variable_item.split('=', 1)
-                    self.__variables[key] = value
+                    variables[key] = value
             elif vars_in and (isinstance(vars_in, tuple) or isinstance(vars_in, list)):
                 self.__logger.trace("Processing a tuple or list of variables")
                 for variable in vars_in:
                     name, value = variable
                     self.__logger.trace("Adding variable '" + name + "' with value '" + value + "'.")
-                    self.__variables[name] = value
+                    variables[name] = value
             else:
                 self.__logger.warn('Unknown type of variables provided. Ignoring them.')
         except Exception as e:
             self.__logger.error("%s" % format(e))
+        return variables
 
-    def get_variables(self):
-        return self.__variables
+    def get_variables(self, target=None):
+        return dict(self.__target_or_default(target).variables)
 
     def set_service_links(self, links_in):
+        self.__target = self.__target.with_service_links(self.resolve_service_links(links_in))
+
+    def resolve_service_links(self, links_in):
+        """
+        Resolves service link arguments to (<local-name>, <service-id>) pairs. Links to services that can't be found
+        are left out.
+        :param links_in: A string of comma-delimited <local-name>=<stack>/<service> pairs, or a tuple/list of
+                         (<local-name>, <stack>/<service>) pairs
+        :return: A list of (<local-name>, <service-id>) pairs
+        """
+        links = []
+        for name, reference in self.parse_service_links(links_in):
+            try:
+                service_id = self.resolve_service_link(reference)
+                if service_id is not None and name is not None:
+                    links.append((name, service_id))
+            except Exception as e:
+                self.__logger.error("%s" % format(e))
+        return links
+
+    def parse_service_links(self, links_in, strict=False):
+        """
+        Parses service link arguments without looking anything up.
+        :param links_in: See resolve_service_links.
+        :param strict: Raises a ConfigurationError for malformed links instead of logging and skipping them.
+        :return: A list of (<local-name>, <stack>/<service>) pairs
+        :raises ConfigurationError: if strict is set and a link isn't <local-name>=<stack>/<service>
+        """
         self.__logger.trace("Adding service links")
         if links_in and links_in is not None and isinstance(links_in, str):
             self.__logger.trace("Processing a string of service links")
-            link_array = links_in.split(',')
-            if len(link_array) > 0:
-                for link in link_array:
-                    try:
-                        name, reference = link.split('=', 1)
-                        self.__logger.trace("Adding link named '" + name + "' linking to service '" + reference + "'.")
-                        service_id = self.__get_service_id_from_link_reference(reference)
-                        if service_id is not None and name is not None:
-                            self.__service_links['serviceLinks'].append({'name': name, 'serviceId': service_id})
-                    except Exception as e:
-                        self.__logger.error("%s" % format(e))
-        elif links_in and (isinstance(links_in, tuple) or isinstance(links_in, list)):
-            self.__logger.trace("Processing a tuple or list of services links")
-            for link in links_in:
+            link_pairs = []
+            for link in links_in.split(','):
                 try:
-                    name, reference = link
-                    self.__logger.trace("Adding link named '" + name + "' linking to service '" + reference + "'.")
-                    service_id = self.__get_service_id_from_link_reference(reference)
-                    if service_id is not None:
-                        self.__service_links['serviceLinks'].append({'name': name, 'serviceId': service_id})
+                    link_pairs.append(link.split('=', 1))
                 except Exception as e:
                     self.__logger.error("%s" % format(e))
+        elif links_in and (isinstance(links_in, tuple) or isinstance(links_in, list)):
+            self.__logger.trace("Processing a tuple or list of services links")
+            link_pairs = links_in
         else:
             self.__logger.error("Unrecognized type of service links. Ignoring them and moving on.")
+            link_pairs = []
+        pairs = []
+        malformed = []
+        for link in link_pairs:
+            try:
+                name, reference = link
+                if strict and (not name or not _is_service_reference(reference)):
+                    raise ValueError(link)
+                self.__logger.trace("Adding link named '" + name + "' linking to service '" + reference + "'.")
+                pairs.append((name, reference))
+            except Exception as e:
+                if strict:
+                    malformed.append('='.join(map(str, link)) if isinstance(link, (list, tuple)) else str(link))
+                else:
+                    self.__logger.error("%s" % format(e))
+        if malformed:
+            raise ConfigurationError("Service links must be '<name>=<stack>/<service>', not %s." %
+                                     ', '.join("'%s'" % link for link in malformed))
+        return pairs
+
+    def resolve_service_link(self, reference):
+        """Returns the id of the service a '<stack>/<service>' reference refers to, or None if there is none."""
+        return self.__get_service_id_from_link_reference(reference)
 
-    def get_service_links(self):
-        return self.__service_links
+    def get_service_links(self, target=None):
+        return self.__target_or_default(target).service_links_payload()
 
-    def stack_exists(self, stack_name=None):
-        return self.__get_stack_id(str(stack_name or self.__stack_name)) is not None
+    def stack_exists(self, stack_name=None, target=None):
+        stack_name = stack_name or self.__target_or_default(target).stack_name
+        return self.__get_cached_stack_id(str(stack_name)) is not None
 
-    def create_stack(self, stack_name=None):
+    def create_stack(self, stack_name=None, target=None, docker_compose=None, rancher_compose=None,
+                     environment=None):
+        """
+        Creates a stack. Given a docker_compose (and optionally a rancher_compose), Rancher creates and starts all
+        services of the stack in one go; wait_for_stack_state('active') waits for them.
+        """
         if stack_name is None:
-            stack_name = self.__stack_name
+            stack_name = self.__target_or_default(target).stack_name
         if self.stack_exists(stack_name):
             self.__logger.error("Stack '%s' already exists. Skipping create action." % stack_name)
             return False
         new_stack = {
             'name': stack_name
         }
+        if docker_compose is not None:
+            new_stack.update(self.__compose_payload(docker_compose, rancher_compose, environment))
+            new_stack['startOnCreate'] = True
         self.__logger.info("Creating stack %s in environment %s..." % (new_stack['name'], self.__project_name))
         response = self.__managed_session(
             HttpMethod.POST,
@@ -167,118 +358,349 @@ class RancherConnection:
             '$.*[@.name is "%s"].id' % stack_name,
             new_stack
         )
-        if response is not None:
-            self.__stack_id = response
+        if response is not None and not isinstance(response, requests.exceptions.HTTPError):
+            with self.__cache_lock:
+                self.__stack_ids[str(stack_name)] = response
             return True
         else:
             return False
 
-    def service_exists(self, service_name=None):
-        if service_name is None:
-            service_name = self.__service_name
-        if self.__stack_id is None:
-            self.__stack_id = self.__get_stack_id()
+    def get_stack(self, stack_id=None, target=None):
+        """Fetches the stack resource itself (state, compose files, ...)."""
+        stack_id = self.__get_actionable_stack_id(stack_id, target=self.__target_or_default(target))
         response = self.__managed_session(
             HttpMethod.GET,
-            self.__get_url_frag(UrlFragType.SERVICE_BASE),
-            "Failed to determine if service '%s' exists",
-            '$.data[@.name is "%s"]' % str(service_name or self.__service_name))
-        if response is not None:
-            return True
+            self.__get_url_frag(UrlFragType.STACK, stack_id),
+            "Failed to get stack with id '%s'." % stack_id,
+            conditional=True)
+        if isinstance(response, dict):
+            return response
         else:
-            return False
+            return None
+
+    def stack_action(self, action, json_payload=None, stack_id=None, target=None):
+        """
+        Posts an action (e.g. 'upgrade', 'finishupgrade', 'rollback') on a stack.
+
+        :return: The stack resource returned by Rancher, or None if the request failed
+        """
+        stack_id = self.__get_actionable_stack_id(stack_id, target=self.__target_or_default(target))
+        response = self.__managed_session(
+            HttpMethod.POST,
+            self.__get_url_frag(UrlFragType.STACK, stack_id) + '/?action=%s' % action,
+            "Error during action '%s' on stack id '%s'." % (action, stack_id),
+            json_payload=json_payload
+        )
+        if isinstance(response, requests.exceptions.HTTPError):
+            raise RancherApiError("Action '%s' on stack '%s' received fatal error response: %s" %
+                                  (action, stack_id, format(response)))
+        if isinstance(response, dict):
+            return response
+        else:
+            return None
+
+    def upgrade_stack(self, docker_compose, rancher_compose=None, environment=None, stack_id=None, target=None):
+        """
+        Upgrades every service of a stack to a new docker-compose/rancher-compose pair with a single request. Use
+        wait_for_stack_state('upgraded') to wait for it and stack_action('finishupgrade') to finish it.
+        """
+        return self.stack_action('upgrade', self.__compose_payload(docker_compose, rancher_compose, environment),
+                                 stack_id, target)
+
+    def wait_for_stack_state(self, state, stack_id=None, target=None, timeout=None, poll_interval=2):
+        """
+        Waits until the stack reaches the given state (e.g. 'active' or 'upgraded').
+
+        :return: True if the stack reached the state before the timeout or deadline
+        """
+        stack_id = self.__get_actionable_stack_id(stack_id, target=self.__target_or_default(target))
+        return self.__wait_for_resource_state(lambda: self.get_stack(stack_id), "Stack with id %s" % stack_id, state,
+                                              timeout, poll_interval) == state
 
-    def create_service(self, new_image, service_name=None):
+    def create_pull_task(self, image, mode='all'):
+        """
+        Asks Rancher to pull an image on the hosts of the environment, without starting any container.
+
+        :param image: The image (and :tag) to pull.
+        :param mode: 'all' to pull on all hosts, 'existing' to only pull on hosts that already have an older version
+                     of the image.
+        :return: The pull task resource, or None if the request failed
+        """
+        self.__logger.info("Pre-pulling image %s..." % image)
+        response = self.__managed_session(
+            HttpMethod.POST,
+            self.__get_url_frag(UrlFragType.PROJECT) + '/pulltasks',
+            "Failed to start pulling image '%s'." % image,
+            json_payload={'image': image, 'mode': mode}
+        )
+        if isinstance(response, dict):
+            return response
+        else:
+            return None
+
+    def wait_for_pull_task(self, pull_task_id, timeout=None, poll_interval=2):
+        """
+        Waits until a pull task has pulled its image on all of its hosts.
+
+        :return: True if the pull task completed before the timeout or deadline
+        """
+        url = self.__get_url_frag(UrlFragType.PROJECT) + '/pulltasks/%s' % pull_task_id
+
+        def get_pull_task():
+            response = self.__managed_session(HttpMethod.GET, url,
+                                              "Failed to get pull task with id '%s'." % pull_task_id,
+                                              conditional=True)
+            return response if isinstance(response, dict) else None
+
+        return self.__wait_for_resource_state(get_pull_task, "Pull task with id %s" % pull_task_id, 'active',
+                                              timeout, poll_interval, failed_states=('error', 'removed')) == 'active'
+
+    def service_exists(self, service_name=None, target=None):
+        target = self.__target_or_default(target)
+        if service_name is not None:
+            target = target._replace(service_name=service_name, service_id=None)
+        return self.__get_actionable_service_id(target=target) is not None
+
+    def create_service(self, new_image, service_name=None, target=None):
+        target = self.__target_or_default(target)
         if service_name is None:
-            service_name = self.__service_name
+            service_name = target.service_name
+        target = target._replace(service_name=service_name)
         if new_image is None:
             self.__logger.error("In order to create service %s, an image must be specified." % service_name)
             return False
-        if self.service_exists(service_name):
+        if self.service_exists(target=target):
             self.__logger.error("Service '%s' already exists. Skipping create." % service_name)
             return False
+        stack_id = self.__get_actionable_stack_id(target=target)
         new_service = {
             'name': service_name,
-            'stackId': self.__stack_id,
+            'stackId': stack_id,
             'startOnCreate': False,
             'launchConfig': {
                 'imageUuid': ("docker:%s" % new_image),
-                'labels': self.__labels,
-                'environment': self.__variables
+                'labels': dict(target.labels),
+                'environment': dict(target.variables)
             }
         }
         self.__logger.info("Creating service %s in stack %s in environment %s..." %
-                           (new_service['name'], self.__stack_name, self.__project_name))
+                           (new_service['name'], target.stack_name, self.__project_name))
         response = self.__managed_session(
             HttpMethod.POST,
-            self.__get_url_frag(UrlFragType.SERVICE_BASE),
+            self.__get_url_frag(UrlFragType.SERVICE_BASE, stack_id),
             "Failed to create service named '%s'." % service_name,
             '$.*[@.name is "%s"].id' % service_name,
             new_service
         )
         if response is not None:
             if isinstance(response, requests.exceptions.HTTPError):
-                self.__logger.fatal("A fatal error occurred. Unable to create service. ")
+                raise RancherApiError("Unable to create service '%s': %s" % (service_name, format(response)))
             else:
-                self.__service_id = response
-                self.__set_service_links()
-                return self.activate_service() and self.wait_for_state('active')
+                with self.__cache_lock:
+                    self.__service_ids[(stack_id, service_name)] = response
+                target = target._replace(stack_id=stack_id, service_id=response)
+                self.__set_service_links(target=target)
+                return self.activate_service(target=target) and self.wait_for_state('active', target=target)
         else:
             return False
 
-    def get_service_state(self, service_id=None):
-        service_id = self.__get_actionable_service_id(service_id)
+    def get_operation_timeout(self):
+        return self.__timeout
+
+    def requests_sent(self):
+        """
+        The number of requests the calling thread has sent through this connection. A GET answered with the response
+        to an identical GET of another thread is counted on that thread only (see requests_coalesced()).
+        """
+        return getattr(self.__local, 'requests', 0)
+
+    def requests_coalesced(self):
+        """The number of GETs that were answered with the response to an identical GET already in flight."""
+        return self.__in_flight.coalesced
+
+    def get_clock(self):
+        return self.__clock
+
+    def get_deadline(self):
+        """Returns the deadline of the calling thread's deadline_scope, or the connection's deadline."""
+        return getattr(self.__local, 'deadline', None) or self.__deadline
+
+    @contextmanager
+    def deadline_scope(self, deadline):
+        """
+        Applies a deadline to everything the calling thread does through this connection inside the with block, so
+        concurrent deploys sharing the connection can each have their own deadline.
+        """
+        previous = getattr(self.__local, 'deadline', None)
+        self.__local.deadline = deadline
+        try:
+            yield deadline
+        finally:
+            self.__local.deadline = previous
+
+    def lifecycle(self, target=None, service=None):
+        """
+        Returns a ServiceLifecycle to drive the target's service through an upgrade (or activation/rollback) with as
+        few state polls as possible.
+
+        :param service: The service resource, if it was just fetched (see get_service), to start from.
+        """
+        return ServiceLifecycle(self, self.resolve(target), self.__logger.level, service=service)
+
+    def find_services(self, references, stack_name=None, conditional=False):
+        """
+        Fetches several services at once with a single filtered services request (plus one stacks request for stack
+        names that aren't cached yet).
+
+        :param references: Service names or '<stack>/<service>' references. Bare names are looked up in stack_name, or
+                           in every stack if no stack_name is given. An empty list selects every service of stack_name.
+        :param stack_name: The default stack for bare service names.
+        :param conditional: Whether to send the request with the ETag of the previous identical lookup (see
+                            __managed_session), for lookups that are repeated, e.g. by reconcile loops. The Service
+                            records are then shared between the lookups.
+        :return: A list of (stack name, Service) pairs, in the order of the references. Services that don't exist, or
+                 are being removed, are left out.
+        :raises RancherApiError: if the lookup failed
+        """
+        wanted = []
+        for reference in references:
+            if '/' in reference:
+                wanted.append(tuple(reference.split('/', 1)))
+            else:
+                wanted.append((stack_name, reference))
+        if not wanted and stack_name:
+            wanted.append((stack_name, None))
+
+        stack_ids = self.__get_cached_stack_ids({stack for stack, service in wanted if stack is not None})
+        params = [('name', service) for service in sorted({service for stack, service in wanted if service})]
+        if all(stack is not None for stack, service in wanted):
+            stack_field = 'environmentId' if self.__api_version == 'v1' else 'stackId'
+            params += [(stack_field, stack_id) for stack_id in sorted(set(stack_ids.values()))]
+            if not stack_ids:
+                return []
         response = self.__managed_session(
             HttpMethod.GET,
-            self.__get_url_frag(UrlFragType.SERVICE_BASE),
-            "Failed to determine if service '%s' exists.",
-            '$.data[@.id is "%s"].state' % service_id)
-        if response is not None:
+            self.__get_url_frag(UrlFragType.PROJECT) + '/services' + ('?' + urlencode(params) if params else ''),
+            "Failed to look up services %s." % ', '.join(references or [str(stack_name)]),
+            '$', conditional=conditional,
+            build=lambda collection: [self.__service_record(service, self.__codec)
+                                      for service in collection.get('data') or []])
+        if not isinstance(response, list):
+            raise RancherApiError("Failed to look up services %s." % ', '.join(references or [str(stack_name)]))
+        services = response
+
+        stack_names = {stack_id: name for name, stack_id in stack_ids.items()}
+        unknown_stacks = {service.stack_id for service in services} - set(stack_names)
+        if unknown_stacks:
+            stack_names.update(self.__get_stack_names(unknown_stacks))
+
+        found = []
+        for stack, service_name in wanted:
+            for service in services:
+                if service.state in REMOVED_STATES:
+                    continue
+                if service_name is not None and service.name != service_name:
+                    continue
+                if stack is not None and service.stack_id != stack_ids.get(stack):
+                    continue
+                found.append((stack_names.get(service.stack_id), service))
+        return found
+
+    def get_service(self, service_id=None, target=None):
+        """
+        Fetches the service resource itself (state, launch configs, ...).
+
+        When the service is looked up by name and the id cached for that name turns out to be gone (an error, or a
+        removed service, e.g. one that was removed and created again under the same name), the cached ids are dropped
+        and the name is looked up again.
+        """
+        target = self.__target_or_default(target)
+        actionable_id = self.__get_actionable_service_id(service_id, target)
+        response = self.__fetch_service(actionable_id)
+        if service_id is None and target.service_name and actionable_id is not None and self.__gone(response) and \
+                self.__get_cached_service_id(target=target) == actionable_id:
+            self.__forget_service(actionable_id, target.stack_name)
+            fresh_id = self.__get_actionable_service_id(target=target._replace(stack_id=None, service_id=None))
+            if fresh_id is None or fresh_id == actionable_id:
+                return None
+            response = self.__fetch_service(fresh_id)
+        if isinstance(response, dict):
             return response
         else:
             return None
 
-    def wait_for_state(self, state, service_id=None):
-        service_id = self.__get_actionable_service_id(service_id)
-        elapsed = 0
-        while self.get_service_state(service_id) != state:
-            self.__logger.trace("Waiting for state to be %s...." % state)
-            sleep(2)
-            elapsed += 2
-            if elapsed >= self.__timeout:
-                self.__logger.error("Waiting for container timed out")
-                return False
-        return True
-
-    def finish_upgrade(self, service_id=None):
-        service_id = self.__get_actionable_service_id(service_id)
-        if self.get_service_state(service_id) == 'active':
-            self.__logger.warn("Service with id %s is currently Active. No upgrade to finish." % service_id)
+    def __fetch_service(self, service_id):
+        return self.__managed_session(
+            HttpMethod.GET,
+            self.__get_url_frag(UrlFragType.SERVICE, service_id=service_id),
+            "Failed to get service with id '%s'." % service_id,
+            conditional=True)
+
+    @staticmethod
+    def __gone(response):
+        return isinstance(response, requests.exceptions.HTTPError) or \
+            (isinstance(response, dict) and response.get('state') in REMOVED_STATES)
+
+    def __forget_service(self, service_id, stack_name=None):
+        """Drops a service id that no longer belongs to a live service (and the id of its stack) from the caches."""
+        with self.__cache_lock:
+            for key in [key for key, value in self.__service_ids.items() if value == service_id]:
+                del self.__service_ids[key]
+            self.__stack_ids.pop(stack_name, None)
+        if self.__inventory is not None:
+            self.__inventory.discard_service(service_id)
+            self.__inventory.refresh()
+
+    def get_service_state(self, service_id=None, target=None):
+        service = self.get_service(service_id, target)
+        if service is not None:
+            return service.get('state')
         else:
-            if self.wait_for_state('upgraded'):
-                response = self.__managed_session(
-                    HttpMethod.POST,
-                    self.__get_url_frag(UrlFragType.SERVICE, None, service_id) + '/?action=finishupgrade',
-                    "Error while finishing upgrade of service id '%s'." % service_id,
-                    '$.*[@.id is "%s"]' % service_id
-                )
-                return self.wait_for_state('active')
-            else:
-                return False
+            return None
+
+    def wait_for_state(self, state, service_id=None, target=None):
+        target = self.__target_or_default(target)
+        service_id = self.__get_actionable_service_id(service_id, target)
+        return self.lifecycle(target._replace(service_id=service_id)).wait_until(state)
+
+    def finish_upgrade(self, service_id=None, target=None):
+        target = self.__target_or_default(target)
+        service_id = self.__get_actionable_service_id(service_id, target)
+        return self.lifecycle(target._replace(service_id=service_id)).finish()
+
+    def service_action(self, action, json_payload=None, service_id=None, target=None):
+        """
+        Posts an action (e.g. 'finishupgrade', 'rollback') on a service.
+
+        :return: The service resource returned by Rancher, or None if the request failed
+        """
+        service_id = self.__get_actionable_service_id(service_id, self.__target_or_default(target))
+        response = self.__managed_session(
+            HttpMethod.POST,
+            self.__get_url_frag(UrlFragType.SERVICE, service_id=service_id) + '/?action=%s' % action,
+            "Error during action '%s' on service id '%s'." % (action, service_id),
+            json_payload=json_payload
+        )
+        if isinstance(response, dict):
+            return response
+        else:
+            return None
 
-    def get_launch_config(self, secondary=False, service_id=None):
+    def get_launch_config(self, secondary=False, service_id=None, target=None):
         self.__logger.trace('Executing get_launch_config....')
-        service_id = self.__get_actionable_service_id(service_id)
+        target = self.__target_or_default(target)
+        service_id = self.__get_actionable_service_id(service_id, target)
+        services_url = self.__get_url_frag(UrlFragType.SERVICE_BASE, self.__get_actionable_stack_id(target=target))
         if secondary:
             response = self.__managed_session(
                 HttpMethod.GET,
-                self.__get_url_frag(UrlFragType.SERVICE_BASE),
+                services_url,
                 "Failed to determine if service '%s' exists.",
                 '$.data[@.id is "%s"].secondaryLaunchConfigs' % service_id)
         else:
             response = self.__managed_session(
                 HttpMethod.GET,
-                self.__get_url_frag(UrlFragType.SERVICE_BASE),
+                services_url,
                 "Failed to determine if service '%s' exists.",
                 '$.data[@.id is "%s"].launchConfig' % service_id)
         if response is not None:
@@ -286,93 +708,201 @@ class RancherConnection:
         else:
             return None
 
-    def do_upgrade(self, json_payload, service_id=None):
+    def do_upgrade(self, json_payload, service_id=None, target=None):
         self.__logger.trace('Executing do_upgrade....')
-        service_id = self.__get_actionable_service_id(service_id)
-        self.__set_service_links(service_id)
+        target = self.__target_or_default(target)
+        service_id = self.__get_actionable_service_id(service_id, target)
+        self.__set_service_links(service_id, target)
         response = self.__managed_session(
             HttpMethod.POST,
-            self.__get_url_frag(UrlFragType.SERVICE, None, service_id) + '/?action=upgrade',
+            self.__get_url_frag(UrlFragType.SERVICE, service_id=service_id) + '/?action=upgrade',
             "Error while upgrading service id '%s' with payload: %s" % (service_id, json_payload),
             '$.*[@.id is "%s"]' % service_id,
             json_payload
         )
         if isinstance(response, requests.exceptions.HTTPError):
-            self.__logger.fatal("Upgrade attempt received fatal error response: %s" % format(response))
+            raise RancherApiError("Upgrade attempt received fatal error response: %s" % format(response))
 
-        self.__logger.trace('Received upgrade response (cached)', json.dumps(response,
-                                                                             sort_keys=True, indent=2))
+        if self.__logger.level >= LogLevel.TRACE:
+            self.__logger.trace('Received upgrade response (cached)', json.dumps(response, sort_keys=True, indent=2))
+        return response
 
-    def activate_service(self, service_id=None):
-        service_id = self.__get_actionable_service_id(service_id)
-        self.wait_for_state('inactive', service_id)
-        response = self.__managed_session(
-            HttpMethod.POST,
-            self.__get_url_frag(UrlFragType.SERVICE, None, service_id) + '/?action=activate',
-            "Error while activating service id '%s'" % service_id,
-            '$.*[@.id is "%s"]' % service_id
-        )
-        return response is not None
+    def activate_service(self, service_id=None, target=None):
+        target = self.__target_or_default(target)
+        service_id = self.__get_actionable_service_id(service_id, target)
+        self.wait_for_state('inactive', service_id, target)
+        return self.service_action('activate', service_id=service_id, target=target) is not None
 
-    def deactivate_service(self, service_id=None):
-        service_id = self.__get_actionable_service_id(service_id)
+    def deactivate_service(self, service_id=None, target=None):
+        service_id = self.__get_actionable_service_id(service_id, self.__target_or_default(target))
         response = self.__managed_session(
             HttpMethod.POST,
-            self.__get_url_frag(UrlFragType.SERVICE, None, service_id) + '/?action=deactivate',
+            self.__get_url_frag(UrlFragType.SERVICE, service_id=service_id) + '/?action=deactivate',
             "Error while deactivating service id '%s'" % service_id,
             '$.*[@.id is "%s"]' % service_id
         )
 
-    def remove_service(self, service_id=None):
-        service_id = self.__get_actionable_service_id(service_id)
+    def remove_service(self, service_id=None, target=None):
+        target = self.__target_or_default(target)
+        service_id = self.__get_actionable_service_id(service_id, target)
         response = self.__managed_session(
             HttpMethod.POST,
-            self.__get_url_frag(UrlFragType.SERVICE, None, service_id) + '/?action=remove',
+            self.__get_url_frag(UrlFragType.SERVICE, service_id=service_id) + '/?action=remove',
             "Error while deleting/removing service id '%s'" % service_id,
             '$.*[@.id is "%s"]' % service_id
         )
+        with self.__cache_lock:
+            for key in [key for key, value in self.__service_ids.items() if value == service_id]:
+                del self.__service_ids[key]
+        if self.__inventory is not None:
+            self.__inventory.discard_service(service_id)
 
-    def rollback(self, service_id=None):
+    def rollback(self, service_id=None, target=None):
         self.__logger.info("Rolling back")
-        service_id = self.__get_actionable_service_id(service_id)
-        response = self.__managed_session(HttpMethod.POST, UrlFragType.SERVICE_BASE + '/' + '/?action=rollback',
-                                          "Error while rolling back service with ID = '%s'." % service_id,
-                                          '$.*[@.id is "%s"]' % service_id)
-        if response is not None:
-            return True
-        else:
-            return False
+        return self.service_action('rollback', service_id=service_id, target=target) is not None
+
+    def __wait_for_resource_state(self, fetch, description, state, timeout=None, poll_interval=2, failed_states=()):
+        """
+        Polls a resource until it reaches the given state (or one of the failed states), the timeout passes or the
+        deadline is reached.
+
+        :param fetch: A function returning the current resource, or None.
+        :return: The last observed state
+        """
+        deadline = self.get_deadline()
+        timeout = deadline.cap(self.__timeout if timeout is None else timeout)
+        elapsed = 0
+        while True:
+            resource = fetch()
+            current = resource.get('state') if resource is not None else None
+            self.__logger.trace("%s is %s" % (description, current), state=current)
+            if current == state:
+                return current
+            if current in failed_states:
+                self.__logger.error("%s failed (state %s): %s" %
+                                    (description, current, resource.get('transitioningMessage') or 'no details'))
+                return current
+            if elapsed >= timeout or deadline.expired():
+                self.__logger.error("%s did not reach state %s in time (currently %s)." %
+                                    (description, state, current or 'unknown'))
+                return current
+            self.__logger.trace("Waiting for state to be %s...." % state)
+            interval = min(poll_interval, timeout - elapsed)
+            self.__clock.sleep(interval)
+            elapsed += interval
+
+    @staticmethod
+    def __compose_payload(docker_compose, rancher_compose=None, environment=None):
+        payload = {'dockerCompose': docker_compose}
+        if rancher_compose is not None:
+            payload['rancherCompose'] = rancher_compose
+        if environment:
+            payload['environment'] = dict(environment)
+        return payload
 
-    def __set_service_links(self, service_id=None):
-        if len(self.__service_links['serviceLinks']) > 0:
-            service_id = self.__get_actionable_service_id(service_id)
+    def __target_or_default(self, target=None):
+        return self.__target if target is None else target
+
+    def __set_service_links(self, service_id=None, target=None):
+        target = self.__target_or_default(target)
+        if len(target.service_links) > 0:
+            service_id = self.__get_actionable_service_id(service_id, target)
             response = self.__managed_session(HttpMethod.POST,
                                               self.__get_url_frag(UrlFragType.SERVICE, service_id=service_id)
                                               + '/?action=setservicelinks',
                                               "Error while attempting to apply service links to service",
-                                              json_payload=self.__service_links
+                                              json_payload=target.service_links_payload()
                                               )
 
-    def __get_actionable_stack_id(self, stack_id=None, stack_name=None):
+    def __get_actionable_stack_id(self, stack_id=None, stack_name=None, target=None):
         self.__logger.trace('Executing __get_actionable_stack_id....')
         if stack_id is None and stack_name is not None:
-            stack_id = self.__get_stack_id(stack_name)
+            stack_id = self.__get_cached_stack_id(stack_name)
         elif stack_id is None:
-            if self.__stack_id is None:
-                self.__stack_id = self.__get_stack_id()
-            stack_id = self.__stack_id
+            target = self.__target_or_default(target)
+            stack_id = target.stack_id or self.__get_cached_stack_id(target.stack_name)
         self.__logger.trace('Found actionable stack id: %s' % stack_id)
         return stack_id
 
-    def __get_actionable_service_id(self, service_id=None):
+    def __get_actionable_service_id(self, service_id=None, target=None):
         self.__logger.trace('Executing __get_actionable_service_id....')
         if service_id is None:
-            if self.__service_id is None:
-                self.__service_id = self.__get_service_id()
-            service_id = self.__service_id
+            target = self.__target_or_default(target)
+            service_id = target.service_id or self.__get_cached_service_id(target=target)
         self.__logger.trace('Found actionable service id: %s' % service_id)
         return service_id
 
+    def __get_cached_stack_id(self, stack_name):
+        with self.__cache_lock:
+            stack_id = self.__stack_ids.get(stack_name)
+        if stack_id is None and self.__inventory is not None:
+            stack = self.__inventory.stack(stack_name)
+            stack_id = stack.id if stack is not None else None
+        elif stack_id is None:
+            stack_id = self.__get_stack_id(stack_name)
+            if stack_id is not None and not isinstance(stack_id, requests.exceptions.HTTPError):
+                with self.__cache_lock:
+                    self.__stack_ids[stack_name] = stack_id
+        return stack_id
+
+    def __get_cached_stack_ids(self, stack_names):
+        """Returns a {name: id} dict for the given stack names, looking all uncached names up in one request."""
+        with self.__cache_lock:
+            stack_ids = {name: self.__stack_ids[name] for name in stack_names if name in self.__stack_ids}
+        missing = sorted(set(stack_names) - set(stack_ids))
+        if missing and self.__inventory is not None:
+            stacks = [self.__inventory.stack(name) for name in missing]
+            stack_ids.update({stack.name: stack.id for stack in stacks if stack is not None})
+        elif missing:
+            response = self.__managed_session(
+                HttpMethod.GET,
+                self.__get_url_frag(UrlFragType.STACK_BASE) + '?' + urlencode([('name', name) for name in missing]),
+                "Failed to get IDs for stacks %s" % ', '.join(missing),
+                '$.data')
+            for stack in response if isinstance(response, list) else []:
+                if stack.get('name') in missing:
+                    stack_ids[stack['name']] = stack['id']
+            with self.__cache_lock:
+                self.__stack_ids.update(stack_ids)
+        return stack_ids
+
+    def __get_stack_names(self, stack_ids):
+        """Returns an {id: name} dict for the given stack ids."""
+        if self.__inventory is not None:
+            stacks = [self.__inventory.stack_by_id(stack_id) for stack_id in stack_ids]
+            return {stack.id: stack.name for stack in stacks if stack is not None}
+        response = self.__managed_session(
+            HttpMethod.GET,
+            self.__get_url_frag(UrlFragType.STACK_BASE) + '?' + urlencode([('id', stack_id)
+                                                                          for stack_id in sorted(stack_ids)]),
+            "Failed to get names for stacks %s" % ', '.join(sorted(stack_ids)),
+            '$.data')
+        stack_names = {}
+        for stack in response if isinstance(response, list) else []:
+            stack_names[stack['id']] = stack.get('name')
+        with self.__cache_lock:
+            self.__stack_ids.update({name: stack_id for stack_id, name in stack_names.items()})
+        return stack_names
+
+    def __get_cached_service_id(self, stack_name=None, service_name=None, target=None):
+        target = self.__target_or_default(target)
+        service_name = service_name or target.service_name
+        if stack_name is not None:
+            stack_id = self.__get_cached_stack_id(stack_name)
+        else:
+            stack_id = target.stack_id or self.__get_cached_stack_id(target.stack_name)
+        with self.__cache_lock:
+            service_id = self.__service_ids.get((stack_id, service_name))
+        if service_id is None and self.__inventory is not None:
+            service = self.__inventory.service_in(stack_id, service_name) if stack_id is not None else None
+            service_id = service.id if service is not None else None
+        elif service_id is None:
+            service_id = self.__get_service_id(stack_id, service_name)
+            if service_id is not None and not isinstance(service_id, requests.exceptions.HTTPError):
+                with self.__cache_lock:
+                    self.__service_ids[(stack_id, service_name)] = service_id
+        return service_id
+
     # ==================================================================================================================
     # A function to retrieve and return the environment ID
     # ==================================================================================================================
@@ -386,22 +916,18 @@ class RancherConnection:
         # GIVEN AN ENVIRONMENT TOKEN. THROW AN ERROR IN THIS CASE
         if self.__project_name is None:
 
-            project_count = self.__managed_session(
+            projects = self.__managed_session(
                 HttpMethod.GET,
                 self.__get_url_frag(UrlFragType.PROJECT_BASE),
-                "Failed to get count of projects. This is a fatal error.",
-                'count($.data)'
+                "Failed to get the list of projects. This is a fatal error.",
+                '$.data'
             )
 
-            if project_count != 1:
-                self.__logger.fatal("An error occurred while trying to get the project ID")
+            if not isinstance(projects, list) or len(projects) != 1:
+                raise NotFoundError("An error occurred while trying to get the project ID. If you are using an "
+                                    "account API key, specify the environment.")
             else:
-                project_id = self.__managed_session(
-                    HttpMethod.GET,
-                    self.__get_url_frag(UrlFragType.PROJECT_BASE),
-                    "Failed to get project ID. This is a fatal error.",
-                    '$.data[0].id'
-                )
+                project_id = projects[0]['id']
 
         # IF WE HAVE A PROJECT NAME, WHEN CAN JUST USE THAT TO GET AN ID, NO MATTER HOW MANY PROJECTS
         # ARE RETURNED
@@ -412,6 +938,8 @@ class RancherConnection:
                 "Failed to get project ID. This is a fatal error.",
                 '$.data[@.name is "%s"].id' % str(self.__project_name)
             )
+            if not isinstance(project_id, str):
+                raise NotFoundError("Unable to find an environment called '%s'." % self.__project_name)
 
         return project_id
 
@@ -420,21 +948,22 @@ class RancherConnection:
     # ==================================================================================================================
     def __get_service_id_from_link_reference(self, service_link_reference):
         # service references are in the form of '<stack>/<service>'
+        if not _is_service_reference(service_link_reference):
+            raise ConfigurationError("Service links must refer to '<stack>/<service>', not '%s'." %
+                                     service_link_reference)
         stack_name, service_name = service_link_reference.split('/')
-        return self.__get_service_id(stack_name, service_name)
+        return self.__get_cached_service_id(stack_name, service_name)
 
     # ======================================================================================================================
-    # A function to retrieve and return a service ID based on a service reference in the service link argument
+    # A function to retrieve and return a service ID based on the stack ID and service name
     # ======================================================================================================================
-    def __get_service_id(self, stack_name=None, service_name=None):
+    def __get_service_id(self, stack_id, service_name):
         self.__logger.trace('Executing __get_service_id....')
-        service_id = None
-        stack_id = self.__get_actionable_stack_id(stack_name=stack_name)
         response = self.__managed_session(
             HttpMethod.GET,
             self.__get_url_frag(UrlFragType.SERVICE_BASE, stack_id),
-            "Failed to get ID for service '%s'" % str(service_name or self.__service_name),
-            '$.data[@.name is "%s"].id' % str(service_name or self.__service_name))
+            "Failed to get ID for service '%s'" % str(service_name),
+            '$.data[@.name is "%s" and %s].id' % (str(service_name), LIVE_QUERY))
         if response is not None:
             self.__logger.debug("Service ID", response)
             return response
@@ -444,18 +973,40 @@ class RancherConnection:
     # ======================================================================================================================
     # A function to retrieve and return a stack ID based on a stack name
     # ======================================================================================================================
-    def __get_stack_id(self, stack_name=None):
+    def __get_stack_id(self, stack_name):
         self.__logger.trace('Executing __get_stack_id....')
         response = self.__managed_session(
             HttpMethod.GET,
             self.__get_url_frag(UrlFragType.STACK_BASE),
-            "Failed to get ID for stack '%s'" % str(stack_name or self.__stack_name),
-            '$.data[@.name is "%s"].id' % str(stack_name or self.__stack_name))
+            "Failed to get ID for stack '%s'" % str(stack_name),
+            '$.data[@.name is "%s" and %s].id' % (str(stack_name), LIVE_QUERY))
         if response is not None:
             return response
         else:
             return None
 
+    def __list_all(self, url, record, err_msg):
+        """
+        Fetches every resource of a collection as records, following its pages. Pages are requested conditionally: an
+        unchanged page is answered with '304 Not Modified' and comes back as the same list object.
+
+        :param record: The record class to build, e.g. Service.
+        :return: A list of pages (lists of records), or None if a page could not be fetched
+        """
+        def build(collection):
+            return _Page([record(resource, self.__codec) for resource in collection.get('data') or []],
+                         (collection.get('pagination') or {}).get('next'))
+
+        pages = []
+        url += '?' + urlencode({'limit': INVENTORY_PAGE_SIZE})
+        while url:
+            page = self.__managed_session(HttpMethod.GET, url, err_msg, '$', conditional=True, build=build)
+            if not isinstance(page, _Page):
+                return None
+            pages.append(page.records)
+            url = urljoin(url, page.next) if page.next else None
+        return pages
+
     def __get_url_frag(self, url_type: UrlFragType, stack_id=None, service_id=None):
         """ URL formatter
 
@@ -474,16 +1025,16 @@ class RancherConnection:
         elif self.__api_version == 'v2-beta':
             stacks_url_fragment = '/stacks'
         else:
-            self.__logger.fatal('Unrecognized API version (%s). Please verify the API version and '
-                                'try again.' % self.__api_version)
+            raise ConfigurationError('Unrecognized API version (%s). Please verify the API version and '
+                                     'try again.' % self.__api_version)
 
         self.__logger.trace('Getting url fragment %s for api version %s' % (url_type.name, self.__api_version))
         projects = self.__api_endpoint + '/projects'
         project = projects + '/%s' % str(self.__project_id or "")
         stacks = project + stacks_url_fragment
-        stack = stacks + '/%s' % str(stack_id or self.__stack_id)
+        stack = stacks + '/%s' % str(stack_id or "")
         services = stack + '/services'
-        service = project + '/services/%s' % str(service_id or self.__service_id)
+        service = project + '/services/%s' % str(service_id or "")
 
         frags = {
             UrlFragType.PROJECT_BASE: projects,
@@ -498,21 +1049,84 @@ class RancherConnection:
     # ======================================================================================================================
     # This function manages the HTTP session and all communications
     # ======================================================================================================================
-    def __managed_session(self, method: HttpMethod, url: str, err_msg: str, object_path_query='$.*', json_payload=None):
+    def __get(self, url, etag, timeout, deadline):
+        """
+        Sends a GET, unless an identical one (same URL, same If-None-Match) is already in flight on another thread: then
+        waits for its response instead of sending another. Only GETs sent after the calling thread's last POST returned
+        are waited for, so that a thread always reads its own writes. Each caller decodes the shared response on its
+        own, so callers never share the objects they get back (except for what conditional GETs already share).
+        """
+        def send():
+            self.__local.requests = self.requests_sent() + 1
+            return self.__session.get(url, headers={'If-None-Match': etag} if etag else None, timeout=timeout)
+
+        # no longer than a request of the caller's own could take
+        wait = None if None in timeout else sum(timeout)
+        remaining = deadline.remaining()
+        if remaining is not None:
+            wait = remaining if wait is None else min(wait, remaining)
+        try:
+            return self.__in_flight.do((url, etag or None), send, getattr(self.__local, 'written', 0), wait)
+        except WaitTimeout:
+            if deadline.expired():
+                raise DeadlineExceeded("The deploy deadline of %s seconds was exceeded." % deadline.seconds)
+            raise requests.exceptions.ReadTimeout("An identical request in flight did not complete in time.")
+
+    def __post(self, url, json_payload, timeout):
+        self.__local.requests = self.requests_sent() + 1
+        try:
+            if json_payload is None:
+                return self.__session.post(url, timeout=timeout)
+            return self.__session.post(url, data=self.__codec.dumps(json_payload),
+                                       headers={'Content-Type': 'application/json'}, timeout=timeout)
+        finally:
+            # GETs sent before the POST returned may not see what it changed: later GETs of this thread don't join them
+            self.__local.written = self.__in_flight.started()
+
+    def __managed_session(self, method: HttpMethod, url: str, err_msg: str, object_path_query='$.*', json_payload=None,
+                          conditional=False, build=None):
+        """
+        :param conditional: For GETs that are polled: sends the ETag of the previous response in If-None-Match, and
+                            answers a '304 Not Modified' (or a body identical to the previous one) with the previous
+                            query result, without decoding or querying anything. The result is shared between
+                            those calls, so callers must not modify it.
+        :param build: Turns the query result into what is returned (and remembered for conditional requests), e.g.
+                      compact resource records, so that the decoded response can be released right away.
+        """
         response = None
         http_response = None
+        polled = None
+        exceeded = None
+        if conditional:
+            with self.__cache_lock:
+                polled = self.__polled.get((url, object_path_query))
+        deadline = self.get_deadline()
+        try:
+            timeout = deadline.request_timeout(self.__connect_timeout, self.__read_timeout)
+        except DeadlineExceeded as e:
+            raise DeadlineExceeded("%s %s" % (format(e), err_msg))
+        sent = monotonic()
         try:
             self.__logger.trace('Managed Session Url: ' + url)
             if method is HttpMethod.GET:
                 self.__logger.trace('Executing a GET', url)
-                http_response = self.__session.get(url)
+                http_response = self.__get(url, polled.etag if polled is not None else None, timeout, deadline)
             elif method is HttpMethod.POST:
-                self.__logger.trace('Executing a POST (payload cached)',
-                                    json.dumps(json_payload, sort_keys=True, indent=2))
-                http_response = self.__session.post(url, json=json_payload)
+                if self.__logger.level >= LogLevel.TRACE:
+                    self.__logger.trace('Executing a POST (payload cached)',
+                                        json.dumps(json_payload, sort_keys=True, indent=2))
+                http_response = self.__post(url, json_payload, timeout)
             else:
                 self.__logger.error("Unknown HTTP method.")
+            if self.__logger.level >= LogLevel.DEBUG:
+                latency_ms = round((monotonic() - sent) * 1000, 1)
+                self.__logger.debug('Request', '%s %s -> %d (%.0f ms)' % (method.name, url, http_response.status_code,
+                                                                         latency_ms),
+                                    method=method.name, url=url, status=http_response.status_code,
+                                    latency_ms=latency_ms)
             http_response.raise_for_status()
+        except DeadlineExceeded as e:
+            exceeded = e
         except requests.exceptions.HTTPError as e:
             self.__logger.error(
                 "%s: "
@@ -521,37 +1135,65 @@ class RancherConnection:
                 "\r\n\tJSON Payload:\r\n\t%s" % (err_msg, url, json.dumps(json_payload, sort_keys=True, indent=2),
                                                  format(e)))
             response = requests.exceptions.HTTPError(e)
+        except requests.exceptions.Timeout as e:
+            self.__logger.error("%s: Rancher did not respond within %s seconds (URL: %s)." % (err_msg, timeout[1], url))
+            response = None
+        except requests.exceptions.ConnectionError as e:
+            self.__logger.error("%s: Unable to connect to Rancher (URL: %s): %s" % (err_msg, url, format(e)))
+            response = None
         else:
-            self.__logger.trace("JSON response cached", json.dumps(http_response.json(), sort_keys=True, indent=2))
-            try:
-                tree = Tree(http_response.json())
-                self.__logger.trace("Query", object_path_query)
-                response = tree.execute(object_path_query)
-                self.__logger.trace("Response cached", json.dumps(response, sort_keys=True, indent=2))
-                if response is not None and isinstance(response, int):
-                    self.__logger.trace("Response is an integer")
-                elif response is not None and len(response) < 1:
+            if conditional and polled is not None and (http_response.status_code == 304 or
+                                                       http_response.content == polled.content):
+                self.__logger.trace("Not modified", url)
+                with self.__cache_lock:
+                    if (url, object_path_query) in self.__polled:
+                        self.__polled.move_to_end((url, object_path_query))
+                response = polled.response
+            else:
+                try:
+                    # decode the body exactly once; only pretty-print it when it is actually going to be logged
+                    payload = self.__codec.loads(http_response.content)
+                    if self.__logger.level >= LogLevel.TRACE:
+                        self.__logger.trace("JSON response cached", json.dumps(payload, sort_keys=True, indent=2))
+                    tree = Tree(payload)
+                    self.__logger.trace("Query", object_path_query)
+                    response = tree.execute(object_path_query)
+                    if self.__logger.level >= LogLevel.TRACE:
+                        self.__logger.trace("Response cached", json.dumps(response, sort_keys=True, indent=2))
+                    if response is not None and isinstance(response, int):
+                        self.__logger.trace("Response is an integer")
+                    elif response is not None and len(response) < 1:
+                        response = None
+                    if build is not None and response is not None:
+                        response = build(response)
+                except TypeError as te:
+                    self.__logger.error("TypeError: %s" % format(te))
+                    self.__logger.trace_dump()
+                    response = None
+                except AttributeError as e:
+                    self.__logger.error("AttributeError: %s" % format(e))
+                    self.__logger.trace_dump()
+                    response = None
+                except StopIteration as e:
+                    self.__logger.error("StopIteration: %s" % format(e))
+                    self.__logger.trace_dump()
+                    response = None
+                except SyntaxError as e:
+                    self.__logger.error("SyntaxError: %s" % format(e))
+                    self.__logger.trace_dump()
+                    response = None
+                except Exception as ex:
+                    self.__logger.error("Unhandled Exception: %s" % format(type(ex)))
+                    self.__logger.trace_dump()
                     response = None
-            except TypeError as te:
-                self.__logger.error("TypeError: %s" % format(te))
-                self.__logger.trace_dump()
-                response = None
-            except AttributeError as e:
-                self.__logger.error("AttributeError: %s" % format(e))
-                self.__logger.trace_dump()
-                response = None
-            except StopIteration as e:
-                self.__logger.error("StopIteration: %s" % format(e))
-                self.__logger.trace_dump()
-                response = None
-            except SyntaxError as e:
-                self.__logger.error("SyntaxError: %s" % format(e))
-                self.__logger.trace_dump()
-                response = None
-            except Exception as ex:
-                self.__logger.error("Unhandled Exception: %s" % format(type(ex)))
-                self.__logger.trace_dump()
-                response = None
+                if conditional and response is not None:
+                    with self.__cache_lock:
+                        self.__polled[(url, object_path_query)] = _PolledResponse(
+                            http_response.headers.get('ETag'), http_response.content, response)
+                        self.__polled.move_to_end((url, object_path_query))
+                        if len(self.__polled) > POLLED_RESPONSES:
+                            self.__polled.popitem(last=False)
         finally:
-            self.__session.close()
+            if exceeded is not None:
+                raise DeadlineExceeded("%s %s" % (format(exceeded), err_msg))
             return response
@@ -0,0 +1,141 @@
+import sys
+import zlib
+
+from .JsonCodec import get_codec
+
+
+def _intern(value):
+    """Interns strings that repeat across resources (ids, states, image names), so they are stored once."""
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def _intern_keys(values):
+    return {_intern(name): value for name, value in (values or {}).items()}
+
+
+class _Resource:
+    """
+    A compact record of a Rancher API resource. The fields ranchertool uses are decoded into slots; everything else is
+    kept as one compressed JSON document (mostly links and action URLs, which compress well), decoded only when
+    resource() asks for the whole resource again. Records hold no references to the response they were built from, so
+    caches of thousands of them stay small.
+    """
+    __slots__ = ('_codec', '_rest')
+
+    # API field -> slot, for the fields that are decoded right away
+    FIELDS = {}
+
+    def __init__(self, resource, codec=None):
+        """
+        :param resource: The resource as decoded from the API.
+        :param codec: The JsonCodec to keep the remaining fields with. Defaults to the fastest one installed.
+        """
+        self._codec = get_codec(codec)
+        for field, slot in self.FIELDS.items():
+            setattr(self, slot, self._decode(field, resource.get(field)))
+        rest = {field: value for field, value in resource.items() if field not in self.FIELDS}
+        self._rest = zlib.compress(self._codec.dumps(rest), 1) if rest else None
+
+    def _decode(self, field, value):
+        return _intern(value)
+
+    def _encode(self, field, value):
+        return value
+
+    def resource(self):
+        """Returns the whole resource as a new dict, as it was received."""
+        resource = self._codec.loads(zlib.decompress(self._rest)) if self._rest is not None else {}
+        for field, slot in self.FIELDS.items():
+            value = self._encode(field, getattr(self, slot))
+            if value is not None:
+                resource[field] = value
+        return resource
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(getattr(self, slot) == getattr(other, slot)
+                                                 for slot in ('_rest',) + tuple(self.FIELDS.values()))
+
+    def __hash__(self):
+        return hash((type(self), getattr(self, 'id', None) or getattr(self, 'name', None)))
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join('%s=%r' % (slot, getattr(self, slot))
+                                                          for slot in ('id', 'name') if hasattr(self, slot)))
+
+
+class LaunchConfig(_Resource):
+    """The (primary or sidekick) launch config of a service."""
+    __slots__ = ('name', 'image_uuid', 'labels', 'environment')
+
+    FIELDS = {'name': 'name', 'imageUuid': 'image_uuid', 'labels': 'labels', 'environment': 'environment'}
+
+    def _decode(self, field, value):
+        if field in ('labels', 'environment'):
+            return _intern_keys(value)
+        return _intern(value)
+
+    def _encode(self, field, value):
+        if field in ('labels', 'environment'):
+            return dict(value) if value else None
+        return value
+
+    @property
+    def image(self):
+        """The image without Rancher's 'docker:' prefix, or None."""
+        if not self.image_uuid:
+            return None
+        return self.image_uuid[len('docker:'):] if self.image_uuid.startswith('docker:') else self.image_uuid
+
+
+class Service(_Resource):
+    """
+    A service resource. launch_config and secondary_launch_configs are LaunchConfigs; links maps the names of linked
+    services to their ids.
+    """
+    __slots__ = ('id', 'name', 'stack_id', 'state', 'health_state', 'scale', 'launch_config',
+                 'secondary_launch_configs', 'links')
+
+    FIELDS = {'id': 'id', 'name': 'name', 'stackId': 'stack_id', 'state': 'state', 'healthState': 'health_state',
+              'scale': 'scale', 'launchConfig': 'launch_config', 'secondaryLaunchConfigs': 'secondary_launch_configs',
+              'linkedServices': 'links'}
+
+    def _decode(self, field, value):
+        if field == 'launchConfig':
+            return LaunchConfig(value or {}, self._codec)
+        if field == 'secondaryLaunchConfigs':
+            return tuple(LaunchConfig(config, self._codec) for config in value or ())
+        if field == 'linkedServices':
+            return _intern_keys(value)
+        return _intern(value)
+
+    def _encode(self, field, value):
+        if field == 'launchConfig':
+            return value.resource() or None
+        if field == 'secondaryLaunchConfigs':
+            return [config.resource() for config in value]
+        if field == 'linkedServices':
+            return dict(value) if value else None
+        return value
+
+    def sidekick(self, name):
+        """Returns the secondary launch config with the given name, or None."""
+        return next((config for config in self.secondary_launch_configs if config.name == name), None)
+
+    @staticmethod
+    def for_api(api_version):
+        """The Service record class for an API version: v1 services refer to their stack as 'environmentId'."""
+        return V1Service if api_version == 'v1' else Service
+
+
+class V1Service(Service):
+    """A service resource of API v1, whose stack (an 'environment' in v1) is its environmentId."""
+    __slots__ = ()
+
+    FIELDS = {('environmentId' if field == 'stackId' else field): slot for field, slot in Service.FIELDS.items()}
+
+
+class Stack(_Resource):
+    """A stack (an 'environment' in API v1) resource."""
+    __slots__ = ('id', 'name', 'state', 'health_state')
+
+    FIELDS = {'id': 'id', 'name': 'name', 'state': 'state', 'healthState': 'health_state'}
@@ -0,0 +1,164 @@
+import copy
+from enum import Enum
+
+from .Logger import Logger, LogLevel
+
+
+class ServiceState(Enum):
+    """The service states ranchertool drives a service through."""
+    INACTIVE = 'inactive'
+    ACTIVATING = 'activating'
+    ACTIVE = 'active'
+    UPGRADING = 'upgrading'
+    UPGRADED = 'upgraded'
+    FINISHING = 'finishing-upgrade'
+    ROLLING_BACK = 'rolling-back'
+
+    @classmethod
+    def of(cls, value):
+        """Maps a state reported by Rancher to a ServiceState, or None for states we don't drive."""
+        try:
+            return cls(value)
+        except ValueError:
+            return None
+
+
+# action -> (states the action may be started from, transitional state, state the service settles in)
+TRANSITIONS = {
+    'activate': ({ServiceState.INACTIVE}, ServiceState.ACTIVATING, ServiceState.ACTIVE),
+    'upgrade': ({ServiceState.ACTIVE, ServiceState.INACTIVE}, ServiceState.UPGRADING, ServiceState.UPGRADED),
+    'finishupgrade': ({ServiceState.UPGRADED}, ServiceState.FINISHING, ServiceState.ACTIVE),
+    'rollback': ({ServiceState.UPGRADING, ServiceState.UPGRADED}, ServiceState.ROLLING_BACK, ServiceState.ACTIVE),
+}
+
+
+class ServiceLifecycle:
+    """
+    Drives one service through activate/upgrade/finish/rollback while tracking the last state Rancher reported.
+
+    Every response that carries the service (the lookup, action responses and polls) updates the last observed state,
+    so the lifecycle only polls Rancher while a transition it started is still pending. Waiting for a state the
+    service is already known to be in costs no request at all.
+    """
+
+    def __init__(self, connection, target, log_level=LogLevel.INFO, poll_interval=2, service=None):
+        """
+        :param connection: The RancherConnection to issue requests through.
+        :param target: The resolved ServiceTarget to operate on.
+        :param service: The service resource, if it was just fetched. Counts as the first observation.
+        """
+        self.__logger = Logger(log_level, 'ServiceLifecycle').bind(service=target.reference())
+        self.__connection = connection
+        self.__target = target
+        self.__poll_interval = poll_interval
+        self.__service = None
+        self.__state = None
+        self.__pending = None
+        self.__record(service)
+
+    @property
+    def target(self):
+        return self.__target
+
+    @property
+    def state(self):
+        """The last observed ServiceState (None if never observed or not a state we drive)."""
+        return self.__state
+
+    @property
+    def pending(self):
+        """The state the service is expected to settle in, or None if no transition is pending."""
+        return self.__pending
+
+    @property
+    def scale(self):
+        """The service's scale as of the last observation (None if never observed)."""
+        return self.__service.get('scale') if self.__service is not None else None
+
+    def observe(self):
+        """Fetches the service and returns its current state."""
+        self.__record(self.__connection.get_service(target=self.__target))
+        return self.__state
+
+    def launch_config(self, secondary=False):
+        """Returns a copy of the service's (secondary) launch config, as of the last observation."""
+        if self.__service is None:
+            self.observe()
+        if self.__service is None:
+            return None
+        return copy.deepcopy(self.__service.get('secondaryLaunchConfigs' if secondary else 'launchConfig'))
+
+    def wait_until(self, state, timeout=None):
+        """
+        Waits until the service reaches the given state. Returns immediately when the service was last observed in
+        that state and no transition is pending.
+        """
+        state = ServiceState(state)
+        if self.__state is state and self.__pending is None:
+            return True
+        deadline = self.__connection.get_deadline()
+        timeout = deadline.cap(self.__connection.get_operation_timeout() if timeout is None else timeout)
+        elapsed = 0
+        while self.observe() is not state:
+            if elapsed >= timeout:
+                self.__logger.error("Waiting for container timed out")
+                return False
+            self.__logger.trace("Waiting for state to be %s...." % state.value)
+            interval = min(self.__poll_interval, timeout - elapsed)
+            self.__connection.get_clock().sleep(interval)
+            elapsed += interval
+            if deadline.expired():
+                self.__logger.error("The deploy deadline of %s seconds was exceeded while waiting for state %s." %
+                                    (deadline.seconds, state.value))
+                return False
+        return True
+
+    def activate(self):
+        return self.__start('activate') and self.wait_until(ServiceState.ACTIVE)
+
+    def upgrade(self, json_payload):
+        """Starts an upgrade. Use wait_until(ServiceState.UPGRADED) to wait for it."""
+        if self.__state is None:
+            self.observe()
+        return self.__start('upgrade', json_payload)
+
+    def finish(self):
+        """Finishes an upgrade, waiting for the upgrade first if it is still in progress."""
+        if self.__state is None:
+            self.observe()
+        if self.__state is ServiceState.ACTIVE and self.__pending is None:
+            self.__logger.warn("Service with id %s is currently Active. No upgrade to finish." %
+                               self.__target.service_id)
+            return True
+        if not self.wait_until(ServiceState.UPGRADED):
+            return False
+        return self.__start('finishupgrade') and self.wait_until(ServiceState.ACTIVE)
+
+    def rollback(self):
+        """Starts a rollback. Use wait_until(ServiceState.ACTIVE) to wait for it."""
+        return self.__start('rollback')
+
+    def __start(self, action, json_payload=None):
+        allowed_from, transitional, final = TRANSITIONS[action]
+        if self.__state is not None and self.__state not in allowed_from and self.__pending is None:
+            self.__logger.warn("Starting '%s' while service with id %s is %s." %
+                               (action, self.__target.service_id, self.__state.value))
+        if action == 'upgrade':
+            response = self.__connection.do_upgrade(json_payload, target=self.__target)
+        else:
+            response = self.__connection.service_action(action, json_payload, target=self.__target)
+        if not isinstance(response, dict):
+            return False
+        self.__record(response)
+        if self.__state is not final:
+            self.__pending = final
+        return True
+
+    def __record(self, service):
+        if not isinstance(service, dict):
+            return
+        self.__service = service
+        self.__state = ServiceState.of(service.get('state'))
+        self.__logger.trace("Observed state %s" % service.get('state'), state=service.get('state'))
+        if self.__pending is not None and self.__state is self.__pending:
+            self.__pending = None
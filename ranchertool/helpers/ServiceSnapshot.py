@@ -0,0 +1,93 @@
+import copy
+import json
+import os
+import tempfile
+import time
+from enum import Enum
+from typing import Dict, List, NamedTuple, Optional
+
+SNAPSHOT_VERSION = 1
+
+
+class RollbackStrategy(Enum):
+    """How a service is brought back to its snapshot."""
+    # Rancher's rollback action while the upgrade is still in progress (it restarts the kept containers), re-applying
+    # the snapshot otherwise
+    AUTO = 'auto'
+    # only Rancher's rollback action
+    ACTION = 'action'
+    # always upgrades the service back to the snapshot's launch configs
+    REAPPLY = 'reapply'
+
+
+class ServiceSnapshot(NamedTuple):
+    """
+    The launch configs of a service as they were before an upgrade, so that the service can be brought back to them
+    after a bad deploy, even after the upgrade was finished and Rancher's rollback action is no longer available.
+    Snapshots are taken from the service resource the upgrade is built from, so taking one costs no request.
+    """
+    project_id: str
+    stack_id: str
+    service_id: str
+    stack_name: Optional[str]
+    service_name: Optional[str]
+    launch_config: Dict
+    secondary_launch_configs: List[Dict]
+    scale: int = 1
+    taken_at: float = 0.0
+
+    @classmethod
+    def take(cls, project_id, lifecycle):
+        """Snapshots the service of a ServiceLifecycle as of its last observation."""
+        target = lifecycle.target
+        return cls(project_id, target.stack_id, target.service_id, target.stack_name, target.service_name,
+                   lifecycle.launch_config() or {}, lifecycle.launch_config(True) or [], lifecycle.scale or 1,
+                   round(time.time(), 3))
+
+    def upgrade_payload(self, batch_size=None, batch_interval=0, start_before_stopping=False):
+        """
+        Builds an in-service upgrade back to the snapshot's launch configs.
+
+        :param batch_size: Containers to replace at once. Defaults to all of them, for the fastest recovery.
+        :param batch_interval: Seconds between batches.
+        """
+        return {'inServiceStrategy': {
+            'batchSize': batch_size or self.scale,
+            'intervalMillis': int(batch_interval * 1000),
+            'startFirst': start_before_stopping,
+            'launchConfig': copy.deepcopy(self.launch_config),
+            'secondaryLaunchConfigs': copy.deepcopy(self.secondary_launch_configs),
+        }}
+
+    def reference(self):
+        return '%s/%s' % (self.stack_name or self.stack_id, self.service_name or self.service_id)
+
+    def save(self, path):
+        """Writes the snapshot to a file. The file is replaced atomically, so it is never left half-written."""
+        directory = os.path.dirname(os.path.abspath(path))
+        descriptor, temporary = tempfile.mkstemp(prefix='.snapshot-', dir=directory)
+        try:
+            with os.fdopen(descriptor, 'w') as f:
+                json.dump(dict(self._asdict(), version=SNAPSHOT_VERSION), f, indent=2, sort_keys=True)
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """
+        :raises OSError: if the file can't be read
+        :raises ValueError: if the file is not a service snapshot
+        """
+        with open(path) as f:
+            try:
+                fields = json.load(f)
+            except ValueError as e:
+                raise ValueError("'%s' is not a service snapshot: %s" % (path, format(e)))
+        if not isinstance(fields, dict) or fields.pop('version', None) != SNAPSHOT_VERSION:
+            raise ValueError("'%s' is not a service snapshot." % path)
+        try:
+            return cls(**fields)
+        except TypeError as e:
+            raise ValueError("'%s' is not a valid service snapshot: %s" % (path, format(e)))
@@ -0,0 +1,44 @@
+from types import MappingProxyType
+from typing import Mapping, NamedTuple, Optional, Tuple
+
+_EMPTY = MappingProxyType({})
+
+
+class ServiceTarget(NamedTuple):
+    """
+    An immutable description of the stack/service a single operation acts on.
+
+    Targets hold everything that used to live on RancherConnection per service (names, resolved ids, labels,
+    variables and service links), so one connection can drive any number of targets from any number of threads.
+    Use the with_* methods (or _replace) to derive a new target instead of changing an existing one.
+    """
+    stack_name: Optional[str] = None
+    service_name: Optional[str] = None
+    stack_id: Optional[str] = None
+    service_id: Optional[str] = None
+    labels: Mapping = _EMPTY
+    variables: Mapping = _EMPTY
+    service_links: Tuple = ()
+
+    def with_labels(self, labels):
+        merged = dict(self.labels)
+        merged.update(labels or {})
+        return self._replace(labels=MappingProxyType(merged))
+
+    def with_variables(self, variables):
+        merged = dict(self.variables)
+        merged.update(variables or {})
+        return self._replace(variables=MappingProxyType(merged))
+
+    def with_service_links(self, service_links):
+        """
+        :param service_links: An iterable of (<local-name>, <service-id>) pairs
+        """
+        return self._replace(service_links=self.service_links + tuple(tuple(link) for link in service_links or ()))
+
+    def service_links_payload(self):
+        """Returns the service links in the format expected by Rancher's 'setservicelinks' action."""
+        return {'serviceLinks': [{'name': name, 'serviceId': service_id} for name, service_id in self.service_links]}
+
+    def reference(self):
+        return '%s/%s' % (self.stack_name, self.service_name)
@@ -0,0 +1,63 @@
+import itertools
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """
+    Coalesces identical calls that overlap in time: the first caller of a key makes the call, and callers asking for
+    the same key while it is in flight wait for it and get its result (or exception) as well. Nothing is remembered
+    once the call has returned, so a later caller always makes a call of its own.
+
+    Every call is numbered as it starts (see started()). A caller that must see the effects of something it did, e.g.
+    a write, passes the number taken after doing it as `after`, and only joins a call that started later.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__calls = {}
+        self.__numbers = itertools.count(1)
+        self.__started = 0
+        # how many callers got the result of another caller's call instead of making their own
+        self.coalesced = 0
+
+    def started(self):
+        """The number of the last call started: every call started from now on gets a higher one."""
+        with self.__lock:
+            return self.__started
+
+    def do(self, key, call, after=0, timeout=None):
+        """
+        Calls call(), unless a call for the same key that started after call number `after` is in flight: then waits
+        for that one instead.
+
+        :param timeout: How long to wait for another caller's call, in seconds. None waits for as long as it takes.
+        :return: What the call returned; raises what it raised
+        :raises concurrent.futures.TimeoutError: if the call waited for took longer than the timeout
+        """
+        with self.__lock:
+            flight = self.__calls.get(key)
+            leader = flight is None or flight[0] <= after
+            if leader:
+                self.__started = next(self.__numbers)
+                # later callers join this call rather than an older one
+                flight = self.__calls[key] = (self.__started, Future())
+            else:
+                self.coalesced += 1
+        future = flight[1]
+        if not leader:
+            return future.result(timeout)
+        try:
+            result = call()
+        except BaseException as e:
+            self.__land(key, flight)
+            future.set_exception(e)
+            raise
+        self.__land(key, flight)
+        future.set_result(result)
+        return result
+
+    def __land(self, key, flight):
+        with self.__lock:
+            if self.__calls.get(key) is flight:
+                del self.__calls[key]
@@ -1,4 +1,19 @@
 import sys
+from .Cassette import Cassette, RecordingTransport, ReplayTransport
+from .Clock import Clock, VirtualClock
+from .Deadline import Deadline
+from .DeployHandle import DeployHandle
+from .Errors import RancherToolError, ConfigurationError, RancherApiError, NotFoundError, DeadlineExceeded, \
+    UpgradeFailed
+from .Http2Transport import Http2Transport
+from .Inventory import Inventory
+from .JsonCodec import JsonCodec, available_codecs, get_codec
 from .Logger import Logger, LogLevel
+from .Profiler import SamplingProfiler
 from .RancherConnection import RancherConnection
+from .Resources import LaunchConfig, Service, Stack
+from .ServiceLifecycle import ServiceLifecycle, ServiceState
+from .ServiceSnapshot import RollbackStrategy, ServiceSnapshot
+from .ServiceTarget import ServiceTarget
+from .SingleFlight import SingleFlight
 sys.path.append('.')
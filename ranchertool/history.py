@@ -0,0 +1,249 @@
+"""
+A local history of deploy timings, so that services getting slower over time are noticed.
+
+Every recorded run stores its outcome, its total duration and request count, and the duration and request count of each
+of its phases (discovery, pull, upgrade, wait, finish, ...) in a SQLite file:
+
+    with DeployHistory('deploys.db') as history:
+        history.record(deploy(connection, 'web', 'api', image='registry.example.com/web/api:42'))
+        for regression in history.regressions('web/api'):
+            print(regression.run.started, regression.ratio)
+
+A run is a regression when it took significantly longer than the median of the service's previous runs with the same
+outcome (its baseline).
+"""
+import sqlite3
+import threading
+import time
+from statistics import median
+from typing import Dict, NamedTuple, Optional
+
+from .helpers import ConfigurationError
+
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    service TEXT NOT NULL,
+    started REAL NOT NULL,
+    outcome TEXT NOT NULL,
+    duration REAL NOT NULL,
+    requests INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS runs_by_service ON runs (service, started);
+CREATE TABLE IF NOT EXISTS phases (
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    phase TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    requests INTEGER NOT NULL,
+    PRIMARY KEY (run_id, phase)
+);
+"""
+
+FAILED = 'failed'
+
+
+class HistoryRun(NamedTuple):
+    """One recorded deploy."""
+    id: int
+    service: str
+    started: float
+    outcome: str
+    duration: float
+    requests: int
+    timings: Dict[str, float]
+    phase_requests: Dict[str, int]
+
+
+class ServiceStats(NamedTuple):
+    """Duration percentiles of a service's runs with the same outcome."""
+    service: str
+    outcome: str
+    runs: int
+    p50: float
+    p90: float
+    p99: float
+    max: float
+    requests: float
+    phases: Dict[str, Dict[str, float]]
+
+    def as_dict(self):
+        return {
+            'service': self.service, 'outcome': self.outcome, 'runs': self.runs, 'p50': round(self.p50, 3),
+            'p90': round(self.p90, 3), 'p99': round(self.p99, 3), 'max': round(self.max, 3),
+            'requests': self.requests,
+            'phases': {phase: {key: round(value, 3) for key, value in values.items()}
+                       for phase, values in self.phases.items()},
+        }
+
+
+class Regression(NamedTuple):
+    """A run that took significantly longer than its baseline, with the phase that slowed down the most."""
+    run: HistoryRun
+    baseline: float
+    phase: Optional[str]
+    phase_baseline: Optional[float]
+
+    @property
+    def ratio(self):
+        return self.run.duration / self.baseline if self.baseline else float('inf')
+
+    def as_dict(self):
+        return {
+            'id': self.run.id, 'service': self.run.service,
+            'started': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.run.started)),
+            'outcome': self.run.outcome, 'duration': round(self.run.duration, 3), 'baseline': round(self.baseline, 3),
+            'ratio': round(self.ratio, 2), 'phase': self.phase,
+            'phase_duration': round(self.run.timings[self.phase], 3) if self.phase else None,
+            'phase_baseline': round(self.phase_baseline, 3) if self.phase else None,
+        }
+
+
+class DeployHistory:
+    """
+    The timing history of deploys, stored in a SQLite file. A DeployHistory can be shared between threads, and
+    several processes (e.g. concurrent CI jobs) can record into the same file.
+    """
+
+    def __init__(self, path):
+        """
+        :raises ConfigurationError: if the file is not a deploy history
+        """
+        self.__lock = threading.Lock()
+        try:
+            self.__db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+            with self.__db:
+                version = self.__db.execute('PRAGMA user_version').fetchone()[0]
+                if version > SCHEMA_VERSION:
+                    raise ConfigurationError("The deploy history '%s' was written by a newer version of ranchertool."
+                                             % path)
+                self.__db.executescript(SCHEMA)
+                self.__db.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+        except sqlite3.Error as e:
+            raise ConfigurationError("Unable to open the deploy history '%s': %s" % (path, format(e)))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.__db.close()
+
+    def record(self, result, failed=False, started=None):
+        """
+        Adds a run.
+
+        :param result: The DeployResult of the run. For a failed deploy, the result of the RancherToolError.
+        :param failed: Whether the deploy failed.
+        :param started: When the run started (seconds since the epoch). Defaults to its duration ago.
+        :return: The id of the run
+        """
+        service = '%s/%s' % (result.stack_name, result.service_name) if result.service_name else result.stack_name
+        outcome = FAILED if failed or result.outcome is None else result.outcome.value
+        started = time.time() - result.duration if started is None else started
+        with self.__lock, self.__db:
+            run_id = self.__db.execute(
+                'INSERT INTO runs (service, started, outcome, duration, requests) VALUES (?, ?, ?, ?, ?)',
+                (service, started, outcome, result.duration, result.request_count)).lastrowid
+            self.__db.executemany(
+                'INSERT INTO phases (run_id, phase, seconds, requests) VALUES (?, ?, ?, ?)',
+                [(run_id, phase, seconds, result.requests.get(phase, 0)) for phase, seconds in result.timings.items()])
+        return run_id
+
+    def runs(self, service=None, since=None):
+        """
+        :param service: Only the runs of this service ('<stack>/<service>', or '<stack>' for compose runs).
+        :param since: Only the runs started after this time (seconds since the epoch).
+        :return: HistoryRuns, oldest first
+        """
+        conditions, parameters = [], []
+        if service:
+            conditions.append('service = ?')
+            parameters.append(service)
+        if since:
+            conditions.append('started >= ?')
+            parameters.append(since)
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+        with self.__lock:
+            rows = self.__db.execute('SELECT id, service, started, outcome, duration, requests FROM runs%s '
+                                     'ORDER BY started, id' % where, parameters).fetchall()
+            phases = self.__db.execute('SELECT run_id, phase, seconds, requests FROM phases WHERE run_id IN '
+                                       '(SELECT id FROM runs%s)' % where, parameters).fetchall()
+        timings, requests = {}, {}
+        for run_id, phase, seconds, count in phases:
+            timings.setdefault(run_id, {})[phase] = seconds
+            requests.setdefault(run_id, {})[phase] = count
+        return [HistoryRun(*row, timings.get(row[0], {}), requests.get(row[0], {})) for row in rows]
+
+    def stats(self, service=None, since=None):
+        """
+        :return: ServiceStats for every service and outcome, with the percentiles of the total and phase durations
+        """
+        groups = {}
+        for run in self.runs(service, since):
+            groups.setdefault((run.service, run.outcome), []).append(run)
+        stats = []
+        for (name, outcome), runs in sorted(groups.items()):
+            durations = [run.duration for run in runs]
+            phases = {}
+            for phase in dict.fromkeys(phase for run in runs for phase in run.timings):
+                seconds = [run.timings[phase] for run in runs if phase in run.timings]
+                phases[phase] = {'p50': percentile(seconds, 50), 'p90': percentile(seconds, 90)}
+            stats.append(ServiceStats(name, outcome, len(runs), percentile(durations, 50), percentile(durations, 90),
+                                      percentile(durations, 99), max(durations),
+                                      median(run.requests for run in runs), phases))
+        return stats
+
+    def regressions(self, service=None, since=None, baseline_runs=20, min_baseline_runs=5, threshold=1.5,
+                    min_slowdown=1.0):
+        """
+        Finds the runs that were significantly slower than their baseline: the median duration of the service's
+        previous baseline_runs runs with the same outcome. Failed runs are neither flagged nor part of baselines.
+
+        :param since: Only flag the runs started after this time. Earlier runs still count towards baselines.
+        :param min_baseline_runs: Runs with fewer previous runs than this are not flagged.
+        :param threshold: How many times longer than its baseline a run has to take to be flagged.
+        :param min_slowdown: How many seconds longer than its baseline a run has to take to be flagged, so that
+                             jitter on very short deploys isn't reported.
+        :return: Regressions, oldest first
+        """
+        previous = {}
+        regressions = []
+        for run in self.runs(service):
+            if run.outcome == FAILED:
+                continue
+            history = previous.setdefault((run.service, run.outcome), [])
+            baseline_window = history[-baseline_runs:]
+            if len(baseline_window) >= min_baseline_runs and (not since or run.started >= since):
+                baseline = median(earlier.duration for earlier in baseline_window)
+                if run.duration > baseline * threshold and run.duration - baseline >= min_slowdown:
+                    regressions.append(Regression(run, baseline, *_slowest_phase(run, baseline_window)))
+            history.append(run)
+        return regressions
+
+
+def percentile(values, percent):
+    """The percentile of values, interpolated linearly between the closest ranks."""
+    values = sorted(values)
+    if not values:
+        return None
+    rank = (len(values) - 1) * percent / 100.0
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+
+def _slowest_phase(run, baseline_window):
+    """The phase of the run that took the most time longer than its baseline, and that baseline."""
+    slowest = (None, None)
+    slowdown = 0.0
+    for phase, seconds in run.timings.items():
+        earlier = [previous.timings[phase] for previous in baseline_window if phase in previous.timings]
+        baseline = median(earlier) if earlier else 0.0
+        if seconds - baseline > slowdown:
+            slowest = (phase, baseline)
+            slowdown = seconds - baseline
+    return slowest
@@ -0,0 +1,335 @@
+"""
+Keeping the services of an environment in line with a directory of service definitions (e.g. a Git checkout).
+
+Every *.json file of the directory holds one service definition, a list of them or {"services": [...]}. A definition
+names a stack and a service and sets the options of api.deploy():
+
+    {"stack": "web", "service": "api", "image": "acme/api:42", "labels": {"team": "web"},
+     "variables": {"MODE": "prod"}, "new_sidekick_images": {"proxy": "acme/proxy:7"}}
+
+Each reconcile cycle looks every defined service up with a single (conditional) request and upgrades only the services
+that drifted: either their definition changed since it was last applied (its hash differs from the one in the state
+file), or their launch config no longer matches it (image, labels, variables or sidekick images). Cycles in which
+nothing changed cost one request, answered with '304 Not Modified'.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional
+
+from . import api
+from .helpers import ConfigurationError, LogLevel, Logger, RancherToolError
+from .release import DEPLOY_OPTIONS
+
+STATE_VERSION = 1
+
+# the service states a service can be upgraded from; others mean a transition is in progress
+SETTLED_STATES = ('active', 'inactive', 'upgraded')
+
+
+class ServiceDefinition(NamedTuple):
+    """The desired state of one service, with the hash it is tracked by."""
+    stack_name: str
+    service_name: str
+    options: Dict
+    digest: str
+    path: str
+
+    @property
+    def name(self):
+        return '%s/%s' % (self.stack_name, self.service_name)
+
+
+class ReconcileOutcome(NamedTuple):
+    """
+    What a cycle did with one service: 'in-sync', 'busy' (in a transition), 'missing', 'drifted' (in a dry run),
+    'upgraded', 'created' or 'failed'.
+    """
+    definition: ServiceDefinition
+    action: str
+    reasons: List[str] = []
+    result: Optional[api.DeployResult] = None
+    error: Optional[str] = None
+
+    @property
+    def changed(self):
+        return self.action in ('upgraded', 'created')
+
+
+class ReconcileReport(NamedTuple):
+    outcomes: List[ReconcileOutcome]
+
+    @property
+    def succeeded(self):
+        return not self.failed()
+
+    def failed(self):
+        return [outcome for outcome in self.outcomes if outcome.action in ('failed', 'missing')]
+
+    def changed(self):
+        return [outcome for outcome in self.outcomes if outcome.changed]
+
+    def as_dicts(self):
+        return [{
+            'service': outcome.definition.name,
+            'action': outcome.action,
+            'reason': '; '.join(outcome.reasons) or None,
+            'duration': round(outcome.result.duration, 3) if outcome.result else None,
+            'error': outcome.error,
+        } for outcome in self.outcomes]
+
+
+class DefinitionDirectory:
+    """
+    The service definitions of a directory. load() only parses the files that were added or changed since the last
+    call (by modification time and size), so polling a large directory every cycle is cheap.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.__files = {}
+
+    def load(self):
+        """
+        :return: The ServiceDefinitions of all files, ordered by file name
+        :raises ConfigurationError: if the directory can't be read, a file is not a valid definition or a service is
+                                    defined more than once
+        """
+        try:
+            names = sorted(name for name in os.listdir(self.path) if name.endswith('.json'))
+        except OSError as e:
+            raise ConfigurationError("Unable to read the service definitions in '%s': %s" % (self.path, format(e)))
+        files = {}
+        for name in names:
+            path = os.path.join(self.path, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # removed since listing the directory
+            signature = (stat.st_mtime_ns, stat.st_size)
+            cached = self.__files.get(path)
+            if cached is None or cached[0] != signature:
+                cached = (signature, _read_definitions(path))
+            files[path] = cached
+        self.__files = files
+
+        definitions = [definition for signature, file_definitions in files.values()
+                       for definition in file_definitions]
+        seen = {}
+        for definition in definitions:
+            if definition.name in seen:
+                raise ConfigurationError("%s is defined in both '%s' and '%s'." %
+                                         (definition.name, seen[definition.name], definition.path))
+            seen[definition.name] = definition.path
+        return definitions
+
+
+class ReconcileState:
+    """
+    The hashes of the definitions that were last applied successfully, kept in a JSON file so that they survive
+    restarts. Without a file, the state only lives as long as the object.
+    """
+
+    def __init__(self, path=None):
+        """
+        :raises ConfigurationError: if the file exists but is not a reconcile state
+        """
+        self.path = path
+        self.applied = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    state = json.load(f)
+                if state.get('version') != STATE_VERSION:
+                    raise ValueError("unknown version %s" % state.get('version'))
+                self.applied = dict(state['services'])
+            except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+                raise ConfigurationError("Unable to read the reconcile state '%s': %s" % (path, format(e)))
+
+    def digest(self, name):
+        return (self.applied.get(name) or {}).get('digest')
+
+    def record(self, definition):
+        self.applied[definition.name] = {'digest': definition.digest, 'applied': round(time.time(), 3)}
+
+    def save(self):
+        """Writes the state file, replacing it atomically."""
+        if not self.path:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        descriptor, temporary = tempfile.mkstemp(prefix='.reconcile-', dir=directory)
+        try:
+            with os.fdopen(descriptor, 'w') as f:
+                json.dump({'version': STATE_VERSION, 'services': self.applied}, f, indent=2, sort_keys=True)
+            os.replace(temporary, self.path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+
+def drift(definition, service):
+    """
+    Compares a definition with a Service record.
+
+    :return: A description of every difference (empty if the service matches its definition)
+    """
+    options = definition.options
+    launch_config = service.launch_config
+    differences = []
+    if options.get('image') and launch_config.image_uuid != 'docker:%s' % options['image']:
+        differences.append('image is %s' % (launch_config.image_uuid or 'unset'))
+    for option, actual in (('labels', launch_config.labels), ('variables', launch_config.environment)):
+        changed = sorted(name for name, value in (options.get(option) or {}).items() if actual.get(name) != value)
+        if changed:
+            differences.append('%s %s differ' % (option, ', '.join(changed)))
+    for name, image in sorted((options.get('new_sidekick_images') or {}).items()):
+        sidekick = service.sidekick(name)
+        if sidekick is None or sidekick.image_uuid != 'docker:%s' % image:
+            differences.append('sidekick %s is %s' % (name, sidekick.image_uuid if sidekick else 'missing'))
+    return differences
+
+
+def reconcile_services(connection, definitions, state=None, max_parallel=4, dry_run=False, log_level=LogLevel.INFO,
+                       **deploy_options):
+    """
+    Runs one reconcile cycle: looks all defined services up with a single request and upgrades the ones that drifted,
+    up to max_parallel at a time. Successfully applied definitions are recorded in the state.
+
+    :param definitions: ServiceDefinitions, e.g. from DefinitionDirectory.load().
+    :param state: A ReconcileState. Without one, every definition counts as changed.
+    :param dry_run: Only reports what would be upgraded.
+    :param deploy_options: Defaults for the api.deploy() options the definitions don't set themselves.
+    :return: A ReconcileReport, in the order of the definitions
+    :raises RancherApiError: if the services could not be looked up
+    """
+    log = Logger(log_level, 'Reconcile')
+    state = state if state is not None else ReconcileState()
+    found = connection.find_services([definition.name for definition in definitions], conditional=True)
+    services = {'%s/%s' % (stack_name, service.name): service for stack_name, service in found}
+
+    outcomes = {}
+    pending = []
+    for definition in definitions:
+        service = services.get(definition.name)
+        if service is None:
+            if definition.options.get('create_service'):
+                pending.append((definition, None, ['service does not exist']))
+            else:
+                outcomes[definition.name] = ReconcileOutcome(definition, 'missing',
+                                                             error='The service does not exist.')
+            continue
+        if service.state not in SETTLED_STATES:
+            outcomes[definition.name] = ReconcileOutcome(definition, 'busy', ['service is %s' % service.state])
+            continue
+        reasons = drift(definition, service)
+        if state.digest(definition.name) != definition.digest:
+            reasons.insert(0, 'definition changed')
+        if reasons:
+            pending.append((definition, service, reasons))
+        else:
+            outcomes[definition.name] = ReconcileOutcome(definition, 'in-sync')
+
+    def apply(definition, service, reasons):
+        log.info("Reconciling %s: %s." % (definition.name, '; '.join(reasons)))
+        try:
+            # upgrade the very service that was found drifted, not whatever the name resolves to in the caches
+            result = api.deploy(connection, definition.stack_name, definition.service_name, wait=True, finish=True,
+                                log_level=log_level, service_id=service.id if service is not None else None,
+                                **dict(deploy_options, **definition.options))
+            remaining = _remaining_drift(connection, definition, result.service_id)
+        except RancherToolError as e:
+            log.error("%s: %s" % (definition.name, format(e)))
+            return ReconcileOutcome(definition, 'failed', reasons, e.result, format(e))
+        if remaining:
+            error = "The deploy finished, but the service still differs from its definition: %s." % \
+                    '; '.join(remaining)
+            log.error("%s: %s" % (definition.name, error))
+            return ReconcileOutcome(definition, 'failed', reasons, result, error)
+        state.record(definition)
+        action = 'created' if result.outcome is api.DeployOutcome.CREATED else 'upgraded'
+        return ReconcileOutcome(definition, action, reasons, result)
+
+    if dry_run:
+        for definition, service, reasons in pending:
+            outcomes[definition.name] = ReconcileOutcome(definition, 'drifted', reasons)
+    elif pending:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_parallel, len(pending)))) as pool:
+            for outcome in pool.map(lambda entry: apply(*entry), pending):
+                outcomes[outcome.definition.name] = outcome
+        state.save()
+    return ReconcileReport([outcomes[definition.name] for definition in definitions])
+
+
+def _remaining_drift(connection, definition, service_id):
+    """Looks a service up again after its deploy and returns how it still differs from its definition."""
+    found = [service for stack_name, service in connection.find_services([definition.name])
+             if service.id == service_id]
+    if not found:
+        return ['service %s is gone' % service_id]
+    return drift(definition, found[0])
+
+
+def run_reconcile(connection, directory, state, interval, cycles=None, on_cycle=None, log_level=LogLevel.INFO,
+                  **reconcile_options):
+    """
+    Reconciles a definition directory every interval seconds.
+
+    :param directory: A DefinitionDirectory.
+    :param cycles: Stops after this many cycles. By default, runs until interrupted.
+    :param on_cycle: Called with the ReconcileReport of every cycle (or the RancherToolError that ended it).
+    :param reconcile_options: Passed on to reconcile_services().
+    :return: The report of the last cycle
+    """
+    log = Logger(log_level, 'Reconcile')
+    clock = connection.get_clock()
+    report = None
+    cycle = 0
+    while cycles is None or cycle < cycles:
+        started = clock.monotonic()
+        try:
+            report = reconcile_services(connection, directory.load(), state, log_level=log_level, **reconcile_options)
+        except RancherToolError as e:
+            # a broken definition or an unreachable Rancher server shouldn't end the loop; the next cycle retries
+            log.error(format(e))
+            report = e
+        if on_cycle is not None:
+            on_cycle(report)
+        cycle += 1
+        if cycles is not None and cycle >= cycles:
+            break
+        clock.sleep(max(0.0, interval - (clock.monotonic() - started)))
+    return report
+
+
+def _read_definitions(path):
+    try:
+        with open(path) as f:
+            content = json.load(f)
+    except (OSError, ValueError) as e:
+        raise ConfigurationError("Unable to read the service definition '%s': %s" % (path, format(e)))
+    if isinstance(content, dict):
+        content = content['services'] if 'services' in content else [content]
+    if not isinstance(content, list):
+        raise ConfigurationError("'%s' is not a service definition." % path)
+
+    definitions = []
+    for entry in content:
+        if not isinstance(entry, dict) or not entry.get('stack') or not entry.get('service'):
+            raise ConfigurationError("Every service definition in '%s' needs a 'stack' and a 'service'." % path)
+        unknown = set(entry) - set(DEPLOY_OPTIONS) - {'stack', 'service'}
+        if unknown:
+            raise ConfigurationError("Unknown options for %s/%s in '%s': %s." %
+                                     (entry['stack'], entry['service'], path, ', '.join(sorted(unknown))))
+        for option in ('labels', 'variables', 'new_sidekick_images'):
+            if not isinstance(entry.get(option, {}), dict):
+                raise ConfigurationError("The %s of %s/%s in '%s' must be an object." %
+                                         (option, entry['stack'], entry['service'], path))
+        options = {option: entry[option] for option in DEPLOY_OPTIONS if option in entry}
+        if isinstance(options.get('service_links'), dict):
+            options['service_links'] = sorted(options['service_links'].items())
+        digest = hashlib.sha256(json.dumps(entry, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+        definitions.append(ServiceDefinition(entry['stack'], entry['service'], options, digest, path))
+    return definitions
@@ -0,0 +1,198 @@
+"""
+Releasing several services of an environment in dependency order.
+
+A release plan lists the services to deploy, each with the options of api.deploy(). A service depends on the services
+it links to (when they are part of the plan) and on the ones named in its 'depends_on':
+
+    {
+      "services": [
+        {"stack": "web", "service": "db", "image": "postgres:12"},
+        {"stack": "web", "service": "cache", "image": "redis:6"},
+        {"stack": "web", "service": "api", "image": "acme/api:42", "service_links": {"db": "web/db"},
+         "depends_on": ["web/cache"]}
+      ]
+    }
+
+run_release() deploys every service as soon as all of its dependencies are active, running independent services
+concurrently, so a release takes as long as its longest dependency chain rather than the sum of all deploys.
+"""
+import json
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from . import api
+from .helpers import ConfigurationError, LogLevel, Logger, RancherToolError
+
+# the api.deploy() options a plan entry may set
+DEPLOY_OPTIONS = ('image', 'batch_size', 'batch_interval', 'start_before_stopping', 'rollback', 'sidekicks',
+                  'new_sidekick_images', 'create_stack', 'create_service', 'labels', 'variables', 'service_links',
+                  'pre_pull')
+
+
+class ReleaseStep(NamedTuple):
+    """One service of a release plan."""
+    stack_name: str
+    service_name: str
+    depends_on: Tuple[str, ...] = ()
+    options: Dict = {}
+
+    @property
+    def name(self):
+        return '%s/%s' % (self.stack_name, self.service_name)
+
+
+class ReleaseOutcome(NamedTuple):
+    step: ReleaseStep
+    result: Optional[api.DeployResult] = None
+    error: Optional[str] = None
+    skipped: bool = False
+
+    @property
+    def succeeded(self):
+        return self.result is not None and self.error is None
+
+    def status(self):
+        if self.skipped:
+            return 'skipped'
+        if not self.succeeded:
+            return 'failed'
+        return self.result.outcome.value
+
+
+class ReleaseReport(NamedTuple):
+    """The outcome of every step, in dependency order."""
+    outcomes: List[ReleaseOutcome]
+
+    @property
+    def succeeded(self):
+        return all(outcome.succeeded for outcome in self.outcomes)
+
+    def failed(self):
+        return [outcome for outcome in self.outcomes if not outcome.succeeded and not outcome.skipped]
+
+    def as_dicts(self):
+        rows = []
+        for outcome in self.outcomes:
+            result = outcome.result
+            rows.append({
+                'service': outcome.step.name,
+                'depends_on': list(outcome.step.depends_on),
+                'status': outcome.status(),
+                'service_id': result.service_id if result else None,
+                'duration': round(result.duration, 3) if result else None,
+                'error': outcome.error,
+            })
+        return rows
+
+
+def load_plan(path):
+    """
+    Reads a release plan file.
+
+    :return: A list of ReleaseSteps, in dependency order
+    :raises ConfigurationError: if the file is not a valid plan or its dependencies have a cycle
+    """
+    try:
+        with open(path) as f:
+            definition = json.load(f)
+    except (OSError, ValueError) as e:
+        raise ConfigurationError("Unable to read the release plan '%s': %s" % (path, format(e)))
+    if isinstance(definition, dict):
+        definition = definition.get('services')
+    if not definition:
+        raise ConfigurationError("The release plan '%s' has no services." % path)
+
+    steps = []
+    for entry in definition:
+        if not entry.get('stack') or not entry.get('service'):
+            raise ConfigurationError("Every service of a release plan needs a 'stack' and a 'service'.")
+        unknown = set(entry) - set(DEPLOY_OPTIONS) - {'stack', 'service', 'depends_on'}
+        if unknown:
+            raise ConfigurationError("Unknown options for %s/%s: %s." %
+                                     (entry['stack'], entry['service'], ', '.join(sorted(unknown))))
+        options = {option: entry[option] for option in DEPLOY_OPTIONS if option in entry}
+        if isinstance(options.get('service_links'), dict):
+            options['service_links'] = sorted(options['service_links'].items())
+        steps.append(ReleaseStep(entry['stack'], entry['service'], tuple(entry.get('depends_on', ())), options))
+    return plan(steps)
+
+
+def plan(steps):
+    """
+    Works out the dependencies of each step: its depends_on plus the services of the plan it links to.
+
+    :return: The steps with their complete depends_on, sorted so that every step comes after its dependencies
+    :raises ConfigurationError: if a step depends on a service that isn't in the plan, or the dependencies have a cycle
+    """
+    names = [step.name for step in steps]
+    if len(set(names)) != len(names):
+        raise ConfigurationError("The release plan lists a service more than once.")
+
+    completed = []
+    for step in steps:
+        links = [target for name, target in step.options.get('service_links') or []]
+        links = [target if '/' in target else '%s/%s' % (step.stack_name, target) for target in links]
+        depends_on = list(dict.fromkeys(list(step.depends_on) + [link for link in links if link in names]))
+        missing = [name for name in depends_on if name not in names]
+        if missing:
+            raise ConfigurationError("%s depends on %s, which %s not part of the release." %
+                                     (step.name, ', '.join(missing), 'is' if len(missing) == 1 else 'are'))
+        completed.append(step._replace(depends_on=tuple(depends_on)))
+
+    # Kahn's algorithm, keeping the plan order among steps that are ready at the same time
+    ordered = []
+    remaining = list(completed)
+    while remaining:
+        done = {step.name for step in ordered}
+        ready = [step for step in remaining if all(name in done for name in step.depends_on)]
+        if not ready:
+            raise ConfigurationError("The dependencies of %s form a cycle." %
+                                     ', '.join(step.name for step in remaining))
+        ordered.extend(ready)
+        remaining = [step for step in remaining if step not in ready]
+    return ordered
+
+
+def run_release(connection, steps, max_parallel=4, log_level=LogLevel.INFO, **deploy_options):
+    """
+    Deploys every step once all of its dependencies are done (and so active), running independent steps concurrently.
+    A failed step causes all steps depending on it, directly or not, to be skipped.
+
+    :param steps: ReleaseSteps, as returned by load_plan() or plan().
+    :param deploy_options: Defaults for the api.deploy() options the steps don't set themselves.
+    :return: A ReleaseReport
+    """
+    log = Logger(log_level, 'Release')
+    steps = plan(steps)
+    outcomes = {}
+
+    def deploy(step):
+        options = dict(deploy_options, **step.options)
+        log.info("Deploying %s..." % step.name)
+        try:
+            result = api.deploy(connection, step.stack_name, step.service_name, wait=True, finish=True,
+                                log_level=log_level, **options)
+        except RancherToolError as e:
+            log.error("%s: %s" % (step.name, format(e)))
+            return ReleaseOutcome(step, e.result, format(e))
+        log.info("%s is %s after %.1f seconds." % (step.name, result.outcome.value, result.duration))
+        return ReleaseOutcome(step, result)
+
+    with ThreadPoolExecutor(max_workers=max(1, max_parallel)) as pool:
+        running = {}
+        while len(outcomes) < len(steps):
+            for step in steps:
+                if step.name in outcomes or step.name in running.values():
+                    continue
+                upstream = [outcomes.get(name) for name in step.depends_on]
+                if any(outcome is not None and not outcome.succeeded for outcome in upstream):
+                    log.warn("Skipping %s because a service it depends on failed." % step.name)
+                    outcomes[step.name] = ReleaseOutcome(step, skipped=True)
+                elif all(outcome is not None for outcome in upstream):
+                    running[pool.submit(deploy, step)] = step.name
+            if not running:
+                continue
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                outcomes[running.pop(future)] = future.result()
+    return ReleaseReport([outcomes[step.name] for step in steps])
@@ -15,6 +15,10 @@ setup(name='gitlab-ci-rancher-deploy',
           'colorama',
           'sakstig'
       ],
+      extras_require={
+          'fast': ['orjson'],
+          'http2': ['httpx[http2]']
+      },
       tests_require=[
           'pytest',
           'cli_test_helpers'
@@ -0,0 +1,63 @@
+"""
+Benchmarks decoding and encoding realistic Rancher collections with every installed JSON library, and compares the
+current single decode with the previous way of handling a response (http_response.json() twice, plus pretty-printing
+it for the trace log).
+
+    python -m tests.bench_codec [services] [rounds]
+"""
+import json
+import sys
+import timeit
+
+from ranchertool.helpers import available_codecs
+
+
+def service(index):
+    return {
+        'id': '1s%d' % index, 'type': 'service', 'baseType': 'service', 'name': 'service-%d' % index,
+        'state': 'active', 'healthState': 'healthy', 'accountId': '1a5', 'stackId': '1st%d' % (index % 20),
+        'scale': 3, 'currentScale': 3, 'createIndex': 4, 'kind': 'service', 'startOnCreate': True,
+        'created': '2020-04-22T10:00:00Z', 'createdTS': 1587549600000, 'uuid': 'b3c3ad1e-%012d' % index,
+        'instanceIds': ['1i%d' % (index * 3 + n) for n in range(3)],
+        'links': {'self': 'http://rancher/v2-beta/projects/1a5/services/1s%d' % index,
+                  'instances': 'http://rancher/v2-beta/projects/1a5/services/1s%d/instances' % index},
+        'actions': {action: 'http://rancher/v2-beta/projects/1a5/services/1s%d/?action=%s' % (index, action)
+                    for action in ('upgrade', 'restart', 'update', 'remove', 'deactivate')},
+        'launchConfig': {
+            'imageUuid': 'docker:registry.example.com/acme/service-%d:1.%d' % (index, index), 'kind': 'container',
+            'networkMode': 'managed', 'privileged': False, 'tty': False, 'stdinOpen': False,
+            'environment': {'VARIABLE_%d' % n: 'value-%d' % n for n in range(12)},
+            'labels': {'io.rancher.container.pull_image': 'always', 'commit': '%040x' % index,
+                       'io.rancher.scheduler.affinity:host_label': 'role=worker'},
+            'ports': ['%d:80/tcp' % (8000 + index)], 'dataVolumes': ['/data/%d:/data' % index],
+            'healthCheck': {'port': 80, 'interval': 2000, 'healthyThreshold': 2, 'unhealthyThreshold': 3,
+                            'requestLine': 'GET "/health" "HTTP/1.0"', 'responseTimeout': 2000},
+        },
+        'secondaryLaunchConfigs': [],
+    }
+
+
+def collection(services):
+    return {'type': 'collection', 'resourceType': 'service', 'pagination': {'limit': 1000, 'total': services},
+            'data': [service(index) for index in range(services)]}
+
+
+def main(services=500, rounds=20):
+    body = json.dumps(collection(services)).encode('utf-8')
+    payload = {'inServiceStrategy': {'launchConfig': service(0)['launchConfig'], 'batchSize': 1}}
+    print('Collection of %d services, %.1f kB; %d rounds' % (services, len(body) / 1024, rounds))
+
+    def previous():
+        json.loads(body)
+        json.dumps(json.loads(body), indent=4, sort_keys=True)
+
+    print('  %-8s decode %7.2f ms  (twice, plus pretty-printed for the trace log)' %
+          ('previous', 1000 * timeit.timeit(previous, number=rounds) / rounds))
+    for name, codec in available_codecs().items():
+        decode = timeit.timeit(lambda: codec.loads(body), number=rounds) / rounds
+        encode = timeit.timeit(lambda: codec.dumps(payload), number=rounds * 100) / (rounds * 100)
+        print('  %-8s decode %7.2f ms  encode payload %6.1f us' % (name, 1000 * decode, 1000000 * encode))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,103 @@
+"""
+Benchmarks many concurrent deploys through one RancherConnection over HTTPS, once with the pooled HTTP/1.1 transport
+and once with the HTTP/2 transport, and compares the wall time, the number of TLS connections opened and the request
+latency. The mock servers run in a child process, so that they don't compete with the client for the GIL. Needs
+httpx, h2 and the openssl command.
+
+    python -m tests.bench_http2 [deploys] [latency] [pool size]
+"""
+import contextlib
+import io
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import requests.adapters
+
+import ranchertool
+from ranchertool.helpers import Http2Transport, LogLevel, RancherConnection
+from ranchertool.history import percentile
+from tests.mock_rancher import MockRancher, MockRancherH2Server, MockRancherServer, tls_certificate
+
+# the CA bundle these point to would replace the self-signed certificate passed as ssl_verify
+CA_BUNDLE_VARIABLES = ('REQUESTS_CA_BUNDLE', 'CURL_CA_BUNDLE')
+
+
+class Timed:
+    """Wraps a transport adapter and records how long every request took."""
+
+    def __init__(self, adapter):
+        self.adapter = adapter
+        self.latencies = []
+
+    def send(self, request, **kwargs):
+        sent = time.monotonic()
+        try:
+            return self.adapter.send(request, **kwargs)
+        finally:
+            self.latencies.append(time.monotonic() - sent)
+
+    def close(self):
+        self.adapter.close()
+
+
+def _serve(pipe, protocol, certificate, deploys, latency):
+    rancher = MockRancher(transition_polls=2, latency=latency)
+    stack_id = rancher.add_stack('bench')
+    for index in range(deploys):
+        rancher.add_service(stack_id, 'service-%d' % index, image='acme/app:1')
+    if protocol == 'HTTP/2':
+        server = MockRancherH2Server(certificate, rancher, workers=deploys)
+    else:
+        server = MockRancherServer(rancher, certificate=certificate)
+    with server:
+        pipe.send(server.url)
+        pipe.recv()
+        pipe.send(server.connections)
+
+
+def run(protocol, adapter, deploys, latency, certificate, pool_size):
+    """Deploys to deploys services at once and returns the wall time, the TLS connections and the request latencies."""
+    context = multiprocessing.get_context('spawn')
+    pipe, child_pipe = context.Pipe()
+    server = context.Process(target=_serve, args=(child_pipe, protocol, certificate, deploys, latency), daemon=True)
+    server.start()
+    url = pipe.recv()
+    timed = Timed(adapter)
+    # the Loggers of the deploys print an empty line each
+    with contextlib.redirect_stdout(io.StringIO()), \
+            RancherConnection(url, 'key', 'secret', None, log_level=LogLevel.SILENT, verify_ssl=certificate[0],
+                              pool_size=pool_size, transport=timed) as connection:
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=deploys) as pool:
+            list(pool.map(lambda index: ranchertool.deploy(connection, 'bench', 'service-%d' % index,
+                                                           image='acme/app:2', log_level=LogLevel.SILENT),
+                          range(deploys)))
+        elapsed = time.monotonic() - started
+    pipe.send('done')
+    connections = pipe.recv()
+    server.join()
+    return elapsed, connections, timed.latencies
+
+
+def main(deploys=100, latency=0.02, pool_size=10):
+    print('%d concurrent deploys over HTTPS, %d ms server latency, pool size %d' % (deploys, latency * 1000, pool_size))
+    print('  %-10s %9s %12s %9s %9s %9s' % ('', 'seconds', 'connections', 'requests', 'p50 ms', 'p99 ms'))
+    with tempfile.TemporaryDirectory() as directory, \
+            mock.patch.dict(os.environ, {name: '' for name in CA_BUNDLE_VARIABLES}):
+        certificate = tls_certificate(directory)
+        for protocol, adapter in (
+                ('HTTP/1.1', requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)),
+                ('HTTP/2', Http2Transport(certificate[0], pool_size))):
+            elapsed, connections, latencies = run(protocol, adapter, deploys, latency, certificate, pool_size)
+            print('  %-10s %9.2f %12d %9d %9.1f %9.1f' % (protocol, elapsed, connections, len(latencies),
+                                                         percentile(latencies, 50) * 1000,
+                                                         percentile(latencies, 99) * 1000))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) if n != 1 else float(arg) for n, arg in enumerate(sys.argv[1:])])
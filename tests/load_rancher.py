@@ -0,0 +1,222 @@
+"""
+A load test of the client: runs many deploys at once through RancherConnection against a MockRancherServer with a
+configurable response latency and upgrade duration, and reports throughput, request rate, request latency, the
+duration of every deploy phase (p50/p90/p99/max), CPU time and peak RSS.
+
+The mock server runs in a child process, so CPU time, memory and threads are the client's alone.
+
+    python -m tests.load_rancher --deploys 300 --latency 0.05 --transition-seconds 3
+    python -m tests.load_rancher --deploys 300 --pool-size 300
+    python -m tests.load_rancher --deploys 300 --connection-per-deploy
+"""
+import argparse
+import json
+import multiprocessing
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests.adapters
+
+import ranchertool
+from ranchertool.helpers import LogLevel, RancherConnection, RancherToolError
+from ranchertool.history import percentile
+from tests.mock_rancher import MockRancher, MockRancherServer
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+PERCENTILES = (50, 90, 99)
+
+
+class TimingAdapter(requests.adapters.HTTPAdapter):
+    """A pooled HTTPAdapter that records how long every request took."""
+
+    def __init__(self, pool_size):
+        super().__init__(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.latencies = []
+
+    def send(self, request, **kwargs):
+        sent = time.monotonic()
+        try:
+            return super().send(request, **kwargs)
+        finally:
+            self.latencies.append(time.monotonic() - sent)
+
+
+def run_load(deploys=100, concurrency=None, latency=0.0, transition_seconds=0.0, pool_size=10,
+             connection_per_deploy=False, pre_pull=False):
+    """
+    Upgrades deploys services at once, concurrency at a time (all at once by default).
+
+    :param latency: Seconds the mock server takes to answer each request.
+    :param transition_seconds: Seconds the mock services take to upgrade and to finish upgrading.
+    :param pool_size: The connection pool size of every RancherConnection.
+    :param connection_per_deploy: Gives every deploy its own RancherConnection instead of sharing one.
+    :return: The report, as a dict
+    """
+    server, pipe = _start_server(deploys, latency, transition_seconds)
+    url = pipe.recv()
+    adapters = []
+
+    def connect():
+        adapter = TimingAdapter(pool_size)
+        adapters.append(adapter)
+        return RancherConnection(url, 'key', 'secret', None, log_level=LogLevel.SILENT, pool_size=pool_size,
+                                 operation_timeout=600, transport=adapter)
+
+    shared = None if connection_per_deploy else connect()
+    peak_threads = [threading.active_count()]
+
+    def deploy(index):
+        connection = shared or connect()
+        try:
+            return ranchertool.deploy(connection, 'load', 'service-%d' % index, image='acme/app:2', pre_pull=pre_pull,
+                                      log_level=LogLevel.SILENT)
+        except RancherToolError as e:
+            return e
+        finally:
+            peak_threads[0] = max(peak_threads[0], threading.active_count())
+            if shared is None:
+                connection.close()
+
+    rss_before = _current_rss()
+    cpu_before = _cpu_seconds()
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency or deploys) as pool:
+        results = list(pool.map(deploy, range(deploys)))
+    elapsed = time.monotonic() - started
+    cpu = _cpu_seconds() - cpu_before
+    if shared is not None:
+        shared.close()
+
+    pipe.send('done')
+    server_requests, server_connections, server_bytes = pipe.recv()
+    server.join()
+
+    succeeded = [result for result in results if not isinstance(result, Exception)]
+    latencies = [latency for adapter in adapters for latency in adapter.latencies]
+    phases = {}
+    for result in succeeded:
+        for phase, seconds in result.timings.items():
+            phases.setdefault(phase, []).append(seconds)
+    return {
+        'deploys': deploys,
+        'concurrency': concurrency or deploys,
+        'connections': 'per-deploy' if connection_per_deploy else 'shared',
+        'pool_size': pool_size,
+        'failed': deploys - len(succeeded),
+        'errors': sorted({format(result) for result in results if isinstance(result, Exception)})[:5],
+        'seconds': round(elapsed, 3),
+        'deploys_per_second': round(len(succeeded) / elapsed, 2),
+        'requests': len(latencies),
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'tcp_connections': server_connections,
+        'server_requests': server_requests,
+        'response_kb': round(server_bytes / 1024, 1),
+        'request_latency_ms': _distribution([latency * 1000 for latency in latencies]),
+        'phase_seconds': {phase: _distribution(seconds) for phase, seconds in phases.items()},
+        'cpu_seconds': round(cpu, 3),
+        'cpu_ms_per_deploy': round(1000 * cpu / deploys, 2),
+        'peak_rss_mb': _peak_rss_mb(),
+        'rss_growth_mb': round((_current_rss() - rss_before) / 1024, 1),
+        'peak_threads': peak_threads[0],
+    }
+
+
+def _serve(pipe, services, latency, transition_seconds):
+    rancher = MockRancher(transition_polls=0, latency=latency, transition_seconds=transition_seconds)
+    stack_id = rancher.add_stack('load')
+    for index in range(services):
+        rancher.add_service(stack_id, 'service-%d' % index, image='acme/app:1')
+    with MockRancherServer(rancher) as server:
+        pipe.send(server.url)
+        pipe.recv()
+        pipe.send((len(rancher.request_log()), server.connections, server.bytes_sent))
+
+
+def _start_server(services, latency, transition_seconds):
+    context = multiprocessing.get_context('spawn')
+    pipe, child_pipe = context.Pipe()
+    server = context.Process(target=_serve, args=(child_pipe, services, latency, transition_seconds), daemon=True)
+    server.start()
+    return server, pipe
+
+
+def _distribution(values):
+    if not values:
+        return {}
+    distribution = {'p%d' % percent: round(percentile(values, percent), 3) for percent in PERCENTILES}
+    distribution['max'] = round(max(values), 3)
+    return distribution
+
+
+def _cpu_seconds():
+    return time.process_time()
+
+
+def _peak_rss_mb():
+    """The peak resident set size of this process in MB (None where getrusage is not available)."""
+    if resource is None:
+        return None
+    # ru_maxrss is in bytes on macOS and in kB everywhere else
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 1024 ** 2, 1)
+
+
+def _current_rss():
+    """The resident set size of this process in kB (0 where /proc is not available)."""
+    try:
+        with open('/proc/self/status') as f:
+            return next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+    except (OSError, StopIteration):
+        return 0
+
+
+def _print_report(report):
+    print('%(deploys)d deploys (%(failed)d failed), %(concurrency)d at a time, %(connections)s connections with a '
+          'pool size of %(pool_size)d' % report)
+    for error in report['errors']:
+        print('  error: %s' % error)
+    print('  %.2f s, %.2f deploys/s, %d requests (%.1f/s) over %d TCP connections, %.1f kB of responses' %
+          (report['seconds'], report['deploys_per_second'], report['requests'], report['requests_per_second'],
+           report['tcp_connections'], report['response_kb']))
+    print('  client CPU %.2f s (%.2f ms per deploy), peak RSS %s MB (+%.1f MB), peak threads %d' %
+          (report['cpu_seconds'], report['cpu_ms_per_deploy'],
+           'n/a' if report['peak_rss_mb'] is None else '%.1f' % report['peak_rss_mb'], report['rss_growth_mb'],
+           report['peak_threads']))
+    rows = [('request (ms)', report['request_latency_ms'])]
+    rows += [('%s (s)' % phase, distribution) for phase, distribution in report['phase_seconds'].items()]
+    print('  %-16s %9s %9s %9s %9s' % ('', 'p50', 'p90', 'p99', 'max'))
+    for name, distribution in rows:
+        print('  %-16s %9.3f %9.3f %9.3f %9.3f' % ((name,) + tuple(distribution[key]
+                                                                  for key in ('p50', 'p90', 'p99', 'max'))))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--deploys', type=int, default=100, help='the number of services to upgrade')
+    parser.add_argument('--concurrency', type=int, default=None, help='deploys at a time (default: all)')
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds the server takes per request")
+    parser.add_argument('--transition-seconds', type=float, default=0.0,
+                        help='seconds an upgrade (and finishing it) takes')
+    parser.add_argument('--pool-size', type=int, default=10, help='the connection pool size')
+    parser.add_argument('--connection-per-deploy', action='store_true',
+                        help='gives every deploy its own connection instead of sharing one')
+    parser.add_argument('--pre-pull', action='store_true', help='pre-pulls the image before each upgrade')
+    parser.add_argument('--json', action='store_true', help='prints the report as JSON')
+    args = parser.parse_args(argv)
+    report = run_load(args.deploys, args.concurrency, args.latency, args.transition_seconds, args.pool_size,
+                      args.connection_per_deploy, args.pre_pull)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        _print_report(report)
+    return 1 if report['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
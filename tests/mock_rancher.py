@@ -0,0 +1,620 @@
+"""
+An in-memory stand-in for the parts of the Rancher v1/v2-beta API that ranchertool talks to.
+
+MockRancher holds the resources and answers requests; MockRancherServer serves it over HTTP/1.1 (optionally with TLS)
+on localhost so that RancherConnection can be exercised end to end without a Rancher server, MockRancherH2Server
+serves it over HTTP/2 and MockRancherTransport answers in-process, without any network at all. Every request is
+recorded, which lets tests assert on the exact request sequence of an operation.
+"""
+import hashlib
+import itertools
+import json
+import os
+import queue
+import selectors
+import socket
+import ssl
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlencode, urlsplit, parse_qs
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from ranchertool.helpers.Clock import SYSTEM_CLOCK
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+except ImportError:  # only needed by MockRancherH2Server
+    h2 = None
+
+# state a service passes through after an action, and the state it settles in
+TRANSITIONS = {
+    'upgrade': ('upgrading', 'upgraded'),
+    'finishupgrade': ('finishing-upgrade', 'active'),
+    'rollback': ('rolling-back', 'active'),
+    'activate': ('activating', 'active'),
+    'deactivate': ('deactivating', 'inactive'),
+    'remove': ('removing', 'removed'),
+}
+
+# the stack fields a compose apply sets
+COMPOSE_FIELDS = ('dockerCompose', 'rancherCompose', 'environment')
+
+
+class MockRancher:
+    """The resources of a single Rancher server and the request handling on top of them."""
+
+    def __init__(self, api_version='v2-beta', project_name='Default', transition_polls=1, latency=0,
+                 transition_seconds=0, etags=True, clock=None):
+        """
+        :param api_version: The API version prefix to answer on.
+        :param project_name: The name of the only project (environment).
+        :param transition_polls: How many times a transitional state (e.g. 'upgrading') is reported before a
+                                 service settles in its final state.
+        :param latency: Seconds the HTTP server waits before answering each request.
+        :param transition_seconds: The minimum number of seconds a transitional state lasts, however often it is
+                                   polled.
+        :param etags: Whether GET responses carry an ETag and are answered with '304 Not Modified' when the
+                      If-None-Match header matches it.
+        :param clock: The Clock transitions are timed with and latency is waited on. Defaults to the system's; a
+                      VirtualClock shared with the RancherConnection makes transition_seconds and latency virtual.
+        """
+        self.api_version = api_version
+        # the field services refer to their stack with; stacks are 'environments' in v1
+        self.stack_field = 'environmentId' if api_version == 'v1' else 'stackId'
+        self.transition_polls = transition_polls
+        self.transition_seconds = transition_seconds
+        self.latency = latency
+        self.etags = etags
+        self.clock = clock or SYSTEM_CLOCK
+        # the most resources a listing of all stacks or services returns at once; further pages are linked from
+        # 'pagination.next'
+        self.page_size = None
+        # actions whose transition never completes, e.g. {'upgrade'} for upgrades that hang in 'upgrading' ('pull' for
+        # pull tasks)
+        self.stuck_actions = set()
+        # images whose pull tasks end in the 'error' state
+        self.unpullable_images = set()
+        self.lock = threading.RLock()
+        self.requests = []
+        # the most requests that were being answered at the same time
+        self.peak_in_flight = 0
+        self.__in_flight = 0
+        self.__ids = itertools.count(1)
+        self.project = {'id': '1a1', 'name': project_name, 'type': 'project'}
+        self.stacks = {}
+        self.services = {}
+        self.pull_tasks = {}
+        self.__pending = {}
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Fixtures
+    # ------------------------------------------------------------------------------------------------------------------
+    def add_stack(self, name):
+        with self.lock:
+            stack_id = '1st%d' % next(self.__ids)
+            self.stacks[stack_id] = {'id': stack_id, 'name': name, 'type': 'stack', 'state': 'active'}
+            return stack_id
+
+    def add_service(self, stack_id, name, image='alpine:latest', state='active', secondary_launch_configs=None,
+                    labels=None, environment=None):
+        with self.lock:
+            service_id = '1s%d' % next(self.__ids)
+            self.services[service_id] = {
+                'id': service_id,
+                'name': name,
+                'type': 'service',
+                self.stack_field: stack_id,
+                'state': state,
+                'healthState': 'healthy',
+                'scale': 1,
+                'launchConfig': {
+                    'imageUuid': 'docker:%s' % image,
+                    'labels': dict(labels or {}),
+                    'environment': dict(environment or {}),
+                },
+                'secondaryLaunchConfigs': list(secondary_launch_configs or []),
+                'serviceLinks': [],
+                'upgrade': None,
+            }
+            return service_id
+
+    @contextmanager
+    def serving(self):
+        """Counts a request as in flight while it is answered (see peak_in_flight)."""
+        with self.lock:
+            self.__in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.__in_flight)
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.__in_flight -= 1
+
+    def request_log(self, method=None):
+        with self.lock:
+            return [entry for entry in self.requests if method is None or entry[0] == method]
+
+    def reset_log(self):
+        with self.lock:
+            self.requests = []
+
+    # ------------------------------------------------------------------------------------------------------------------
+    # Request handling
+    # ------------------------------------------------------------------------------------------------------------------
+    def handle(self, method, url, body=None):
+        """
+        Answers a single request.
+
+        :return: A (status code, JSON-serializable payload) pair
+        """
+        parts = urlsplit(url)
+        query = parse_qs(parts.query)
+        path = [segment for segment in parts.path.split('/') if segment]
+        with self.lock:
+            self.requests.append((method, parts.path.rstrip('/') + ('?' + parts.query if parts.query else '')))
+            if not path or path[0] != self.api_version:
+                return 404, {'type': 'error', 'status': 404}
+            path = path[1:]
+            stacks_name = 'environments' if self.api_version == 'v1' else 'stacks'
+
+            if path == ['projects'] and method == 'GET':
+                return 200, self.__collection([self.project])
+            if len(path) < 2 or path[0] != 'projects' or path[1] != self.project['id']:
+                return 404, {'type': 'error', 'status': 404}
+            path = path[2:]
+
+            if path == [stacks_name]:
+                if method == 'GET':
+                    return 200, self.__page(parts.path, query, self.__filter(self.stacks.values(), query))
+                if method == 'POST':
+                    stack_id = self.add_stack(body['name'])
+                    stack = self.stacks[stack_id]
+                    for field in COMPOSE_FIELDS:
+                        if field in body:
+                            stack[field] = body[field]
+                    if body.get('dockerCompose') and body.get('startOnCreate'):
+                        stack['state'] = 'activating'
+                        self.__transition(stack_id, 'active')
+                    return 201, stack
+            if len(path) == 2 and path[0] == stacks_name:
+                stack = self.stacks.get(path[1])
+                if stack is None:
+                    return 404, {'type': 'error', 'status': 404}
+                if method == 'GET':
+                    return 200, self.__observe(stack)
+                if method == 'POST' and 'action' in query:
+                    return self.__stack_action(stack, query['action'][0], body)
+            if len(path) == 3 and path[0] == stacks_name and path[2] == 'services':
+                services = [self.__observe(service) for service in self.services.values()
+                            if service[self.stack_field] == path[1]]
+                if method == 'GET':
+                    return 200, self.__collection(self.__filter(services, query))
+                if method == 'POST':
+                    launch_config = body.get('launchConfig', {})
+                    service_id = self.add_service(path[1], body['name'], state='inactive',
+                                                  labels=launch_config.get('labels'),
+                                                  environment=launch_config.get('environment'))
+                    self.services[service_id]['launchConfig'].update(launch_config)
+                    return 201, self.services[service_id]
+            if path == ['pulltasks'] and method == 'POST':
+                pull_task_id = '1pt%d' % next(self.__ids)
+                self.pull_tasks[pull_task_id] = {'id': pull_task_id, 'type': 'pullTask', 'image': body['image'],
+                                                 'mode': body.get('mode'), 'state': 'activating'}
+                if 'pull' not in self.stuck_actions:
+                    self.__transition(pull_task_id, 'error' if body['image'] in self.unpullable_images else 'active')
+                return 201, self.pull_tasks[pull_task_id]
+            if len(path) == 2 and path[0] == 'pulltasks' and method == 'GET' and path[1] in self.pull_tasks:
+                return 200, self.__observe(self.pull_tasks[path[1]])
+            if path == ['services'] and method == 'GET':
+                services = [self.__observe(service) for service in self.services.values()]
+                return 200, self.__page(parts.path, query, self.__filter(services, query))
+            if len(path) == 2 and path[0] == 'services':
+                service = self.services.get(path[1])
+                if service is None:
+                    return 404, {'type': 'error', 'status': 404}
+                if method == 'GET':
+                    return 200, self.__observe(service)
+                if method == 'POST' and 'action' in query:
+                    return self.__action(service, query['action'][0], body)
+            return 404, {'type': 'error', 'status': 404}
+
+    def __action(self, service, action, body):
+        if action == 'setservicelinks':
+            service['serviceLinks'] = list((body or {}).get('serviceLinks', []))
+            return 200, service
+        if action not in TRANSITIONS:
+            return 422, {'type': 'error', 'status': 422, 'code': 'InvalidAction'}
+        if action == 'upgrade':
+            strategy = (body or {}).get('inServiceStrategy', {})
+            service['upgrade'] = body
+            service['previousLaunchConfig'] = service['launchConfig']
+            service['launchConfig'] = strategy.get('launchConfig') or service['launchConfig']
+            if strategy.get('secondaryLaunchConfigs'):
+                service['secondaryLaunchConfigs'] = strategy['secondaryLaunchConfigs']
+        elif action == 'rollback' and 'previousLaunchConfig' in service:
+            service['launchConfig'] = service.pop('previousLaunchConfig')
+        transitional, final = TRANSITIONS[action]
+        service['state'] = transitional
+        if action in self.stuck_actions:
+            self.__pending.pop(service['id'], None)
+        else:
+            self.__transition(service['id'], final)
+        return 202, service
+
+    def __stack_action(self, stack, action, body):
+        if action not in ('upgrade', 'finishupgrade', 'rollback'):
+            return 422, {'type': 'error', 'status': 422, 'code': 'InvalidAction'}
+        if action == 'upgrade':
+            stack['previousCompose'] = {field: stack.get(field) for field in COMPOSE_FIELDS}
+            stack.update({field: body[field] for field in COMPOSE_FIELDS if field in (body or {})})
+        elif action == 'rollback' and 'previousCompose' in stack:
+            stack.update(stack.pop('previousCompose'))
+        transitional, final = TRANSITIONS[action]
+        stack['state'] = transitional
+        if action in self.stuck_actions:
+            self.__pending.pop(stack['id'], None)
+        else:
+            self.__transition(stack['id'], final)
+        return 202, stack
+
+    def __transition(self, resource_id, final):
+        self.__pending[resource_id] = [final, self.transition_polls, self.clock.monotonic() + self.transition_seconds]
+
+    def __observe(self, service):
+        """Reports a service's (or stack's) current state and moves it towards its final state."""
+        observed = dict(service)
+        pending = self.__pending.get(service['id'])
+        if pending is not None:
+            if pending[1] <= 0 and self.clock.monotonic() >= pending[2]:
+                service['state'] = pending[0]
+                observed['state'] = pending[0]
+                del self.__pending[service['id']]
+            else:
+                pending[1] -= 1
+        return observed
+
+    @staticmethod
+    def __filter(resources, query):
+        filtered = list(resources)
+        for key, values in query.items():
+            if key in ('limit', 'sort', 'order', 'marker'):
+                continue
+            filtered = [resource for resource in filtered if str(resource.get(key)) in values]
+        return filtered
+
+    def __page(self, path, query, resources):
+        """Answers a listing with one page of at most page_size resources, linking to the next page."""
+        if not self.page_size:
+            return self.__collection(resources)
+        offset = int(query.get('marker', ['0'])[0])
+        collection = self.__collection(resources[offset:offset + self.page_size])
+        if offset + self.page_size < len(resources):
+            pairs = [(key, value) for key, values in query.items() if key != 'marker' for value in values]
+            collection['pagination'] = {'next': path + '?' + urlencode(pairs + [('marker', offset + self.page_size)])}
+        return collection
+
+    @staticmethod
+    def __collection(data):
+        return {'type': 'collection', 'resourceType': data[0]['type'] if data else None, 'data': list(data)}
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # the headers and the body are written separately; without TCP_NODELAY, the body waits for the client's delayed ACK
+    # of the headers, which adds ~40 ms to every request
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        if self.server.ssl_context is not None:
+            self.request = self.server.ssl_context.wrap_socket(self.request, server_side=True)
+        super().setup()
+        with self.server.rancher.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        self.__respond('GET')
+
+    def do_POST(self):
+        self.__respond('POST')
+
+    def __respond(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        rancher = self.server.rancher
+        with rancher.serving():
+            if rancher.latency:
+                rancher.clock.sleep(rancher.latency)
+            status, payload = rancher.handle(method, self.path, body)
+        content = json.dumps(payload).encode('utf-8')
+        etag = None
+        if rancher.etags and method == 'GET' and status == 200:
+            etag = '"%s"' % hashlib.sha1(content).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                status, content = 304, b''
+        with rancher.lock:
+            self.server.bytes_sent += len(content)
+            self.server.not_modified += status == 304
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MockRancherTransport(requests.adapters.BaseAdapter):
+    """
+    A transport adapter that answers a RancherConnection's requests from a MockRancher in-process, with the same ETag
+    handling as MockRancherServer. Together with a VirtualClock it runs whole deploys without a socket or a real sleep.
+    """
+
+    def __init__(self, rancher=None):
+        super().__init__()
+        self.rancher = rancher or MockRancher()
+        self.not_modified = 0
+
+    def send(self, request, **kwargs):
+        rancher = self.rancher
+        parts = urlsplit(request.url)
+        body = request.body.decode('utf-8') if isinstance(request.body, bytes) else request.body
+        with rancher.serving():
+            if rancher.latency:
+                rancher.clock.sleep(rancher.latency)
+            status, payload = rancher.handle(request.method, parts.path + ('?' + parts.query if parts.query else ''),
+                                             json.loads(body) if body else None)
+        content = json.dumps(payload).encode('utf-8')
+        response = requests.Response()
+        response.headers = CaseInsensitiveDict({'Content-Type': 'application/json'})
+        if rancher.etags and request.method == 'GET' and status == 200:
+            etag = '"%s"' % hashlib.sha1(content).hexdigest()
+            response.headers['ETag'] = etag
+            if request.headers.get('If-None-Match') == etag:
+                status, content = 304, b''
+                with rancher.lock:
+                    self.not_modified += 1
+        response.status_code = status
+        response.reason = HTTPStatus(status).phrase
+        response._content = content
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # load tests open hundreds of connections at once
+    request_queue_size = 1024
+
+
+class MockRancherServer:
+    """
+    Serves a MockRancher over HTTP/1.1 on an ephemeral localhost port, with TLS when given a certificate (see
+    tls_certificate()). Use it as a context manager.
+    """
+
+    def __init__(self, rancher=None, certificate=None):
+        """
+        :param certificate: A (certificate file, key file) pair to serve https with.
+        """
+        self.rancher = rancher or MockRancher()
+        self.__server = _Server(('127.0.0.1', 0), _Handler)
+        self.__server.rancher = self.rancher
+        self.__server.ssl_context = _server_context(certificate, 'http/1.1') if certificate else None
+        self.__server.connections = 0
+        self.__server.bytes_sent = 0
+        self.__server.not_modified = 0
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.__server.server_address
+        return '%s://%s:%d' % ('https' if self.__server.ssl_context else 'http', host, port)
+
+    @property
+    def connections(self):
+        """The number of TCP connections clients opened."""
+        return self.__server.connections
+
+    @property
+    def bytes_sent(self):
+        """The number of response body bytes sent to clients."""
+        return self.__server.bytes_sent
+
+    @property
+    def not_modified(self):
+        """The number of GETs answered with '304 Not Modified'."""
+        return self.__server.not_modified
+
+    def __enter__(self):
+        self.__thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+
+class MockRancherH2Server:
+    """
+    Serves a MockRancher over HTTP/2 with TLS (negotiated with ALPN) on an ephemeral localhost port. Each connection
+    is served by one thread, which hands the requests to a thread pool, so that concurrent requests on a connection
+    are answered concurrently. Needs the h2 package. Use it as a context manager.
+    """
+
+    def __init__(self, certificate, rancher=None, workers=64):
+        """
+        :param certificate: A (certificate file, key file) pair, e.g. from tls_certificate().
+        """
+        if h2 is None:
+            raise RuntimeError("MockRancherH2Server needs the h2 package.")
+        self.rancher = rancher or MockRancher()
+        self.connections = 0
+        self.streams = 0
+        self.__context = _server_context(certificate, 'h2')
+        self.__socket = socket.create_server(('127.0.0.1', 0), backlog=1024)
+        self.__pool = ThreadPoolExecutor(max_workers=workers)
+        self.__thread = threading.Thread(target=self.__accept, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.__socket.getsockname()
+        return 'https://%s:%d' % (host, port)
+
+    def __enter__(self):
+        self.__thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.__socket.close()
+        self.__pool.shutdown(wait=False)
+
+    def __accept(self):
+        while True:
+            try:
+                client, _ = self.__socket.accept()
+            except OSError:
+                return
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self.__serve, args=(client,), daemon=True).start()
+
+    def __serve(self, client):
+        try:
+            client = self.__context.wrap_socket(client, server_side=True)
+        except (OSError, ssl.SSLError):
+            client.close()
+            return
+        with self.rancher.lock:
+            self.connections += 1
+        connection = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False,
+                                                                          header_encoding='utf-8'))
+        connection.initiate_connection()
+        client.sendall(connection.data_to_send())
+        # the workers hand their responses back through a queue, so that only this thread touches the TLS socket
+        responses = queue.Queue()
+        wake_up, woken = socket.socketpair()
+        selector = selectors.DefaultSelector()
+        selector.register(client, selectors.EVENT_READ)
+        selector.register(woken, selectors.EVENT_READ)
+        requests = {}
+        unsent = {}
+        try:
+            while True:
+                selector.select()
+                # consume the wake-ups before the responses, so that none is left behind without its wake-up
+                try:
+                    woken.recv(65536, socket.MSG_DONTWAIT)
+                except BlockingIOError:
+                    pass
+                while True:
+                    try:
+                        stream_id, status, content = responses.get_nowait()
+                    except queue.Empty:
+                        break
+                    connection.send_headers(stream_id, [(':status', str(status)), ('content-type', 'application/json'),
+                                                        ('content-length', str(len(content)))])
+                    unsent[stream_id] = content
+                data = self.__receive(client)
+                if data is None:
+                    return
+                for event in connection.receive_data(data) if data else []:
+                    if isinstance(event, h2.events.RequestReceived):
+                        requests[event.stream_id] = (dict(event.headers), bytearray())
+                    elif isinstance(event, h2.events.DataReceived):
+                        requests[event.stream_id][1].extend(event.data)
+                        connection.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                    elif isinstance(event, h2.events.StreamEnded):
+                        headers, body = requests.pop(event.stream_id)
+                        self.__pool.submit(self.__respond, responses, wake_up, event.stream_id, headers, bytes(body))
+                    elif isinstance(event, h2.events.StreamReset):
+                        unsent.pop(event.stream_id, None)
+                    elif isinstance(event, h2.events.ConnectionTerminated):
+                        return
+                self.__send_data(connection, unsent)
+                client.sendall(connection.data_to_send())
+        except (OSError, ssl.SSLError):
+            pass
+        finally:
+            selector.close()
+            wake_up.close()
+            woken.close()
+            client.close()
+
+    @staticmethod
+    def __receive(client):
+        """Reads everything the client has sent so far: b'' if nothing, None if the client closed the connection."""
+        data = bytearray()
+        client.setblocking(False)
+        try:
+            while True:
+                chunk = client.recv(65536)
+                if not chunk:
+                    return bytes(data) or None
+                data.extend(chunk)
+        except (ssl.SSLWantReadError, BlockingIOError):
+            return bytes(data)
+        finally:
+            client.setblocking(True)
+
+    @staticmethod
+    def __send_data(connection, unsent):
+        """Sends as much of the response bodies as the flow control windows allow."""
+        for stream_id, content in list(unsent.items()):
+            window = min(connection.local_flow_control_window(stream_id), len(content))
+            for start in range(0, window, connection.max_outbound_frame_size):
+                connection.send_data(stream_id, content[start:min(start + connection.max_outbound_frame_size, window)])
+            if window == len(content):
+                connection.end_stream(stream_id)
+                del unsent[stream_id]
+            else:
+                unsent[stream_id] = content[window:]
+
+    def __respond(self, responses, wake_up, stream_id, headers, body):
+        with self.rancher.serving():
+            if self.rancher.latency:
+                self.rancher.clock.sleep(self.rancher.latency)
+            status, payload = self.rancher.handle(headers[':method'], headers[':path'],
+                                                  json.loads(body) if body else None)
+        with self.rancher.lock:
+            self.streams += 1
+        responses.put((stream_id, status, json.dumps(payload).encode('utf-8')))
+        try:
+            wake_up.send(b'x')
+        except OSError:
+            pass
+
+
+def tls_certificate(directory):
+    """
+    Creates a self-signed certificate for 127.0.0.1 with the openssl command.
+
+    :return: A (certificate file, key file) pair. The certificate file doubles as the CA bundle to verify it with.
+    """
+    certificate = os.path.join(directory, 'localhost.pem')
+    key = os.path.join(directory, 'localhost-key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', key, '-out', certificate,
+                    '-days', '1', '-subj', '/CN=127.0.0.1', '-addext', 'subjectAltName=IP:127.0.0.1'],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return certificate, key
+
+
+def _server_context(certificate, protocol):
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(*certificate)
+    context.set_alpn_protocols([protocol])
+    return context
@@ -0,0 +1,116 @@
+"""
+Runs whole deploy scenarios (slow upgrades, stuck states, timeouts, rollbacks) against a MockRancher in virtual time:
+the connection and the mock share a VirtualClock and talk through a MockRancherTransport, so a wait that would take
+minutes against a real Rancher server finishes in milliseconds and every run takes the same virtual time.
+
+    python -m tests.simulation
+"""
+import time
+from unittest import mock
+
+import ranchertool
+from ranchertool import api
+from ranchertool.helpers import LogLevel, RancherConnection, VirtualClock
+from tests.mock_rancher import MockRancher, MockRancherTransport
+
+# never resolved or connected to; the transport answers every request
+URL = 'http://rancher.simulated'
+
+
+class Simulation:
+    """A MockRancher, a VirtualClock and a RancherConnection wired together."""
+
+    def __init__(self, timeout=300, transition_polls=0, transition_seconds=0, latency=0):
+        """
+        :param timeout: The connection's operation timeout, in virtual seconds.
+        :param transition_seconds: How long transitional states (e.g. 'upgrading') last, in virtual seconds.
+        :param latency: Virtual seconds every request takes.
+        """
+        self.clock = VirtualClock()
+        self.rancher = MockRancher(transition_polls=transition_polls, transition_seconds=transition_seconds,
+                                   latency=latency, clock=self.clock)
+        self.connection = RancherConnection(URL, 'key', 'secret', 'Default', log_level=LogLevel.SILENT,
+                                            operation_timeout=timeout, transport=MockRancherTransport(self.rancher),
+                                            clock=self.clock)
+
+    def add_service(self, stack_name, service_name, image='acme/api:1', state='active'):
+        stack_id = next((stack['id'] for stack in self.rancher.stacks.values() if stack['name'] == stack_name), None)
+        return self.rancher.add_service(stack_id or self.rancher.add_stack(stack_name), service_name, image=image,
+                                        state=state)
+
+    def deploy(self, stack_name, service_name, **kwargs):
+        """
+        Deploys in virtual time.
+
+        :return: A (DeployResult or the RancherToolError raised, virtual seconds taken) pair
+        """
+        start = self.clock.monotonic()
+        try:
+            outcome = ranchertool.deploy(self.connection, stack_name, service_name, log_level=LogLevel.SILENT,
+                                         **kwargs)
+        except ranchertool.RancherToolError as e:
+            outcome = e
+        return outcome, self.clock.monotonic() - start
+
+    def image(self, service_id):
+        return self.rancher.services[service_id]['launchConfig']['imageUuid']
+
+
+def virtual_connections(clock):
+    """Patches api.connect, so that the connections the command line opens wait and keep deadlines on the clock."""
+    connect = api.connect
+    return mock.patch.object(api, 'connect', lambda *args, **kwargs: connect(*args, clock=clock, **kwargs))
+
+
+def slow_upgrade():
+    """An upgrade that takes Rancher 3 minutes, and its finish another 3."""
+    simulation = Simulation(transition_seconds=180)
+    simulation.add_service('web', 'api')
+    return simulation, simulation.deploy('web', 'api', image='acme/api:2')
+
+
+def stuck_upgrade():
+    """An upgrade that never completes: times out after 5 minutes and is rolled back."""
+    simulation = Simulation(timeout=300)
+    simulation.add_service('web', 'api')
+    simulation.rancher.stuck_actions.add('upgrade')
+    return simulation, simulation.deploy('web', 'api', image='acme/api:2', rollback=True)
+
+
+def exceeded_deadline():
+    """A 10 minute upgrade under a 2 minute deadline."""
+    simulation = Simulation(transition_seconds=600)
+    simulation.add_service('web', 'api')
+    return simulation, simulation.deploy('web', 'api', image='acme/api:2', deadline=120)
+
+
+def previous_upgrade():
+    """A service left 'upgraded' by an earlier deploy, whose finish takes a minute."""
+    simulation = Simulation(transition_seconds=60)
+    simulation.add_service('web', 'api', state='upgraded')
+    return simulation, simulation.deploy('web', 'api', image='acme/api:2')
+
+
+def stuck_pre_pull():
+    """Pull tasks that never complete, so the upgrade is never started."""
+    simulation = Simulation(timeout=120)
+    simulation.add_service('web', 'api')
+    simulation.rancher.stuck_actions.add('pull')
+    return simulation, simulation.deploy('web', 'api', image='acme/api:2', pre_pull=True)
+
+
+SCENARIOS = (slow_upgrade, stuck_upgrade, exceeded_deadline, previous_upgrade, stuck_pre_pull)
+
+
+def main():
+    for scenario in SCENARIOS:
+        start = time.perf_counter()
+        _, (outcome, seconds) = scenario()
+        result = getattr(outcome, 'result', outcome)
+        print('  %-18s %-14s virtual %6.0f s  real %6.1f ms' %
+              (scenario.__name__, getattr(result, 'outcome', None) and result.outcome.value or type(outcome).__name__,
+               seconds, 1000 * (time.perf_counter() - start)))
+
+
+if __name__ == '__main__':
+    main()
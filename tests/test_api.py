@@ -0,0 +1,146 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from click.testing import CliRunner
+
+import ranchertool
+from ranchertool import DeployOutcome, cli
+from ranchertool.helpers import LogLevel
+from tests.mock_rancher import MockRancher, MockRancherServer
+
+
+class DeployApiTests(unittest.TestCase):
+
+    def setUp(self):
+        self.rancher = MockRancher(transition_polls=0)
+        self.stack_id = self.rancher.add_stack('web')
+        self.service_id = self.rancher.add_service(self.stack_id, 'api', image='acme/api:1')
+        self.server = MockRancherServer(self.rancher).__enter__()
+        self.connection = ranchertool.connect(self.server.url, 'key', 'secret', timeout=1, log_level=LogLevel.SILENT)
+
+    def tearDown(self):
+        self.connection.close()
+        self.server.__exit__(None, None, None)
+
+    def deploy(self, service='api', **kwargs):
+        return ranchertool.deploy(self.connection, 'web', service, log_level=LogLevel.SILENT, **kwargs)
+
+    def test_deploy_returns_outcome_and_timings(self):
+        result = self.deploy(image='acme/api:2', labels='commit=abc', variables={'MODE': 'prod'})
+        self.assertEqual(DeployOutcome.FINISHED, result.outcome)
+        self.assertEqual(self.service_id, result.service_id)
+        self.assertEqual({'discovery', 'upgrade', 'wait', 'finish'}, set(result.timings))
+        self.assertGreater(result.duration, 0)
+        launch_config = self.rancher.services[self.service_id]['launchConfig']
+        self.assertEqual('docker:acme/api:2', launch_config['imageUuid'])
+        self.assertEqual({'commit': 'abc'}, launch_config['labels'])
+        self.assertEqual({'MODE': 'prod'}, launch_config['environment'])
+
+    def test_no_wait_returns_handle(self):
+        result = self.deploy(image='acme/api:2', wait=False)
+        self.assertEqual(DeployOutcome.TRIGGERED, result.outcome)
+        self.assertEqual(self.service_id, result.handle.service_id)
+
+    def test_create_service(self):
+        result = self.deploy('new', image='acme/new:1', create_service=True)
+        self.assertEqual(DeployOutcome.CREATED, result.outcome)
+        self.assertEqual('active', self.rancher.services[result.service_id]['state'])
+
+    def test_errors_are_raised_not_exited(self):
+        with self.assertRaises(ranchertool.NotFoundError):
+            self.deploy('missing')
+        with self.assertRaises(ranchertool.ConfigurationError):
+            self.deploy('missing', create_service=True)
+        with self.assertRaises(ranchertool.ConfigurationError):
+            ranchertool.connect('rancher.example.com', 'key', 'secret')
+
+    def test_failed_upgrade_is_rolled_back(self):
+        self.rancher.stuck_actions.add('upgrade')
+        with self.assertRaises(ranchertool.UpgradeFailed) as context:
+            self.deploy(image='acme/api:2', rollback=True)
+        self.assertTrue(context.exception.rolled_back)
+        self.assertIn('rollback', context.exception.result.timings)
+        self.assertEqual('docker:acme/api:1', self.rancher.services[self.service_id]['launchConfig']['imageUuid'])
+
+    def test_pre_pull_before_upgrade(self):
+        self.rancher.add_service(self.stack_id, 'app', secondary_launch_configs=[{'name': 'proxy'}])
+        result = ranchertool.deploy(self.connection, 'web', 'app', image='acme/app:2', pre_pull=True,
+                                    new_sidekick_images={'proxy': 'acme/proxy:2'}, log_level=LogLevel.SILENT)
+        self.assertEqual(DeployOutcome.FINISHED, result.outcome)
+        self.assertIn('pull', result.timings)
+        posts = [path for method, path in self.rancher.request_log('POST')]
+        self.assertEqual(['/v2-beta/projects/1a1/pulltasks'] * 2, posts[:2])
+        self.assertTrue(posts[2].endswith('?action=upgrade'))
+        self.assertEqual({'acme/app:2', 'acme/proxy:2'}, {task['image'] for task in self.rancher.pull_tasks.values()})
+        self.assertEqual({'active'}, {task['state'] for task in self.rancher.pull_tasks.values()})
+
+    def test_failed_pre_pull_prevents_upgrade(self):
+        self.rancher.unpullable_images.add('acme/api:404')
+        with self.assertRaises(ranchertool.RancherApiError):
+            self.deploy(image='acme/api:404', pre_pull=True)
+        self.assertFalse([path for method, path in self.rancher.request_log('POST') if 'action=upgrade' in path])
+        self.assertEqual('docker:acme/api:1', self.rancher.services[self.service_id]['launchConfig']['imageUuid'])
+
+    def test_many_deploys_share_one_connection(self):
+        services = ['svc%d' % i for i in range(12)]
+        for service in services:
+            self.rancher.add_service(self.stack_id, service)
+        with ThreadPoolExecutor(max_workers=6) as pool:
+            results = list(pool.map(lambda service: self.deploy(service, image='acme/%s:2' % service), services))
+        self.assertEqual([DeployOutcome.FINISHED] * len(services), [result.outcome for result in results])
+        self.assertEqual(1, self.rancher.request_log().count(('GET', '/v2-beta/projects')))
+
+
+    def test_preflight_fails_before_any_change(self):
+        self.rancher.add_service(self.stack_id, 'app', secondary_launch_configs=[{'name': 'proxy'}])
+        with self.assertRaises(ranchertool.NotFoundError):
+            self.deploy(image='acme/api:2', service_links=[('db', 'web/db'), ('cache', 'other/cache')])
+        for links in ('db=db', 'db', 'db=web/db/extra', [('db',)], [('', 'web/db')]):
+            with self.assertRaises(ranchertool.ConfigurationError, msg=repr(links)):
+                self.deploy(image='acme/api:2', service_links=links)
+        with self.assertRaises(ranchertool.ConfigurationError):
+            self.deploy('app', image='acme/app:2', new_sidekick_images={'proxy': 'acme/proxy:2', 'cron': 'acme/cron:2'})
+        with self.assertRaises(ranchertool.NotFoundError):
+            ranchertool.deploy(self.connection, 'new', 'api', image='acme/api:2', create_stack=True,
+                               log_level=LogLevel.SILENT)
+        with self.assertRaises(ranchertool.ConfigurationError):
+            self.deploy()
+        self.assertEqual([], self.rancher.request_log('POST'))
+
+    def test_malformed_links_are_reported_by_the_cli(self):
+        for links in ('db', 'db=web/db/extra'):
+            result = CliRunner().invoke(cli.main, ['upgrade', '--stack', 'web', '--service', 'api', '--image',
+                                                   'acme/api:2', '--service-links', links, '--rancher-url',
+                                                   self.server.url, '--rancher-key', 'key', '--rancher-secret',
+                                                   'secret', '--log-level', 'SILENT'])
+            self.assertNotEqual(0, result.exit_code)
+            self.assertIsInstance(result.exception, SystemExit, result.exception)
+        self.assertEqual([], self.rancher.request_log('POST'))
+
+    def test_preflight_looks_links_up_concurrently(self):
+        for index in range(6):
+            self.rancher.add_service(self.rancher.add_stack('data-%d' % index), 'db')
+        self.rancher.latency = 0.1
+        links = [('db%d' % index, 'data-%d/db' % index) for index in range(6)]
+        result = self.deploy(image='acme/api:2', service_links=links, finish=False)
+        # the links are looked up side by side; concurrent lookups of the same listing are coalesced into one
+        # request, so the count depends on how many of them overlap
+        self.assertGreater(self.rancher.peak_in_flight, 1)
+        self.assertLessEqual(result.requests['discovery'], 15)
+        self.assertEqual(DeployOutcome.UPGRADED, result.outcome)
+
+    def test_preflight_looks_the_service_up_alongside_a_link(self):
+        self.rancher.add_service(self.rancher.add_stack('data'), 'db')
+        self.rancher.latency = 0.1
+        self.connection.close()
+        # a fresh connection, with no cached ids: the service's lookups go to Rancher too
+        self.connection = ranchertool.connect(self.server.url, 'key', 'secret', timeout=1, log_level=LogLevel.SILENT)
+        self.rancher.reset_log()
+        result = self.deploy(image='acme/api:2', service_links=[('db', 'data/db')], finish=False)
+        self.assertEqual(DeployOutcome.UPGRADED, result.outcome)
+        self.assertGreater(self.rancher.peak_in_flight, 1)
+        self.assertEqual(len(self.rancher.request_log()), sum(result.requests.values()))
+
+
+if __name__ == '__main__':
+    unittest.main()
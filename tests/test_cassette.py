@@ -0,0 +1,89 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from click.testing import CliRunner
+
+import ranchertool
+from ranchertool import cli
+from ranchertool.helpers import Cassette, LogLevel
+from tests.mock_rancher import MockRancher, MockRancherServer
+
+
+class CassetteTests(unittest.TestCase):
+
+    def setUp(self):
+        self.rancher = MockRancher(transition_polls=0, latency=0.05)
+        self.service_id = self.rancher.add_service(self.rancher.add_stack('web'), 'api', image='acme/api:1')
+        self.directory = tempfile.TemporaryDirectory()
+        self.cassette = os.path.join(self.directory.name, 'deploy.cassette')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def upgrade(self, url, *args):
+        return CliRunner().invoke(cli.main, ['upgrade', '--stack', 'web', '--service', 'api', '--image', 'acme/api:2',
+                                             '--rancher-url', url, '--rancher-key', 'key', '--rancher-secret',
+                                             'secret', '--log-level', 'SILENT'] + list(args))
+
+    def record(self, *args):
+        with MockRancherServer(self.rancher) as server:
+            result = self.upgrade(server.url, '--record', self.cassette, *args)
+        self.assertEqual(0, result.exit_code, result.output)
+        return self.rancher.request_log()
+
+    def test_record_then_replay_offline(self):
+        recorded = self.record()
+        cassette = Cassette.load(self.cassette)
+        self.assertEqual([(method, path.rstrip('/')) for method, path in recorded],
+                         [(exchange['method'], exchange['path']) for exchange in cassette.exchanges])
+        self.assertTrue(all(exchange['elapsed'] >= 0.05 for exchange in cassette.exchanges))
+        with open(self.cassette) as f:
+            self.assertNotIn('secret', f.read())
+
+        # nothing listens on this port any more: every response comes from the cassette
+        started = time.monotonic()
+        result = self.upgrade('http://127.0.0.1:9', '--replay', self.cassette)
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertLess(time.monotonic() - started, cassette.duration())
+
+    def test_environment_values_are_redacted(self):
+        self.rancher.services[self.service_id]['launchConfig']['environment'] = {'DB_PASSWORD': 'hunter2'}
+        variables = ('--variables', 'API_TOKEN=s3cr3t')
+        self.record(*variables)
+        with open(self.cassette) as f:
+            recorded = f.read()
+        self.assertNotIn('hunter2', recorded)
+        self.assertNotIn('s3cr3t', recorded)
+        self.assertIn('DB_PASSWORD', recorded)
+        # requests are matched on their redacted bodies, so the run still replays
+        result = self.upgrade('http://127.0.0.1:9', '--replay', self.cassette, *variables)
+        self.assertEqual(0, result.exit_code, result.output)
+
+    def test_replay_at_recorded_speed(self):
+        self.record()
+        cassette = Cassette.load(self.cassette)
+        connection = ranchertool.connect('http://rancher.invalid', 'key', 'secret', replay=self.cassette,
+                                         replay_speed=1, log_level=LogLevel.SILENT)
+        started = time.monotonic()
+        result = ranchertool.deploy(connection, 'web', 'api', image='acme/api:2', log_level=LogLevel.SILENT)
+        self.assertEqual(ranchertool.DeployOutcome.FINISHED, result.outcome)
+        self.assertGreaterEqual(time.monotonic() - started,
+                                sum(exchange['elapsed'] for exchange in cassette.exchanges[1:]))
+
+    def test_unrecorded_request_fails(self):
+        self.record()
+        result = self.upgrade('http://127.0.0.1:9', '--replay', self.cassette, '--image', 'acme/api:3')
+        self.assertNotEqual(0, result.exit_code)
+
+    def test_invalid_cassette(self):
+        with open(self.cassette, 'w') as f:
+            json.dump({'not': 'a cassette'}, f)
+        with self.assertRaises(ranchertool.ConfigurationError):
+            ranchertool.connect('http://rancher.invalid', 'key', 'secret', replay=self.cassette)
+
+
+if __name__ == '__main__':
+    unittest.main()
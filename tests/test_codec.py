@@ -0,0 +1,45 @@
+import unittest
+
+import ranchertool
+from ranchertool import DeployOutcome
+from ranchertool.helpers import JsonCodec, LogLevel, available_codecs, get_codec
+from tests.mock_rancher import MockRancher, MockRancherServer
+
+
+class JsonCodecTests(unittest.TestCase):
+
+    def test_fastest_available_is_default(self):
+        codecs = available_codecs()
+        self.assertEqual('json', list(codecs)[-1])
+        self.assertEqual(list(codecs)[0], get_codec().name)
+
+    def test_codecs_round_trip(self):
+        payload = {'data': [{'id': '1s1', 'name': 'api', 'launchConfig': {'labels': {'a': 'ü'}}, 'scale': 2}]}
+        for codec in available_codecs().values():
+            encoded = codec.dumps(payload)
+            self.assertIsInstance(encoded, bytes)
+            self.assertEqual(payload, codec.loads(encoded))
+
+    def test_unknown_codec(self):
+        codec = JsonCodec('custom', None, None)
+        self.assertIs(codec, get_codec(codec))
+        with self.assertRaises(ValueError):
+            get_codec('simplejson-9000')
+        with self.assertRaises(ranchertool.ConfigurationError):
+            ranchertool.connect('http://rancher.example.com', 'key', 'secret', codec='simplejson-9000')
+
+    def test_deploy_with_every_codec(self):
+        for name in available_codecs():
+            with self.subTest(codec=name):
+                rancher = MockRancher(transition_polls=0)
+                service_id = rancher.add_service(rancher.add_stack('web'), 'api', image='acme/api:1')
+                with MockRancherServer(rancher) as server:
+                    connection = ranchertool.connect(server.url, 'key', 'secret', timeout=1, codec=name,
+                                                     log_level=LogLevel.SILENT)
+                    try:
+                        result = ranchertool.deploy(connection, 'web', 'api', image='acme/api:2',
+                                                    labels='commit=abc', log_level=LogLevel.SILENT)
+                    finally:
+                        connection.close()
+                self.assertEqual(DeployOutcome.FINISHED, result.outcome)
+                self.assertEqual({'commit': 'abc'}, rancher.services[service_id]['launchConfig']['labels'])
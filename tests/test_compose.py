@@ -0,0 +1,86 @@
+import os
+import tempfile
+import unittest
+
+from click.testing import CliRunner
+
+from ranchertool import cli
+from tests.mock_rancher import MockRancher, MockRancherServer
+
+DOCKER_COMPOSE = """version: '2'
+services:
+  api:
+    image: acme/api:2
+  worker:
+    image: acme/worker:2
+"""
+RANCHER_COMPOSE = """version: '2'
+services:
+  api:
+    scale: 3
+"""
+
+
+class ComposeTests(unittest.TestCase):
+
+    def setUp(self):
+        self.rancher = MockRancher(transition_polls=0)
+        self.server = MockRancherServer(self.rancher).__enter__()
+        self.directory = tempfile.TemporaryDirectory()
+        self.docker_compose = os.path.join(self.directory.name, 'docker-compose.yml')
+        self.rancher_compose = os.path.join(self.directory.name, 'rancher-compose.yml')
+        with open(self.docker_compose, 'w') as f:
+            f.write(DOCKER_COMPOSE)
+        with open(self.rancher_compose, 'w') as f:
+            f.write(RANCHER_COMPOSE)
+
+    def tearDown(self):
+        self.directory.cleanup()
+        self.server.__exit__(None, None, None)
+
+    def compose(self, *args):
+        self.rancher.reset_log()
+        return CliRunner().invoke(cli.main, ['compose', '--stack', 'preview', '--docker-compose', self.docker_compose,
+                                             '--rancher-compose', self.rancher_compose, '--rancher-url',
+                                             self.server.url, '--rancher-key', 'key', '--rancher-secret', 'secret'] +
+                                  list(args))
+
+    def stack(self):
+        return next(stack for stack in self.rancher.stacks.values() if stack['name'] == 'preview')
+
+    def test_creates_stack_with_one_request(self):
+        result = self.compose('--variable', 'TAG', '2')
+        self.assertEqual(0, result.exit_code, result.output)
+        stack = self.stack()
+        self.assertEqual('active', stack['state'])
+        self.assertEqual([DOCKER_COMPOSE, RANCHER_COMPOSE, {'TAG': '2'}],
+                         [stack['dockerCompose'], stack['rancherCompose'], stack['environment']])
+        self.assertEqual([('POST', '/v2-beta/projects/1a1/stacks')], self.rancher.request_log('POST'))
+
+    def test_upgrades_existing_stack(self):
+        self.rancher.add_stack('preview')
+        result = self.compose()
+        self.assertEqual(0, result.exit_code, result.output)
+        stack = self.stack()
+        self.assertEqual('active', stack['state'])
+        self.assertEqual(DOCKER_COMPOSE, stack['dockerCompose'])
+        self.assertEqual(['/v2-beta/projects/1a1/stacks/%s?action=upgrade' % stack['id'],
+                          '/v2-beta/projects/1a1/stacks/%s?action=finishupgrade' % stack['id']],
+                         [path for method, path in self.rancher.request_log('POST')])
+
+    def test_missing_stack_without_create(self):
+        result = self.compose('--no-create-stack')
+        self.assertNotEqual(0, result.exit_code)
+        self.assertEqual([], self.rancher.request_log('POST'))
+
+    def test_failed_upgrade_is_rolled_back(self):
+        stack_id = self.rancher.add_stack('preview')
+        self.rancher.stacks[stack_id]['dockerCompose'] = 'old'
+        self.rancher.stuck_actions.add('upgrade')
+        result = self.compose('--timeout', '1', '--rollback')
+        self.assertNotEqual(0, result.exit_code)
+        self.assertEqual(('active', 'old'), (self.stack()['state'], self.stack()['dockerCompose']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from ranchertool.helpers import Deadline, DeadlineExceeded, LogLevel, RancherConnection, ServiceTarget, SingleFlight
+from tests import simulation
+from tests.mock_rancher import MockRancher, MockRancherServer, MockRancherTransport
+
+SERVICE_COUNT = 24
+
+
+class HoldingTransport(MockRancherTransport):
+    """Holds the response to the next GET back, once hold() is called, until it is released."""
+
+    def __init__(self, rancher):
+        super().__init__(rancher)
+        self.held = threading.Event()
+        self.released = threading.Event()
+        self.__holds = threading.Semaphore(0)
+
+    def hold(self):
+        self.__holds.release()
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        if request.method == 'GET' and self.__holds.acquire(blocking=False):
+            self.held.set()
+            self.released.wait(10)
+        return response
+
+
+class ConnectionThreadSafetyTests(unittest.TestCase):
+
+    def setUp(self):
+        self.rancher = MockRancher(transition_polls=0)
+        stack_id = self.rancher.add_stack('web')
+        for i in range(SERVICE_COUNT):
+            self.rancher.add_service(stack_id, 'svc%d' % i, image='acme/svc%d:1' % i)
+        self.server = MockRancherServer(self.rancher).__enter__()
+        self.connection = RancherConnection(self.server.url, 'key', 'secret', None, 'web', None,
+                                            log_level=LogLevel.SILENT, pool_size=8)
+
+    def tearDown(self):
+        self.connection.close()
+        self.server.__exit__(None, None, None)
+
+    def test_targets_are_immutable(self):
+        target = self.connection.target(service_name='svc1', labels='a=1', variables=[('B', '2')])
+        self.assertIsInstance(target, ServiceTarget)
+        with self.assertRaises(AttributeError):
+            target.service_id = '1s99'
+        with self.assertRaises(TypeError):
+            target.labels['a'] = '2'
+        self.assertEqual({'a': '1'}, dict(target.labels))
+        self.assertEqual({'a': '1', 'c': '3'}, dict(target.with_labels({'c': '3'}).labels))
+        self.assertEqual({'a': '1'}, dict(target.labels))
+
+    def test_concurrent_reads_from_one_connection(self):
+        def inspect(i):
+            target = self.connection.target(service_name='svc%d' % i)
+            return (self.connection.get_service_state(target=target),
+                    self.connection.get_launch_config(target=target)['imageUuid'])
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(inspect, list(range(SERVICE_COUNT)) * 4))
+
+        for i, (state, image) in enumerate(results):
+            self.assertEqual('active', state)
+            self.assertEqual('docker:acme/svc%d:1' % (i % SERVICE_COUNT), image)
+
+    def test_concurrent_upgrades_from_one_connection(self):
+        def upgrade(i):
+            target = self.connection.resolve(self.connection.target(service_name='svc%d' % i,
+                                                                    labels=[('build', str(i))]))
+            launch_config = self.connection.get_launch_config(target=target)
+            launch_config['imageUuid'] = 'docker:acme/svc%d:2' % i
+            launch_config['labels'].update(self.connection.get_labels(target))
+            self.connection.do_upgrade({'inServiceStrategy': {'launchConfig': launch_config}}, target=target)
+            return self.connection.finish_upgrade(target=target)
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            self.assertTrue(all(pool.map(upgrade, range(SERVICE_COUNT))))
+
+        for service in self.rancher.services.values():
+            i = service['name'][3:]
+            self.assertEqual('active', service['state'])
+            self.assertEqual('docker:acme/svc%s:2' % i, service['launchConfig']['imageUuid'])
+            self.assertEqual({'build': i}, service['launchConfig']['labels'])
+
+    def test_identical_concurrent_gets_are_coalesced(self):
+        target = self.connection.resolve(self.connection.target(service_name='svc1'))
+        self.rancher.latency = 0.2
+        for callers in (1, 8, 32):
+            self.rancher.reset_log()
+            barrier = threading.Barrier(callers)
+
+            def inspect(_):
+                barrier.wait()
+                return self.connection.get_launch_config(target=target)
+
+            with ThreadPoolExecutor(max_workers=callers) as pool:
+                launch_configs = list(pool.map(inspect, range(callers)))
+            self.assertEqual(1, len(self.rancher.request_log('GET')), '%d callers' % callers)
+            self.assertEqual(['docker:acme/svc1:1'] * callers, [config['imageUuid'] for config in launch_configs])
+            # every caller gets a launch config of its own to modify
+            self.assertEqual(callers, len({id(config) for config in launch_configs}))
+        self.assertEqual(7 + 31, self.connection.requests_coalesced())
+
+    def test_reads_after_a_write_are_not_coalesced_with_older_reads(self):
+        transport = HoldingTransport(self.rancher)
+        connection = RancherConnection(simulation.URL, 'key', 'secret', None, 'web', 'svc1', log_level=LogLevel.SILENT,
+                                       transport=transport)
+        target = connection.resolve()
+        launch_config = connection.get_launch_config(target=target)
+        transport.hold()
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            # another thread's GET, sent before the upgrade
+            before = pool.submit(connection.get_service_state, target=target)
+            self.assertTrue(transport.held.wait(5))
+            connection.do_upgrade({'inServiceStrategy': {'launchConfig': launch_config}}, target=target)
+            self.assertEqual('upgraded', connection.get_service_state(target=target))
+            transport.released.set()
+            self.assertEqual('active', before.result())
+        self.assertEqual(0, connection.requests_coalesced())
+
+    def test_waits_for_coalesced_reads_are_bounded_by_the_deadline(self):
+        transport = HoldingTransport(self.rancher)
+        connection = RancherConnection(simulation.URL, 'key', 'secret', None, 'web', 'svc1', log_level=LogLevel.SILENT,
+                                       transport=transport)
+        target = connection.resolve()
+        transport.hold()
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            leader = pool.submit(connection.get_service_state, target=target)
+            self.assertTrue(transport.held.wait(5))
+            started = time.monotonic()
+            with connection.deadline_scope(Deadline(0.2)), self.assertRaises(DeadlineExceeded):
+                connection.get_service_state(target=target)
+            self.assertLess(time.monotonic() - started, 2)
+            transport.released.set()
+            self.assertEqual('active', leader.result())
+        self.assertEqual(1, connection.requests_coalesced())
+
+    def test_single_flight_joins_only_calls_started_late_enough(self):
+        flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def call(name):
+            def run():
+                calls.append(name)
+                release.wait(5)
+                return name
+            return run
+
+        def until(condition):
+            while not condition():
+                time.sleep(0.01)
+
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            first = pool.submit(flight.do, 'key', call('first'))
+            until(lambda: flight.started() == 1)
+            with self.assertRaises(TimeoutError):
+                flight.do('key', call('timed out'), timeout=0.05)
+            # a caller that must see what it did after the first call started makes a call of its own...
+            second = pool.submit(flight.do, 'key', call('second'), after=flight.started())
+            until(lambda: flight.started() == 2)
+            # ...and later callers join the newest call
+            third = pool.submit(flight.do, 'key', call('third'))
+            until(lambda: flight.coalesced == 2)
+            release.set()
+            self.assertEqual(['first', 'second', 'second'], [future.result() for future in (first, second, third)])
+        self.assertEqual(['first', 'second'], calls)
+
+    def test_resolved_ids_are_cached(self):
+        self.connection.resolve(self.connection.target(service_name='svc3'))
+        self.rancher.reset_log()
+        target = self.connection.resolve(self.connection.target(service_name='svc3'))
+        self.assertEqual([], self.rancher.request_log())
+        self.assertIsNotNone(target.stack_id)
+        self.assertIsNotNone(target.service_id)
+
+    def test_default_target_still_configurable(self):
+        self.connection.set_labels('a=1,b=2')
+        self.connection.set_variables('X=1|Y=2')
+        self.connection.set_service_links('link=web/svc2')
+        self.assertEqual({'a': '1', 'b': '2'}, self.connection.get_labels())
+        self.assertEqual({'X': '1', 'Y': '2'}, self.connection.get_variables())
+        self.assertEqual('link', self.connection.get_service_links()['serviceLinks'][0]['name'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import time
+import unittest
+
+from ranchertool.helpers import Deadline, DeadlineExceeded, LogLevel, RancherConnection, ServiceState, VirtualClock
+from tests.mock_rancher import MockRancher, MockRancherServer
+
+
+class DeadlineTests(unittest.TestCase):
+
+    def setUp(self):
+        self.rancher = MockRancher(transition_polls=0)
+        self.rancher.add_service(self.rancher.add_stack('web'), 'api')
+        self.server = MockRancherServer(self.rancher).__enter__()
+
+    def tearDown(self):
+        self.server.__exit__(None, None, None)
+
+    def test_deadline_caps_durations(self):
+        self.assertEqual(5, Deadline().cap(5))
+        self.assertIsNone(Deadline().remaining())
+        deadline = Deadline(1)
+        self.assertLessEqual(deadline.cap(5), 1)
+        self.assertEqual(0.5, deadline.cap(0.5))
+        connect, read = deadline.request_timeout(10, 30)
+        self.assertLessEqual(connect, 1)
+        self.assertLessEqual(read, 1)
+        self.assertTrue(Deadline(0).expired())
+
+    def test_no_time_left_is_not_a_zero_timeout(self):
+        clock = VirtualClock()
+        deadline = Deadline(10, clock)
+        clock.advance(9.5)
+        self.assertEqual((0.5, 0.5), deadline.request_timeout(10, 30))
+        clock.advance(0.5)
+        with self.assertRaises(DeadlineExceeded):
+            deadline.request_timeout(10, 30)
+
+    def test_stalled_request_times_out(self):
+        connection = RancherConnection(self.server.url, 'key', 'secret', None, 'web', 'api',
+                                       log_level=LogLevel.SILENT, read_timeout=0.2)
+        target = connection.resolve()
+        self.rancher.latency = 2
+        started = time.monotonic()
+        self.assertIsNone(connection.get_service_state(target=target))
+        self.assertLess(time.monotonic() - started, 1.5)
+
+    def test_deadline_bounds_waits(self):
+        connection = RancherConnection(self.server.url, 'key', 'secret', None, 'web', 'api',
+                                       log_level=LogLevel.SILENT, deadline=Deadline(1))
+        lifecycle = connection.lifecycle()
+        self.rancher.transition_polls = 1000
+        self.assertTrue(lifecycle.upgrade({'inServiceStrategy': {'launchConfig': lifecycle.launch_config()}}))
+        started = time.monotonic()
+        self.assertFalse(lifecycle.wait_until(ServiceState.UPGRADED))
+        self.assertLess(time.monotonic() - started, 1.5)
+
+    def test_expired_deadline_fails_before_requesting(self):
+        connection = RancherConnection(self.server.url, 'key', 'secret', None, 'web', 'api',
+                                       log_level=LogLevel.SILENT, deadline=Deadline(0.2))
+        time.sleep(0.3)
+        self.rancher.reset_log()
+        with self.assertRaises(DeadlineExceeded):
+            connection.resolve()
+        self.assertEqual([], self.rancher.request_log())
+
+
+if __name__ == '__main__':
+    unittest.main()
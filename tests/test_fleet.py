@@ -0,0 +1,90 @@
+import json
+import os
+import tempfile
+import unittest
+
+from click.testing import CliRunner
+
+from ranchertool import cli, fleet
+from tests.mock_rancher import MockRancher, MockRancherServer
+
+
+class FleetTests(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = {}
+        for name in ('staging', 'eu', 'us', 'dr'):
+            rancher = MockRancher(project_name=name.upper(), transition_polls=0)
+            if name != 'us':
+                rancher.add_service(rancher.add_stack('web'), 'api', image='acme/api:1')
+            self.servers[name] = MockRancherServer(rancher).__enter__()
+        self.directory = tempfile.TemporaryDirectory()
+        os.environ['FLEET_TEST_SECRET'] = 'secret'
+
+    def tearDown(self):
+        del os.environ['FLEET_TEST_SECRET']
+        self.directory.cleanup()
+        for server in self.servers.values():
+            server.__exit__(None, None, None)
+
+    def write_fleet(self, names, ordering=None, waves=None):
+        definition = {'targets': [{'name': name, 'url': self.servers[name].url, 'environment': name.upper(),
+                                   'access_key': 'key', 'secret_key_env': 'FLEET_TEST_SECRET',
+                                   'wave': (waves or {}).get(name, 0)} for name in names]}
+        if ordering:
+            definition['ordering'] = ordering
+        path = os.path.join(self.directory.name, 'fleet.json')
+        with open(path, 'w') as f:
+            json.dump(definition, f)
+        return path
+
+    def image(self, name):
+        rancher = self.servers[name].rancher
+        return [service['launchConfig']['imageUuid'] for service in rancher.services.values()]
+
+    def fleet(self, path, *args):
+        return CliRunner().invoke(cli.main, ['fleet', '--config', path, '--stack', 'web', '--service', 'api',
+                                             '--image', 'acme/api:2', '--format', 'json', '--log-level', 'SILENT'] +
+                                  list(args))
+
+    def test_all_at_once(self):
+        result = self.fleet(self.write_fleet(['staging', 'eu', 'dr']))
+        self.assertEqual(0, result.exit_code, result.output)
+        rows = json.loads(result.output)
+        self.assertEqual([('staging', 'finished'), ('eu', 'finished'), ('dr', 'finished')],
+                         [(row['target'], row['status']) for row in rows])
+        for name in ('staging', 'eu', 'dr'):
+            self.assertEqual(['docker:acme/api:2'], self.image(name))
+
+    def test_all_at_once_reports_every_failure(self):
+        result = self.fleet(self.write_fleet(['staging', 'us', 'dr']))
+        self.assertNotEqual(0, result.exit_code)
+        rows = json.JSONDecoder().raw_decode(result.output.strip())[0]
+        self.assertEqual(['finished', 'failed', 'finished'], [row['status'] for row in rows])
+        self.assertIn("Unable to find a stack called 'web'", rows[1]['error'])
+
+    def test_waves_stop_after_failed_wave(self):
+        path = self.write_fleet(['staging', 'us', 'eu', 'dr'], 'waves', {'staging': 0, 'us': 0, 'eu': 1, 'dr': 1})
+        report = fleet.deploy_fleet(*fleet.load_fleet(path)[:1], 'web', 'api', ordering='waves', image='acme/api:2',
+                                    log_level='SILENT')
+        self.assertFalse(report.succeeded)
+        self.assertEqual(['finished', 'failed', 'skipped', 'skipped'], [outcome.status() for outcome in report.outcomes])
+        self.assertEqual(['docker:acme/api:1'], self.image('eu'))
+
+    def test_stop_on_first_failure(self):
+        path = self.write_fleet(['staging', 'us', 'eu'])
+        report = fleet.deploy_fleet(fleet.load_fleet(path)[0], 'web', 'api', ordering='stop-on-first-failure',
+                                    image='acme/api:2', log_level='SILENT')
+        self.assertEqual(['finished', 'failed', 'skipped'], [outcome.status() for outcome in report.outcomes])
+        self.assertEqual(1, len(report.failed()))
+
+    def test_invalid_definition(self):
+        path = os.path.join(self.directory.name, 'fleet.json')
+        with open(path, 'w') as f:
+            json.dump({'targets': [{'name': 'eu', 'url': 'https://rancher.eu', 'access_key': 'key'}]}, f)
+        with self.assertRaises(fleet.ConfigurationError):
+            fleet.load_fleet(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
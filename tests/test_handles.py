@@ -0,0 +1,77 @@
+import os
+import tempfile
+import unittest
+
+from click.testing import CliRunner
+
+from ranchertool import cli
+from ranchertool.helpers import DeployHandle
+from tests.mock_rancher import MockRancher, MockRancherServer
+
+
+class DeployHandleTests(unittest.TestCase):
+
+    def setUp(self):
+        self.rancher = MockRancher(transition_polls=0)
+        stack_id = self.rancher.add_stack('web')
+        self.service_ids = [self.rancher.add_service(stack_id, name, image='acme/%s:1' % name)
+                            for name in ('api', 'worker')]
+        self.server = MockRancherServer(self.rancher).__enter__()
+        self.connection_args = ['--rancher-url', self.server.url, '--rancher-key', 'key', '--rancher-secret', 'secret',
+                                '--log-level', 'SILENT']
+
+    def tearDown(self):
+        self.server.__exit__(None, None, None)
+
+    def test_encode_decode(self):
+        handle = DeployHandle('1a1', '1st1', '1s2', 'web', 'api', 'upgraded', 1700000000.5)
+        encoded = handle.encode()
+        self.assertTrue(encoded.startswith('rt1.'))
+        self.assertNotIn('=', encoded)
+        self.assertEqual(handle, DeployHandle.decode(encoded + '\n'))
+        with self.assertRaises(ValueError):
+            DeployHandle.decode('rt1.not-base64!')
+        with self.assertRaises(ValueError):
+            DeployHandle.decode('1s2')
+
+    def test_no_wait_emits_handle_that_wait_resumes(self):
+        runner = CliRunner()
+        handles = []
+        for service in ('api', 'worker'):
+            result = runner.invoke(cli.main, self.connection_args + ['--stack', 'web', '--service', service,
+                                                                     '--image', 'acme/%s:2' % service, '--no-wait'])
+            self.assertEqual(0, result.exit_code, result.output)
+            handles.append(DeployHandle.decode(result.output.strip().splitlines()[-1]))
+        self.assertEqual(self.service_ids, [handle.service_id for handle in handles])
+        for service_id in self.service_ids:
+            self.assertIn(self.rancher.services[service_id]['state'], ('upgrading', 'upgraded'))
+
+        self.rancher.reset_log()
+        result = runner.invoke(cli.main, ['wait'] + [handle.encode() for handle in handles] + self.connection_args)
+        self.assertEqual(0, result.exit_code, result.output)
+        for service_id in self.service_ids:
+            self.assertEqual('active', self.rancher.services[service_id]['state'])
+        # the handle carries every id, so nothing has to be looked up again
+        paths = [path for method, path in self.rancher.request_log()]
+        self.assertNotIn('/v2-beta/projects', paths)
+        self.assertFalse([path for path in paths if path.endswith('/stacks') or path.endswith('/services')])
+
+    def test_wait_reads_handle_file(self):
+        runner = CliRunner()
+        with tempfile.TemporaryDirectory() as directory:
+            handle_file = os.path.join(directory, 'handles.txt')
+            result = runner.invoke(cli.main, self.connection_args + ['--stack', 'web', '--service', 'api', '--image',
+                                                                     'acme/api:2', '--no-wait', '--handle-file',
+                                                                     handle_file])
+            self.assertEqual(0, result.exit_code, result.output)
+            result = runner.invoke(cli.main, ['wait', '--handle-file', handle_file] + self.connection_args)
+            self.assertEqual(0, result.exit_code, result.output)
+        self.assertEqual('active', self.rancher.services[self.service_ids[0]]['state'])
+
+    def test_wait_rejects_bad_handles(self):
+        result = CliRunner().invoke(cli.main, ['wait', 'nonsense'] + self.connection_args)
+        self.assertNotEqual(0, result.exit_code)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+import json
+import os
+import tempfile
+import unittest
+
+from click.testing import CliRunner
+
+import ranchertool
+from ranchertool import DeployOutcome, DeployResult, cli
+from ranchertool.helpers import ConfigurationError, LogLevel, VirtualClock
+from ranchertool.history import DeployHistory, percentile
+from tests import simulation
+from tests.mock_rancher import MockRancher, MockRancherServer
+
+
+def result(wait, service='api', outcome=DeployOutcome.FINISHED):
+    return DeployResult('web', service, '1s1', outcome, {'discovery': 0.5, 'upgrade': 1.0, 'wait': wait, 'finish': 1.0},
+                        requests={'discovery': 3, 'upgrade': 2, 'wait': int(wait), 'finish': 2})
+
+
+class DeployHistoryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'history.db')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_percentile(self):
+        self.assertEqual(2.5, percentile([4, 1, 3, 2], 50))
+        self.assertAlmostEqual(3.97, percentile([1, 2, 3, 4], 99))
+        self.assertEqual(7, percentile([7], 90))
+        self.assertIsNone(percentile([], 50))
+
+    def test_record_and_stats(self):
+        with DeployHistory(self.path) as history:
+            for started, wait in enumerate([10, 12, 11, 13]):
+                history.record(result(wait), started=started)
+            history.record(result(3, outcome=None), failed=True, started=10)
+        with DeployHistory(self.path) as history:
+            runs = history.runs('web/api')
+            self.assertEqual(5, len(runs))
+            self.assertEqual({'discovery': 3, 'upgrade': 2, 'wait': 10, 'finish': 2}, runs[0].phase_requests)
+            self.assertEqual(17, runs[0].requests)
+            failed, finished = history.stats()
+        self.assertEqual(('web/api', 'finished', 4), finished[:3])
+        self.assertEqual(('web/api', 'failed', 1), failed[:3])
+        self.assertEqual(14.0, finished.p50)
+        self.assertEqual(15.5, finished.max)
+        self.assertEqual(11.5, finished.phases['wait']['p50'])
+
+    def test_regressions_are_flagged_against_baseline(self):
+        with DeployHistory(self.path) as history:
+            for started, wait in enumerate([10, 11, 10, 12, 11, 10, 30, 11]):
+                history.record(result(wait), started=started)
+            history.record(result(60, 'other'), started=20)
+            history.record(result(90, outcome=None), failed=True, started=21)
+            regressions = history.regressions(min_baseline_runs=5)
+            self.assertEqual([], history.regressions(since=7))
+        self.assertEqual(1, len(regressions))
+        regression = regressions[0]
+        self.assertEqual(32.5, regression.run.duration)
+        self.assertEqual(13.0, regression.baseline)
+        self.assertEqual('wait', regression.phase)
+        self.assertEqual(10.5, regression.phase_baseline)
+
+    def test_not_a_history_file(self):
+        with open(self.path, 'w') as f:
+            f.write('not a database' * 100)
+        with self.assertRaises(ConfigurationError):
+            DeployHistory(self.path)
+
+
+class HistoryCommandTests(unittest.TestCase):
+
+    def setUp(self):
+        self.rancher = MockRancher(transition_polls=1)
+        self.rancher.add_service(self.rancher.add_stack('web'), 'api', image='acme/api:1')
+        self.server = MockRancherServer(self.rancher).__enter__()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'history.db')
+
+    def tearDown(self):
+        self.directory.cleanup()
+        self.server.__exit__(None, None, None)
+
+    def test_deploy_counts_requests_per_phase(self):
+        with ranchertool.connect(self.server.url, 'key', 'secret', log_level=LogLevel.SILENT,
+                                 clock=VirtualClock()) as connection:
+            result = ranchertool.deploy(connection, 'web', 'api', image='acme/api:2', pre_pull=True,
+                                        log_level=LogLevel.SILENT)
+        self.assertEqual(set(result.timings), set(result.requests))
+        self.assertEqual(len(self.rancher.request_log()) - 1, result.request_count)  # minus the project lookup
+        self.assertGreaterEqual(result.requests['pull'], 2)
+        self.assertEqual(1, result.requests['upgrade'])
+
+    def test_upgrade_records_and_history_reports(self):
+        for image in ('acme/api:2', 'acme/api:3'):
+            with simulation.virtual_connections(VirtualClock()):
+                upgrade = CliRunner().invoke(cli.main, ['upgrade', '--rancher-url', self.server.url, '--rancher-key',
+                                                        'key', '--rancher-secret', 'secret', '--stack', 'web',
+                                                        '--service', 'api', '--image', image, '--log-level', 'SILENT',
+                                                        '--history', self.path])
+            self.assertEqual(0, upgrade.exit_code, upgrade.output)
+        report = CliRunner().invoke(cli.main, ['history', '--history', self.path, '--format', 'json', 'web/api'])
+        self.assertEqual(0, report.exit_code, report.output)
+        services = json.loads(report.output)['services']
+        self.assertEqual([('web/api', 'finished', 2)], [(row['service'], row['outcome'], row['runs'])
+                                                        for row in services])
+        self.assertEqual({'discovery', 'upgrade', 'wait', 'finish'}, set(services[0]['phases']))
+        self.assertGreater(services[0]['requests'], 0)
+
+        table = CliRunner().invoke(cli.main, ['history', '--history', self.path])
+        self.assertEqual(0, table.exit_code, table.output)
+        self.assertIn('web/api', table.output)
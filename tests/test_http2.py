@@ -0,0 +1,69 @@
+import importlib
+import os
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import ranchertool
+from ranchertool import DeployOutcome
+from ranchertool.helpers import ConfigurationError, Http2Transport, LogLevel, RancherConnection
+from tests.mock_rancher import MockRancher, MockRancherH2Server, MockRancherServer, h2, tls_certificate
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+@unittest.skipUnless(httpx and h2 and shutil.which('openssl'), 'needs httpx, h2 and openssl')
+class Http2TransportTests(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.certificate = tls_certificate(directory.name)
+        self.rancher = MockRancher(transition_polls=1, latency=0.01)
+        stack_id = self.rancher.add_stack('web')
+        for index in range(20):
+            self.rancher.add_service(stack_id, 'service-%d' % index, image='acme/app:1')
+
+    def test_concurrent_deploys_share_one_connection(self):
+        with MockRancherH2Server(self.certificate, self.rancher) as server:
+            with ranchertool.connect(server.url, 'key', 'secret', ssl_verify=self.certificate[0], http2=True,
+                                     log_level=LogLevel.SILENT) as connection:
+                connection.get_project_id()
+                with ThreadPoolExecutor(max_workers=20) as pool:
+                    results = list(pool.map(lambda index: ranchertool.deploy(
+                        connection, 'web', 'service-%d' % index, image='acme/app:2', log_level=LogLevel.SILENT),
+                        range(20)))
+        self.assertEqual({DeployOutcome.FINISHED}, {result.outcome for result in results})
+        self.assertEqual(1, server.connections)
+        self.assertEqual(len(self.rancher.request_log()), server.streams)
+
+    def test_http1_servers_keep_working(self):
+        with MockRancherServer(self.rancher, certificate=self.certificate) as server:
+            transport = Http2Transport(verify=False)
+            with RancherConnection(server.url, 'key', 'secret', None, 'web', 'service-0', log_level=LogLevel.SILENT,
+                                   transport=transport) as connection:
+                self.assertEqual('active', connection.get_service_state())
+        self.assertEqual(1, server.connections)
+
+    def test_proxied_requests_fall_back_to_http1(self):
+        with MockRancherServer(self.rancher) as proxy:
+            # rancher.invalid doesn't resolve: the service state can only come through the proxy
+            with mock.patch.dict(os.environ, {'HTTP_PROXY': proxy.url, 'NO_PROXY': ''}):
+                with RancherConnection('http://rancher.invalid', 'key', 'secret', None, 'web', 'service-0',
+                                       log_level=LogLevel.SILENT, transport=Http2Transport()) as connection:
+                    self.assertEqual('active', connection.get_service_state())
+        self.assertGreater(len(self.rancher.request_log('GET')), 0)
+
+    def test_missing_httpx_is_a_configuration_error(self):
+        with mock.patch.object(importlib.import_module('ranchertool.helpers.Http2Transport'), 'httpx', None):
+            with self.assertRaises(ConfigurationError):
+                ranchertool.connect('https://rancher.example.com', 'key', 'secret', http2=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
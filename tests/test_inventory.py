@@ -0,0 +1,101 @@
+import unittest
+
+import ranchertool
+from ranchertool.helpers import LogLevel
+from tests.mock_rancher import MockRancher, MockRancherServer
+
+
+class InventoryTests(unittest.TestCase):
+
+    def setUp(self):
+        self.rancher = MockRancher(transition_polls=0)
+        self.db_ids = {}
+        for index in range(6):
+            stack_id = self.rancher.add_stack('data-%d' % index)
+            self.db_ids['data-%d' % index] = self.rancher.add_service(stack_id, 'db', image='postgres:12')
+        self.api_id = self.rancher.add_service(self.rancher.add_stack('web'), 'api', image='acme/api:1')
+        self.server = MockRancherServer(self.rancher).__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+
+    def connect(self, inventory=True):
+        connection = ranchertool.connect(self.server.url, 'key', 'secret', timeout=1, log_level=LogLevel.SILENT,
+                                         inventory=inventory)
+        self.addCleanup(connection.close)
+        self.rancher.reset_log()
+        return connection
+
+    def deploy_with_links(self, connection):
+        links = [('db%d' % index, 'data-%d/db' % index) for index in range(6)]
+        ranchertool.deploy(connection, 'web', 'api', image='acme/api:2', service_links=links,
+                           log_level=LogLevel.SILENT)
+        return len(self.rancher.request_log('GET'))
+
+    def test_lookups_by_name_reference_and_id(self):
+        inventory = self.connect().inventory
+        service = inventory.service('data-3', 'db')
+        self.assertEqual(self.db_ids['data-3'], service.id)
+        requests = len(self.rancher.request_log())
+        self.assertIs(service, inventory.service_by_reference('data-3/db'))
+        self.assertIs(service, inventory.service_by_id(self.db_ids['data-3']))
+        self.assertEqual('data-3', inventory.stack_by_id(service.stack_id).name)
+        self.assertEqual(6, len(inventory.services_named('db')))
+        self.assertEqual([service], inventory.stack_services(service.stack_id))
+        self.assertEqual(7, len(inventory))
+        self.assertEqual(requests, len(self.rancher.request_log()))
+
+    def test_listings_are_fetched_page_by_page(self):
+        self.rancher.page_size = 4
+        inventory = self.connect().inventory
+        inventory.refresh()
+        # 7 stacks and 7 services, 4 per page
+        self.assertEqual(4, len(self.rancher.request_log('GET')))
+        self.assertIsNotNone(inventory.service('web', 'api'))
+
+    def test_unchanged_refresh_indexes_nothing(self):
+        inventory = self.connect().inventory
+        self.assertTrue(inventory.refresh())
+        not_modified = self.server.not_modified
+        self.assertFalse(inventory.refresh())
+        self.assertEqual(not_modified + 2, self.server.not_modified)
+
+    def test_misses_refresh_the_index(self):
+        connection = self.connect()
+        self.assertIsNone(connection.inventory.service('web', 'worker'))
+        self.rancher.add_service(self.rancher.services[self.api_id]['stackId'], 'worker')
+        self.assertTrue(connection.service_exists('worker', target=connection.target('web')))
+        connection.remove_service(target=connection.target('web', 'worker'))
+        self.assertIsNone(connection.inventory.service_by_reference('web/worker'))
+
+    def test_recreated_service_replaces_the_cached_one(self):
+        for inventory in (True, False):
+            connection = self.connect(inventory=inventory)
+            ranchertool.deploy(connection, 'web', 'api', image='acme/api:2', log_level=LogLevel.SILENT)
+            # removed and created again under the same name behind the connection's back
+            self.rancher.services[self.api_id]['state'] = 'removed'
+            stack_id = self.rancher.services[self.api_id]['stackId']
+            self.api_id = self.rancher.add_service(stack_id, 'api', image='acme/api:1')
+            result = ranchertool.deploy(connection, 'web', 'api', image='acme/api:3', log_level=LogLevel.SILENT)
+            self.assertEqual(self.api_id, result.service_id)
+            self.assertEqual('docker:acme/api:3', self.rancher.services[self.api_id]['launchConfig']['imageUuid'])
+
+    def test_v1_inventory(self):
+        rancher = MockRancher(api_version='v1', transition_polls=0)
+        service_id = rancher.add_service(rancher.add_stack('web'), 'api', image='acme/api:1')
+        with MockRancherServer(rancher) as server:
+            with ranchertool.connect(server.url, 'key', 'secret', api_version='v1', log_level=LogLevel.SILENT,
+                                     inventory=True) as connection:
+                self.assertEqual(service_id, connection.inventory.service('web', 'api').id)
+                [(stack_name, service)] = connection.find_services(['web/api'])
+                self.assertEqual(('web', service_id), (stack_name, service.id))
+
+    def test_links_across_stacks_need_fewer_requests(self):
+        without = self.deploy_with_links(self.connect(inventory=False))
+        with_inventory = self.deploy_with_links(self.connect())
+        self.assertEqual(sorted(('db%d' % index, self.db_ids['data-%d' % index]) for index in range(6)),
+                         sorted((link['name'], link['serviceId'])
+                                for link in self.rancher.services[self.api_id]['serviceLinks']))
+        self.assertLess(with_inventory, without)
+
+
+if __name__ == '__main__':
+    unittest.main()
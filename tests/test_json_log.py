@@ -0,0 +1,135 @@
+import io
+import json
+import threading
+import time
+import unittest
+from unittest import mock
+
+from click.testing import CliRunner
+
+from ranchertool import cli
+from ranchertool.helpers import Logger, LogLevel
+from tests.mock_rancher import MockRancher, MockRancherServer
+
+
+class SlowStream(io.StringIO):
+
+    def write(self, text):
+        time.sleep(0.05)
+        return super().write(text)
+
+
+class BrokenStream(io.StringIO):
+
+    def write(self, text):
+        raise OSError('disk full')
+
+
+class JsonLogTests(unittest.TestCase):
+
+    def tearDown(self):
+        Logger.configure('text')
+
+    def test_records_carry_bound_fields(self):
+        stream = io.StringIO()
+        Logger.configure('json', stream)
+        log = Logger(LogLevel.DEBUG, 'Deploy').bind(service='web/api')
+        log.info('Upgrading', phase='upgrade')
+        log.bind(phase='wait').debug('Request', 'GET /services', latency_ms=12.5)
+        log.trace('not logged at DEBUG')
+        Logger.flush()
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([('INFO', 'Upgrading', 'upgrade'), ('DEBUG', 'Request: GET /services', 'wait')],
+                         [(record['level'], record['message'], record['phase']) for record in records])
+        self.assertEqual({'web/api'}, {record['service'] for record in records})
+        self.assertEqual(12.5, records[1]['latency_ms'])
+        self.assertEqual('Deploy', records[0]['logger'])
+
+    def test_caller_fields_do_not_replace_reserved_ones(self):
+        stream = io.StringIO()
+        Logger.configure('json', stream)
+        Logger(LogLevel.INFO, 'Deploy').bind(logger='other').info('Upgrading', level='high', ts='yesterday')
+        Logger.flush()
+        record = json.loads(stream.getvalue())
+        self.assertEqual(('INFO', 'Deploy', 'Upgrading'), (record['level'], record['logger'], record['message']))
+        self.assertEqual(('high', 'other', 'yesterday'), (record['level_'], record['logger_'], record['ts_']))
+
+    def test_writer_survives_bad_records_and_streams(self):
+        stream = io.StringIO()
+        Logger.configure('json', stream)
+        circular = []
+        circular.append(circular)
+        log = Logger(LogLevel.INFO, 'Deploy')
+        log.info('unwritable', value=circular)
+        log.info('written')
+        started = time.monotonic()
+        Logger.flush()
+        self.assertLess(time.monotonic() - started, 1)
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(['ERROR', 'INFO'], [record['level'] for record in records])
+        self.assertEqual('written', records[1]['message'])
+
+        Logger.configure('json', BrokenStream())
+        with mock.patch('sys.__stderr__', io.StringIO()) as stderr:
+            log.info('lost')
+            Logger.flush()
+            log.info('lost too')
+            started = time.monotonic()
+            Logger.flush()
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(2, stderr.getvalue().count('disk full'))
+
+    def test_fatal_errors_stay_json(self):
+        stream = io.StringIO()
+        Logger.configure('json', stream)
+        with self.assertRaises(SystemExit) as exited:
+            Logger(LogLevel.TRACE, 'Deploy').fatal('Stack not found')
+        self.assertEqual(1, exited.exception.code)
+        self.assertEqual(['Stack not found'], [json.loads(line)['message'] for line in stream.getvalue().splitlines()])
+
+    def test_logging_does_not_wait_for_the_stream(self):
+        stream = SlowStream()
+        Logger.configure('json', stream)
+        log = Logger(LogLevel.INFO, 'Load')
+        started = time.monotonic()
+        threads = [threading.Thread(target=lambda: [log.info('message %d' % i) for i in range(100)])
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLess(time.monotonic() - started, 0.05)
+        Logger.flush()
+        self.assertEqual(400, len(stream.getvalue().splitlines()))
+
+    def test_cli_json_log_format(self):
+        rancher = MockRancher(transition_polls=0)
+        rancher.add_service(rancher.add_stack('web'), 'api')
+        with MockRancherServer(rancher) as server:
+            result = CliRunner().invoke(cli.main, ['--log-format', 'json', '--stack', 'web', '--service', 'api',
+                                                   '--image', 'acme/api:2', '--rancher-url', server.url,
+                                                   '--rancher-key', 'key', '--rancher-secret', 'secret',
+                                                   '--log-level', 'TRACE'])
+        self.assertEqual(0, result.exit_code, result.output)
+        records = [json.loads(line) for line in result.stderr.splitlines()]
+        requests = [record for record in records if 'latency_ms' in record]
+        self.assertEqual(len(rancher.request_log()), len(requests))
+        self.assertIn('upgraded', [record.get('state') for record in records])
+        self.assertIn(('Deploy', 'web/api', 'finish'),
+                      [(record['logger'], record.get('service'), record.get('phase')) for record in records])
+
+    def test_cli_output_is_kept_apart_from_json_logs(self):
+        rancher = MockRancher(transition_polls=0)
+        rancher.add_service(rancher.add_stack('web'), 'api')
+        with MockRancherServer(rancher) as server:
+            result = CliRunner().invoke(cli.main, ['--log-format', 'json', 'status', '--stack', 'web', '--format',
+                                                   'json', '--rancher-url', server.url, '--rancher-key', 'key',
+                                                   '--rancher-secret', 'secret', '--log-level', 'DEBUG'])
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertEqual([('web', 'api', 'active')],
+                         [(row['stack'], row['service'], row['state']) for row in json.loads(result.stdout)])
+        self.assertTrue(all('latency_ms' in json.loads(line) for line in result.stderr.splitlines()))
+
+
+if __name__ == '__main__':
+    unittest.main()
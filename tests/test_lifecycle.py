@@ -0,0 +1,75 @@
+import unittest
+
+from click.testing import CliRunner
+
+from ranchertool import cli
+from ranchertool.helpers import LogLevel, RancherConnection, ServiceState, VirtualClock
+from tests import simulation
+from tests.mock_rancher import MockRancher, MockRancherServer, MockRancherTransport
+
+
+class LifecycleTests(unittest.TestCase):
+
+    def setUp(self):
+        self.rancher = MockRancher(transition_polls=0)
+        self.stack_id = self.rancher.add_stack('web')
+        self.service_id = self.rancher.add_service(self.stack_id, 'api', image='acme/api:1')
+        self.server = MockRancherServer(self.rancher).__enter__()
+
+    def tearDown(self):
+        self.server.__exit__(None, None, None)
+
+    def test_full_upgrade_request_sequence(self):
+        result = CliRunner().invoke(cli.main, ['--rancher-url', self.server.url, '--rancher-key', 'key',
+                                               '--rancher-secret', 'secret', '--stack', 'web', '--service', 'api',
+                                               '--image', 'acme/api:2', '--log-level', 'SILENT'])
+        self.assertEqual(0, result.exit_code, result.output)
+        service = '/v2-beta/projects/1a1/services/%s' % self.service_id
+        self.assertEqual([
+            ('GET', '/v2-beta/projects'),
+            ('GET', '/v2-beta/projects/1a1/stacks'),
+            ('GET', '/v2-beta/projects/1a1/stacks/%s/services' % self.stack_id),
+            ('GET', service),
+            ('POST', service + '?action=upgrade'),
+            ('GET', service),
+            ('POST', service + '?action=finishupgrade'),
+            ('GET', service),
+        ], self.rancher.request_log())
+        self.assertEqual('active', self.rancher.services[self.service_id]['state'])
+        self.assertEqual('docker:acme/api:2', self.rancher.services[self.service_id]['launchConfig']['imageUuid'])
+
+    def test_wait_without_pending_transition_does_not_poll(self):
+        connection = RancherConnection(self.server.url, 'key', 'secret', None, 'web', 'api',
+                                       log_level=LogLevel.SILENT)
+        lifecycle = connection.lifecycle()
+        self.assertIs(ServiceState.ACTIVE, lifecycle.observe())
+        self.rancher.reset_log()
+        self.assertTrue(lifecycle.wait_until(ServiceState.ACTIVE))
+        self.assertEqual([], self.rancher.request_log())
+
+    def test_upgrade_tracks_pending_transition(self):
+        self.rancher.transition_polls = 1
+        clock = VirtualClock()
+        connection = RancherConnection(simulation.URL, 'key', 'secret', None, 'web', 'api',
+                                       log_level=LogLevel.SILENT, transport=MockRancherTransport(self.rancher),
+                                       clock=clock)
+        lifecycle = connection.lifecycle()
+        self.assertTrue(lifecycle.upgrade({'inServiceStrategy': {'launchConfig': lifecycle.launch_config()}}))
+        self.assertIs(ServiceState.UPGRADING, lifecycle.state)
+        self.assertIs(ServiceState.UPGRADED, lifecycle.pending)
+        self.assertTrue(lifecycle.finish())
+        self.assertIs(ServiceState.ACTIVE, lifecycle.state)
+        self.assertIsNone(lifecycle.pending)
+        # the one poll of each transition waited on the virtual clock
+        self.assertEqual(4, clock.slept)
+
+    def test_finish_on_active_service_is_a_no_op(self):
+        connection = RancherConnection(self.server.url, 'key', 'secret', None, 'web', 'api',
+                                       log_level=LogLevel.SILENT)
+        lifecycle = connection.lifecycle()
+        self.assertTrue(lifecycle.finish())
+        self.assertEqual([], self.rancher.request_log('POST'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,23 @@
+import unittest
+
+from tests.load_rancher import run_load
+
+
+class LoadHarnessTests(unittest.TestCase):
+
+    def test_report(self):
+        report = run_load(deploys=20, concurrency=10, latency=0.005)
+        self.assertEqual(0, report['failed'], report['errors'])
+        self.assertGreater(report['deploys_per_second'], 0)
+        self.assertEqual(report['server_requests'], report['requests'])
+        self.assertLessEqual(report['tcp_connections'], 20)
+        self.assertEqual({'discovery', 'upgrade', 'wait', 'finish'}, set(report['phase_seconds']))
+        self.assertEqual({'p50', 'p90', 'p99', 'max'}, set(report['request_latency_ms']))
+        if report['peak_rss_mb'] is not None:
+            # in MB whatever unit the platform reports it in
+            self.assertTrue(1 < report['peak_rss_mb'] < 4096, report['peak_rss_mb'])
+
+    def test_connection_per_deploy(self):
+        report = run_load(deploys=10, connection_per_deploy=True)
+        self.assertEqual(0, report['failed'], report['errors'])
+        self.assertEqual(10, report['tcp_connections'])
@@ -0,0 +1,62 @@
+import unittest
+
+from ranchertool.helpers import LogLevel, RancherConnection, ServiceState, VirtualClock
+from tests import simulation
+from tests.mock_rancher import MockRancher, MockRancherServer, MockRancherTransport
+
+
+class ConditionalPollingTests(unittest.TestCase):
+
+    def connect(self, rancher):
+        self.server = MockRancherServer(rancher).__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        connection = RancherConnection(self.server.url, 'key', 'secret', None, 'web', 'api',
+                                       log_level=LogLevel.SILENT)
+        self.addCleanup(connection.close)
+        return connection
+
+    def rancher(self, **kwargs):
+        rancher = MockRancher(transition_polls=0, **kwargs)
+        self.service_id = rancher.add_service(rancher.add_stack('web'), 'api',
+                                              environment={'VARIABLE_%d' % n: 'x' * 100 for n in range(50)})
+        return rancher
+
+    def test_stable_state_is_polled_with_etags(self):
+        connection = self.connect(self.rancher())
+        first = connection.get_service()
+        sent = self.server.bytes_sent
+        for _ in range(10):
+            self.assertIs(first, connection.get_service())
+        self.assertEqual(10, self.server.not_modified)
+        self.assertEqual(sent, self.server.bytes_sent)
+        self.assertEqual(11, len(self.server.rancher.request_log('GET')) - 3)  # project, stack and service lookups
+
+    def test_changes_are_seen(self):
+        rancher = self.rancher()
+        connection = self.connect(rancher)
+        self.assertEqual('active', connection.get_service_state())
+        with rancher.lock:
+            rancher.services[self.service_id]['state'] = 'inactive'
+        self.assertEqual('inactive', connection.get_service_state())
+        self.assertEqual('inactive', connection.get_service_state())
+        self.assertEqual(1, self.server.not_modified)
+
+    def test_identical_bodies_are_not_decoded_again_without_etags(self):
+        connection = self.connect(self.rancher(etags=False))
+        first = connection.get_service()
+        self.assertIs(first, connection.get_service())
+        self.assertEqual(0, self.server.not_modified)
+
+    def test_upgrade_with_conditional_polls(self):
+        clock = VirtualClock()
+        rancher = self.rancher(transition_seconds=5, clock=clock)
+        transport = MockRancherTransport(rancher)
+        connection = RancherConnection(simulation.URL, 'key', 'secret', None, 'web', 'api', log_level=LogLevel.SILENT,
+                                       transport=transport, clock=clock)
+        lifecycle = connection.lifecycle()
+        self.assertTrue(lifecycle.upgrade({'inServiceStrategy': {'launchConfig': {'imageUuid': 'docker:acme/api:2'}}}))
+        self.assertTrue(lifecycle.wait_until(ServiceState.UPGRADED))
+        self.assertTrue(lifecycle.finish())
+        self.assertEqual('docker:acme/api:2', rancher.services[self.service_id]['launchConfig']['imageUuid'])
+        # the polls while a transition was under way went unchanged
+        self.assertGreater(transport.not_modified, 0)
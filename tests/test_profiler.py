@@ -0,0 +1,62 @@
+import os
+import tempfile
+import time
+import unittest
+
+from click.testing import CliRunner
+
+from ranchertool import cli
+from ranchertool.helpers import SamplingProfiler
+from tests.mock_rancher import MockRancher, MockRancherServer
+
+
+def busy_client_work(seconds):
+    end = time.monotonic() + seconds
+    total = 0
+    while time.monotonic() < end:
+        total += sum(range(100))
+    return total
+
+
+def idle(seconds):
+    time.sleep(seconds)
+
+
+class ProfilerTests(unittest.TestCase):
+
+    def test_samples_split_client_and_waiting_time(self):
+        with SamplingProfiler(interval=0.002) as profiler:
+            busy_client_work(0.2)
+            idle(0.2)
+        self.assertGreater(profiler.samples, 20)
+        stacks = profiler.collapsed()
+        self.assertTrue(any(stack.startswith('MainThread;') and 'test_profiler:busy_client_work' in stack
+                            for stack in stacks))
+        self.assertTrue(any(stack.endswith('test_profiler:idle [waiting]') for stack in stacks))
+        summary = profiler.summary(top=3)
+        self.assertIn('test_profiler:busy_client_work', summary)
+        self.assertNotIn('test_profiler:idle', summary)
+
+    def test_profile_option_before_default_command(self):
+        rancher = MockRancher(transition_polls=0)
+        rancher.add_service(rancher.add_stack('web'), 'api')
+        with tempfile.TemporaryDirectory() as directory, MockRancherServer(rancher) as server:
+            path = os.path.join(directory, 'profile.txt')
+            connection_args = ['--rancher-url', server.url, '--rancher-key', 'key', '--rancher-secret', 'secret']
+            result = CliRunner().invoke(cli.main, ['--profile', path, '--stack', 'web', '--service', 'api', '--image',
+                                                   'acme/api:2', '--log-level', 'SILENT'] + connection_args)
+            self.assertEqual(0, result.exit_code, result.output)
+            with open(path) as f:
+                lines = f.read().splitlines()
+            self.assertTrue(lines)
+            self.assertTrue(all(line.rsplit(' ', 1)[1].isdigit() for line in lines))
+            self.assertTrue(any('ranchertool/cli:upgrade' in line for line in lines))
+
+            result = CliRunner().invoke(cli.main, ['--profile=%s' % path, '--profile-top', '3', 'status', '--stack',
+                                                   'web'] + connection_args)
+            self.assertEqual(0, result.exit_code, result.output)
+            self.assertIn('api', result.output)
+
+
+if __name__ == '__main__':
+    unittest.main()
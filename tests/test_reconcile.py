@@ -0,0 +1,164 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from click.testing import CliRunner
+
+import ranchertool
+from ranchertool import DefinitionDirectory, ReconcileState, cli, reconcile
+from ranchertool.helpers import LogLevel
+from tests.mock_rancher import MockRancher, MockRancherServer
+
+
+class ReconcileTests(unittest.TestCase):
+
+    def setUp(self):
+        self.rancher = MockRancher(transition_polls=0)
+        stack_id = self.rancher.add_stack('web')
+        self.api_id = self.rancher.add_service(stack_id, 'api', image='acme/api:1', labels={'team': 'web'})
+        self.worker_id = self.rancher.add_service(stack_id, 'worker', image='acme/worker:1')
+        self.server = MockRancherServer(self.rancher).__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        self.connection = ranchertool.connect(self.server.url, 'key', 'secret', timeout=1, log_level=LogLevel.SILENT)
+        self.addCleanup(self.connection.close)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.definitions = DefinitionDirectory(self.directory)
+        self.state = ReconcileState(os.path.join(self.directory, 'state'))
+        self.define('api', {'stack': 'web', 'service': 'api', 'image': 'acme/api:1', 'labels': {'team': 'web'}})
+        self.define('worker', {'stack': 'web', 'service': 'worker', 'image': 'acme/worker:1'})
+
+    def define(self, name, content):
+        path = os.path.join(self.directory, '%s.json' % name)
+        with open(path, 'w') as f:
+            json.dump(content, f)
+        # a distinct modification time, even on file systems with a coarse clock
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+
+    def reconcile(self, **kwargs):
+        return ranchertool.reconcile_services(self.connection, self.definitions.load(), self.state,
+                                              log_level=LogLevel.SILENT, **kwargs)
+
+    def actions(self, report):
+        return {outcome.definition.service_name: outcome.action for outcome in report.outcomes}
+
+    def image(self, service_id):
+        return self.rancher.services[service_id]['launchConfig']['imageUuid']
+
+    def test_unchanged_cycles_cost_one_conditional_request(self):
+        self.assertEqual({'api': 'upgraded', 'worker': 'upgraded'}, self.actions(self.reconcile()))
+        self.assertEqual({'api': 'in-sync', 'worker': 'in-sync'}, self.actions(self.reconcile()))
+        self.rancher.reset_log()
+        not_modified = self.server.not_modified
+        report = self.reconcile()
+        self.assertEqual({'api': 'in-sync', 'worker': 'in-sync'}, self.actions(report))
+        self.assertTrue(report.succeeded)
+        self.assertEqual(1, len(self.rancher.request_log()))
+        self.assertEqual(not_modified + 1, self.server.not_modified)
+
+    def test_drifted_service_is_upgraded(self):
+        self.reconcile()
+        self.rancher.services[self.worker_id]['launchConfig']['imageUuid'] = 'docker:acme/worker:0'
+        report = self.reconcile()
+        self.assertEqual({'api': 'in-sync', 'worker': 'upgraded'}, self.actions(report))
+        self.assertEqual(['image is docker:acme/worker:0'], report.outcomes[1].reasons)
+        self.assertEqual('docker:acme/worker:1', self.image(self.worker_id))
+        self.assertEqual('active', self.rancher.services[self.worker_id]['state'])
+
+    def test_changed_definition_is_upgraded(self):
+        self.reconcile()
+        self.define('api', {'stack': 'web', 'service': 'api', 'image': 'acme/api:2', 'labels': {'team': 'web'}})
+        report = self.reconcile()
+        self.assertEqual({'api': 'upgraded', 'worker': 'in-sync'}, self.actions(report))
+        self.assertEqual(['definition changed', 'image is docker:acme/api:1'], report.outcomes[0].reasons)
+        self.assertEqual('docker:acme/api:2', self.image(self.api_id))
+
+    def test_recreated_service_converges(self):
+        connection = ranchertool.connect(self.server.url, 'key', 'secret', timeout=1, log_level=LogLevel.SILENT,
+                                         inventory=True)
+        self.addCleanup(connection.close)
+        ranchertool.reconcile_services(connection, self.definitions.load(), self.state, log_level=LogLevel.SILENT)
+        # removed and created again under the same name, still on the old image
+        self.rancher.services[self.api_id]['state'] = 'removed'
+        stack_id = self.rancher.services[self.api_id]['stackId']
+        api_id = self.rancher.add_service(stack_id, 'api', image='acme/api:0', labels={'team': 'web'})
+        report = ranchertool.reconcile_services(connection, self.definitions.load(), self.state,
+                                                log_level=LogLevel.SILENT)
+        self.assertEqual({'api': 'upgraded', 'worker': 'in-sync'}, self.actions(report))
+        self.assertEqual(api_id, report.outcomes[0].result.service_id)
+        self.assertEqual('docker:acme/api:1', self.image(api_id))
+        report = ranchertool.reconcile_services(connection, self.definitions.load(), self.state,
+                                                log_level=LogLevel.SILENT)
+        self.assertEqual({'api': 'in-sync', 'worker': 'in-sync'}, self.actions(report))
+
+    def test_upgrade_that_does_not_converge_fails(self):
+        self.reconcile()
+        self.rancher.services[self.worker_id]['launchConfig']['imageUuid'] = 'docker:acme/worker:0'
+        deployed = ranchertool.DeployResult('web', 'worker', self.worker_id, ranchertool.DeployOutcome.FINISHED, {})
+        with mock.patch.object(reconcile.api, 'deploy', return_value=deployed):
+            report = self.reconcile()
+        self.assertEqual({'api': 'in-sync', 'worker': 'failed'}, self.actions(report))
+        self.assertIn('image is docker:acme/worker:0', report.outcomes[1].error)
+        self.assertFalse(report.succeeded)
+
+    def test_busy_and_missing_services(self):
+        self.reconcile()
+        self.rancher.reset_log()
+        self.define('cron', {'stack': 'web', 'service': 'cron', 'image': 'acme/cron:1'})
+        self.rancher.services[self.api_id]['state'] = 'upgrading'
+        self.rancher.services[self.api_id]['launchConfig']['imageUuid'] = 'docker:acme/api:0'
+        report = self.reconcile()
+        self.assertEqual({'api': 'busy', 'cron': 'missing', 'worker': 'in-sync'}, self.actions(report))
+        self.assertFalse(report.succeeded)
+        self.assertEqual(['cron'], [outcome.definition.service_name for outcome in report.failed()])
+        self.assertEqual([], self.rancher.request_log('POST'))
+
+    def test_state_survives_restarts(self):
+        self.reconcile()
+        self.state = ReconcileState(self.state.path)
+        self.assertEqual({'api': 'in-sync', 'worker': 'in-sync'}, self.actions(self.reconcile()))
+        with open(self.state.path, 'w') as f:
+            f.write('{"services": {}}')
+        with self.assertRaises(ranchertool.ConfigurationError):
+            ReconcileState(self.state.path)
+
+    def test_dry_run_changes_nothing(self):
+        self.rancher.services[self.api_id]['launchConfig']['labels']['team'] = 'ops'
+        report = self.reconcile(dry_run=True)
+        self.assertEqual({'api': 'drifted', 'worker': 'drifted'}, self.actions(report))
+        self.assertEqual(['definition changed', 'labels team differ'], report.outcomes[0].reasons)
+        self.assertEqual([], self.rancher.request_log('POST'))
+        self.assertFalse(os.path.exists(self.state.path))
+
+    def test_only_changed_files_are_parsed_again(self):
+        first = self.definitions.load()
+        self.define('worker', {'stack': 'web', 'service': 'worker', 'image': 'acme/worker:2'})
+        second = self.definitions.load()
+        self.assertIs(first[0], second[0])
+        self.assertIsNot(first[1], second[1])
+        self.define('copy', {'stack': 'web', 'service': 'worker'})
+        with self.assertRaises(ranchertool.ConfigurationError):
+            self.definitions.load()
+        self.define('copy', {'stack': 'web', 'service': 'worker', 'imag': 'typo'})
+        with self.assertRaises(ranchertool.ConfigurationError):
+            self.definitions.load()
+
+    def test_reconcile_command(self):
+        self.rancher.services[self.worker_id]['launchConfig']['imageUuid'] = 'docker:acme/worker:0'
+        result = CliRunner().invoke(cli.main, ['reconcile', self.directory, '--state', self.state.path,
+                                               '--rancher-url', self.server.url, '--rancher-key', 'key',
+                                               '--rancher-secret', 'secret', '--format', 'json',
+                                               '--log-level', 'SILENT'])
+        self.assertEqual(0, result.exit_code, result.output)
+        rows = json.loads(result.output[result.output.index('['):])
+        self.assertEqual(['upgraded', 'upgraded'], [row['action'] for row in rows])
+        self.assertEqual('docker:acme/worker:1', self.image(self.worker_id))
+        self.assertEqual(2, len(ReconcileState(self.state.path).applied))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from click.testing import CliRunner
+
+from ranchertool import api, cli, release
+from ranchertool.helpers import ConfigurationError, VirtualClock
+from tests import simulation
+from tests.mock_rancher import MockRancher, MockRancherServer
+
+PLAN = {'services': [
+    {'stack': 'web', 'service': 'api', 'image': 'acme/api:2', 'service_links': {'db': 'web/db'},
+     'depends_on': ['web/cache']},
+    {'stack': 'web', 'service': 'db', 'image': 'postgres:12'},
+    {'stack': 'web', 'service': 'cache', 'image': 'redis:6'},
+]}
+
+
+class ReleaseTests(unittest.TestCase):
+
+    def setUp(self):
+        self.rancher = MockRancher()
+        self.stack_id = self.rancher.add_stack('web')
+        self.ids = {name: self.rancher.add_service(self.stack_id, name) for name in ('api', 'db', 'cache')}
+        self.server = MockRancherServer(self.rancher).__enter__()
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+        self.server.__exit__(None, None, None)
+
+    def release(self, plan, *args):
+        path = os.path.join(self.directory.name, 'plan.json')
+        with open(path, 'w') as f:
+            json.dump(plan, f)
+        return CliRunner().invoke(cli.main, ['release', '--plan', path, '--rancher-url', self.server.url,
+                                             '--rancher-key', 'key', '--rancher-secret', 'secret', '--format', 'json',
+                                             '--log-level', 'SILENT'] + list(args))
+
+    def action_index(self, name, action):
+        posts = [path for method, path in self.rancher.request_log('POST')]
+        return posts.index('/v2-beta/projects/1a1/services/%s?action=%s' % (self.ids[name], action))
+
+    def test_dependants_wait_for_their_upstreams(self):
+        # the independent db and cache are deployed side by side: each waits for the other to have started
+        side_by_side = threading.Barrier(2, timeout=10)
+        deploy = api.deploy
+
+        def deploy_side_by_side(connection, stack_name, service_name, **kwargs):
+            if service_name in ('db', 'cache'):
+                side_by_side.wait()
+            return deploy(connection, stack_name, service_name, **kwargs)
+
+        with simulation.virtual_connections(VirtualClock()), mock.patch.object(api, 'deploy', deploy_side_by_side):
+            result = self.release(PLAN)
+        self.assertEqual(0, result.exit_code, result.output)
+        rows = json.loads(result.output)
+        self.assertEqual(['db', 'cache', 'api'], [row['service'].split('/')[1] for row in rows])
+        self.assertEqual(['web/cache', 'web/db'], rows[2]['depends_on'])
+        self.assertEqual({'finished'}, {row['status'] for row in rows})
+        # api is upgraded only once both are active
+        self.assertGreater(self.action_index('api', 'upgrade'), self.action_index('db', 'finishupgrade'))
+        self.assertGreater(self.action_index('api', 'upgrade'), self.action_index('cache', 'finishupgrade'))
+        self.assertEqual([{'name': 'db', 'serviceId': self.ids['db']}],
+                         self.rancher.services[self.ids['api']]['serviceLinks'])
+
+    def test_failed_upstream_skips_dependants(self):
+        self.rancher.transition_polls = 0
+        plan = {'services': PLAN['services'] + [{'stack': 'web', 'service': 'queue', 'depends_on': ['web/missing']},
+                                                {'stack': 'web', 'service': 'missing', 'image': 'acme/missing:1'}]}
+        plan['services'][0] = dict(plan['services'][0], depends_on=['web/cache', 'web/missing'])
+        result = self.release(plan)
+        self.assertNotEqual(0, result.exit_code)
+        rows = json.JSONDecoder().raw_decode(result.output.strip())[0]
+        self.assertEqual({'web/db': 'finished', 'web/cache': 'finished', 'web/missing': 'failed', 'web/api': 'skipped',
+                          'web/queue': 'skipped'}, {row['service']: row['status'] for row in rows})
+        self.assertEqual('docker:alpine:latest', self.rancher.services[self.ids['api']]['launchConfig']['imageUuid'])
+
+    def test_plan_validation(self):
+        steps = [release.ReleaseStep('web', 'a', ('web/b',)), release.ReleaseStep('web', 'b', ('web/a',))]
+        with self.assertRaises(ConfigurationError):
+            release.plan(steps)
+        with self.assertRaises(ConfigurationError):
+            release.plan([release.ReleaseStep('web', 'a', ('web/unknown',))])
+        # links to services outside the plan are not dependencies
+        steps = release.plan([release.ReleaseStep('web', 'a', options={'service_links': [('db', 'other/db')]})])
+        self.assertEqual((), steps[0].depends_on)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import json
+import tracemalloc
+import unittest
+
+import ranchertool
+from ranchertool import LaunchConfig, Service, Stack
+from ranchertool.helpers import LogLevel, get_codec
+from tests.mock_rancher import MockRancher, MockRancherServer
+
+
+def service_resource(index):
+    """A service resource as Rancher returns it, with the links and actions ranchertool doesn't use."""
+    return {
+        'id': '1s%d' % index,
+        'type': 'service',
+        'name': 'service-%d' % index,
+        'stackId': '1st1',
+        'state': 'active',
+        'healthState': 'healthy',
+        'scale': 2,
+        'createIndex': index,
+        'description': None,
+        'launchConfig': {
+            'imageUuid': 'docker:acme/service:%d' % index,
+            'labels': {'io.rancher.container.pull_image': 'always', 'team': 'web'},
+            'environment': {'MODE': 'prod'},
+            'ports': ['80:8080/tcp'],
+            'networkMode': 'managed',
+        },
+        'secondaryLaunchConfigs': [{'name': 'proxy', 'imageUuid': 'docker:acme/proxy:1'}],
+        'linkedServices': {'db': '1s0'},
+        'links': {name: 'http://rancher/v2-beta/projects/1a1/services/1s%d/%s' % (index, name)
+                  for name in ('self', 'account', 'consumedbyservices', 'consumedservices', 'instances', 'stack')},
+        'actions': {name: 'http://rancher/v2-beta/projects/1a1/services/1s%d/?action=%s' % (index, name)
+                    for name in ('upgrade', 'restart', 'update', 'remove', 'deactivate', 'addservicelink')},
+    }
+
+
+class ResourceTests(unittest.TestCase):
+
+    def test_fields_are_decoded_into_slots(self):
+        service = Service(service_resource(1))
+        self.assertFalse(hasattr(service, '__dict__'))
+        self.assertEqual(('1s1', 'service-1', '1st1', 'active', 'healthy', 2),
+                         (service.id, service.name, service.stack_id, service.state, service.health_state,
+                          service.scale))
+        self.assertIsInstance(service.launch_config, LaunchConfig)
+        self.assertEqual('acme/service:1', service.launch_config.image)
+        self.assertEqual({'MODE': 'prod'}, service.launch_config.environment)
+        self.assertEqual('docker:acme/proxy:1', service.sidekick('proxy').image_uuid)
+        self.assertIsNone(service.sidekick('cache'))
+        self.assertEqual({'db': '1s0'}, service.links)
+
+    def test_resource_round_trip(self):
+        for codec in ('json', None):
+            resource = service_resource(1)
+            self.assertEqual(resource, Service(resource, get_codec(codec)).resource())
+        stack = {'id': '1st1', 'name': 'web', 'state': 'active', 'healthState': 'healthy', 'type': 'stack'}
+        self.assertEqual(stack, Stack(stack).resource())
+        self.assertEqual(Service(service_resource(1)), Service(json.loads(json.dumps(service_resource(1)))))
+        self.assertNotEqual(Service(service_resource(1)), Service(service_resource(2)))
+
+    def test_v1_services_refer_to_their_environment(self):
+        resource = service_resource(1)
+        resource['environmentId'] = resource.pop('stackId')
+        service = Service.for_api('v1')(resource)
+        self.assertIsInstance(service, Service)
+        self.assertEqual('1st1', service.stack_id)
+        self.assertEqual(resource, service.resource())
+        self.assertIsNone(Service.for_api('v2-beta')(resource).stack_id)
+
+    def test_repeated_strings_are_shared(self):
+        first, second = Service(service_resource(1)), Service(service_resource(2))
+        self.assertIs(first.state, second.state)
+        self.assertIs(next(iter(first.launch_config.labels)), next(iter(second.launch_config.labels)))
+
+    def test_records_are_smaller_than_the_decoded_resources(self):
+        payload = json.dumps([service_resource(index) for index in range(2000)]).encode('utf-8')
+
+        def allocated(build):
+            tracemalloc.start()
+            kept = build(json.loads(payload))
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            self.assertEqual(2000, len(kept))
+            return size
+
+        resources = allocated(lambda resources: resources)
+        records = allocated(lambda resources: [Service(resource) for resource in resources])
+        self.assertLess(records, resources * 0.75)
+
+    def test_find_services_returns_records(self):
+        rancher = MockRancher()
+        stack_id = rancher.add_stack('web')
+        rancher.add_service(stack_id, 'api', image='acme/api:1', labels={'team': 'web'})
+        with MockRancherServer(rancher) as server:
+            with ranchertool.connect(server.url, 'key', 'secret', log_level=LogLevel.SILENT) as connection:
+                [(stack_name, service)] = connection.find_services(['web/api'], conditional=True)
+                self.assertEqual(('web', 'api', 'acme/api:1'), (stack_name, service.name, service.launch_config.image))
+                self.assertEqual({'team': 'web'}, service.resource()['launchConfig']['labels'])
+                [(stack_name, again)] = connection.find_services(['web/api'], conditional=True)
+                self.assertIs(service, again)
+                self.assertEqual(1, server.not_modified)
+
+
+if __name__ == '__main__':
+    unittest.main()
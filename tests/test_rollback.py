@@ -0,0 +1,110 @@
+import os
+import tempfile
+import unittest
+
+from click.testing import CliRunner
+
+import ranchertool
+from ranchertool import RollbackStrategy, ServiceSnapshot, cli
+from ranchertool.helpers import LogLevel
+from tests.mock_rancher import MockRancher, MockRancherServer
+
+
+class SnapshotRollbackTests(unittest.TestCase):
+
+    def setUp(self):
+        self.rancher = MockRancher(transition_polls=0)
+        self.service_id = self.rancher.add_service(self.rancher.add_stack('web'), 'api', image='acme/api:1',
+                                                   secondary_launch_configs=[{'name': 'proxy',
+                                                                              'imageUuid': 'docker:acme/proxy:1'}])
+        self.rancher.services[self.service_id]['scale'] = 4
+        self.server = MockRancherServer(self.rancher).__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        self.connection = ranchertool.connect(self.server.url, 'key', 'secret', timeout=1, log_level=LogLevel.SILENT)
+        self.addCleanup(self.connection.close)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'api.snapshot')
+
+    def image(self):
+        return self.rancher.services[self.service_id]['launchConfig']['imageUuid']
+
+    def deploy(self, **kwargs):
+        return ranchertool.deploy(self.connection, 'web', 'api', image='acme/api:2',
+                                  new_sidekick_images={'proxy': 'acme/proxy:2'}, log_level=LogLevel.SILENT, **kwargs)
+
+    def test_snapshot_is_saved_before_the_upgrade(self):
+        result = self.deploy(snapshot_file=self.path)
+        snapshot = ServiceSnapshot.load(self.path)
+        self.assertEqual(result.snapshot, snapshot)
+        self.assertEqual(('web', 'api', self.service_id, 4), (snapshot.stack_name, snapshot.service_name,
+                                                              snapshot.service_id, snapshot.scale))
+        self.assertEqual('docker:acme/api:1', snapshot.launch_config['imageUuid'])
+        self.assertEqual('docker:acme/proxy:1', snapshot.secondary_launch_configs[0]['imageUuid'])
+        self.assertEqual('docker:acme/api:2', self.image())
+
+    def test_finished_upgrade_is_reapplied_all_at_once(self):
+        self.deploy(snapshot_file=self.path)
+        result = ranchertool.rollback(self.connection, self.path, log_level=LogLevel.SILENT)
+        self.assertIn('reapply', result.timings)
+        self.assertNotIn('rollback', result.timings)
+        self.assertEqual('docker:acme/api:1', self.image())
+        service = self.rancher.services[self.service_id]
+        self.assertEqual('docker:acme/proxy:1', service['secondaryLaunchConfigs'][0]['imageUuid'])
+        self.assertEqual('active', service['state'])
+        strategy = service['upgrade']['inServiceStrategy']
+        self.assertEqual((4, 0), (strategy['batchSize'], strategy['intervalMillis']))
+
+    def test_upgrade_in_progress_uses_the_rollback_action(self):
+        snapshot = self.deploy(finish=False).snapshot
+        result = ranchertool.rollback(self.connection, snapshot, log_level=LogLevel.SILENT)
+        self.assertEqual(['rollback'], [phase for phase in result.timings if phase != 'discovery'])
+        self.assertEqual('docker:acme/api:1', self.image())
+
+    def test_failed_rollback_action_falls_back_to_reapply(self):
+        snapshot = self.deploy(finish=False).snapshot
+        self.rancher.stuck_actions.add('rollback')
+        result = ranchertool.rollback(self.connection, snapshot, log_level=LogLevel.SILENT)
+        self.assertIn('rollback', result.timings)
+        self.assertIn('reapply', result.timings)
+        self.assertEqual('docker:acme/api:1', self.image())
+        self.assertEqual('active', self.rancher.services[self.service_id]['state'])
+
+    def test_reapply_strategy_skips_the_rollback_action(self):
+        self.rancher.stuck_actions.add('upgrade')
+        with self.assertRaises(ranchertool.UpgradeFailed) as context:
+            self.deploy(rollback=True, rollback_strategy='reapply')
+        self.assertNotIn('rollback', context.exception.result.timings)
+        self.assertIn('reapply', context.exception.result.timings)
+        self.assertFalse([path for method, path in self.rancher.request_log('POST') if 'action=rollback' in path])
+
+    def test_action_strategy_needs_an_upgrade_in_progress(self):
+        snapshot = self.deploy().snapshot
+        self.rancher.reset_log()
+        with self.assertRaises(ranchertool.UpgradeFailed):
+            ranchertool.rollback(self.connection, snapshot, RollbackStrategy.ACTION, log_level=LogLevel.SILENT)
+        self.assertEqual([], self.rancher.request_log('POST'))
+
+    def test_not_a_snapshot(self):
+        with open(self.path, 'w') as f:
+            f.write('{"launch_config": {}}')
+        with self.assertRaises(ValueError):
+            ServiceSnapshot.load(self.path)
+        with self.assertRaises(ranchertool.ConfigurationError):
+            ranchertool.rollback(self.connection, self.path)
+
+    def test_rollback_command(self):
+        options = ['--rancher-url', self.server.url, '--rancher-key', 'key', '--rancher-secret', 'secret',
+                   '--log-level', 'SILENT']
+        upgrade = CliRunner().invoke(cli.main, ['upgrade', '--stack', 'web', '--service', 'api', '--image',
+                                                'acme/api:2', '--snapshot', self.path] + options)
+        self.assertEqual(0, upgrade.exit_code, upgrade.output)
+        self.assertEqual('docker:acme/api:2', self.image())
+        rollback = CliRunner().invoke(cli.main, ['rollback', '--snapshot', self.path, '--batch-size', '2'] + options)
+        self.assertEqual(0, rollback.exit_code, rollback.output)
+        self.assertEqual('docker:acme/api:1', self.image())
+        self.assertEqual(2, self.rancher.services[self.service_id]['upgrade']['inServiceStrategy']['batchSize'])
+
+
+if __name__ == '__main__':
+    unittest.main()
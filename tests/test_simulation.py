@@ -0,0 +1,77 @@
+import unittest
+from unittest import mock
+
+import ranchertool
+from ranchertool.api import DeployOutcome
+from ranchertool.helpers import Deadline, VirtualClock
+from tests import simulation
+
+
+class VirtualClockTests(unittest.TestCase):
+
+    def test_time_only_moves_when_slept_on(self):
+        clock = VirtualClock(10)
+        clock.sleep(5)
+        clock.advance(2.5)
+        clock.sleep(-1)
+        self.assertEqual(17.5, clock.monotonic())
+        self.assertEqual(5, clock.slept)
+
+    def test_deadlines_run_on_the_clock(self):
+        clock = VirtualClock()
+        deadline = Deadline(60, clock)
+        self.assertEqual(30, deadline.cap(30))
+        clock.sleep(45)
+        self.assertEqual(15, deadline.cap(30))
+        clock.sleep(15)
+        self.assertTrue(deadline.expired())
+
+
+class SimulationTests(unittest.TestCase):
+
+    def test_slow_upgrade(self):
+        sim, (result, seconds) = simulation.slow_upgrade()
+        self.assertEqual(DeployOutcome.FINISHED, result.outcome)
+        self.assertEqual(360, seconds)
+        self.assertEqual(360, sim.clock.slept)
+        self.assertEqual(180, round(result.timings['wait']))
+        self.assertEqual(180, round(result.timings['finish']))
+
+    def test_stuck_upgrade_times_out_and_rolls_back(self):
+        sim, (error, seconds) = simulation.stuck_upgrade()
+        self.assertIsInstance(error, ranchertool.UpgradeFailed)
+        self.assertTrue(error.rolled_back)
+        self.assertEqual(300, seconds)
+        self.assertEqual('docker:acme/api:1', sim.image(next(iter(sim.rancher.services))))
+
+    def test_exceeded_deadline(self):
+        sim, (error, seconds) = simulation.exceeded_deadline()
+        self.assertIsInstance(error, ranchertool.UpgradeFailed)
+        self.assertEqual(120, seconds)
+        self.assertEqual('upgrading', next(iter(sim.rancher.services.values()))['state'])
+
+    def test_previous_upgrade_is_finished_first(self):
+        sim, (result, seconds) = simulation.previous_upgrade()
+        self.assertEqual(DeployOutcome.FINISHED, result.outcome)
+        self.assertEqual(180, seconds)
+        actions = [path.rsplit('=', 1)[1] for method, path in sim.rancher.request_log('POST')]
+        self.assertEqual(['finishupgrade', 'upgrade', 'finishupgrade'], actions)
+
+    def test_stuck_pre_pull_never_starts_the_upgrade(self):
+        sim, (error, seconds) = simulation.stuck_pre_pull()
+        self.assertIsInstance(error, ranchertool.RancherToolError)
+        self.assertEqual(120, seconds)
+        self.assertFalse([path for method, path in sim.rancher.request_log('POST') if 'action=upgrade' in path])
+
+    def test_scenarios_never_sleep_for_real(self):
+        with mock.patch('time.sleep') as sleep:
+            for scenario in simulation.SCENARIOS:
+                sim, (outcome, seconds) = scenario()
+                # all of the virtual time passed on the clock's sleeps
+                self.assertEqual(sim.clock.monotonic(), sim.clock.slept, scenario.__name__)
+                self.assertGreater(seconds, 0, scenario.__name__)
+        self.assertEqual(0, sleep.call_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import json
+import unittest
+
+from click.testing import CliRunner
+
+from ranchertool import cli
+from tests.mock_rancher import MockRancher, MockRancherServer
+
+
+class StatusTests(unittest.TestCase):
+
+    def setUp(self):
+        self.rancher = MockRancher()
+        web = self.rancher.add_stack('web')
+        jobs = self.rancher.add_stack('jobs')
+        self.rancher.add_service(web, 'api', image='acme/api:7')
+        self.rancher.add_service(web, 'worker', image='acme/worker:3', state='upgraded')
+        self.rancher.add_service(jobs, 'worker', image='acme/cron:1')
+        self.server = MockRancherServer(self.rancher).__enter__()
+        self.connection_args = ['--rancher-url', self.server.url, '--rancher-key', 'key', '--rancher-secret', 'secret']
+
+    def tearDown(self):
+        self.server.__exit__(None, None, None)
+
+    def status(self, *args):
+        self.rancher.reset_log()
+        return CliRunner().invoke(cli.main, ['status'] + list(args) + self.connection_args)
+
+    def test_json_output_with_one_services_request(self):
+        result = self.status('web/api', 'jobs/worker', '--format', 'json')
+        self.assertEqual(0, result.exit_code, result.output)
+        rows = json.loads(result.output)
+        self.assertEqual([('web', 'api', 'active', 'acme/api:7'), ('jobs', 'worker', 'active', 'acme/cron:1')],
+                         [(row['stack'], row['service'], row['state'], row['image']) for row in rows])
+        self.assertEqual([1, 'healthy'], [rows[0]['scale'], rows[0]['health']])
+        services_requests = [path for method, path in self.rancher.request_log() if '/services' in path]
+        self.assertEqual(1, len(services_requests))
+        self.assertEqual(3, len(self.rancher.request_log()))
+
+    def test_table_output_for_whole_stack(self):
+        result = self.status('--stack', 'web')
+        self.assertEqual(0, result.exit_code, result.output)
+        lines = result.output.strip().splitlines()
+        self.assertEqual(['STACK', 'SERVICE', 'STATE', 'HEALTH', 'SCALE', 'IMAGE'], lines[0].split())
+        self.assertEqual(['web', 'api', 'active', 'healthy', '1', 'acme/api:7'], lines[1].split())
+        self.assertEqual(['web', 'worker', 'upgraded', 'healthy', '1', 'acme/worker:3'], lines[2].split())
+        self.assertEqual(3, len(lines))
+
+    def test_bare_names_search_every_stack(self):
+        result = self.status('worker', '--format', 'json')
+        self.assertEqual(0, result.exit_code, result.output)
+        self.assertEqual({'web', 'jobs'}, {row['stack'] for row in json.loads(result.output)})
+
+    def test_require_state(self):
+        self.assertEqual(0, self.status('web/api', '--require-state', 'active').exit_code)
+        self.assertEqual(1, self.status('web/worker', '--require-state', 'active').exit_code)
+        self.assertEqual(1, self.status('web/missing', '--require-state', 'active').exit_code)
+
+
+if __name__ == '__main__':
+    unittest.main()